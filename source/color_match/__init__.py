@@ -1,90 +1,632 @@
 """color_match package"""
 
 import argparse
+import importlib
+import json
 import os
+import sys
+from collections.abc import Mapping
 import numpy as np
-from PIL import Image
 from . import utils
-from . import hm
-from . import reinhard
-from . import mkl
-from . import mvgd
+from . import instrument
+from . import parallel
+from .reference import ReferenceProfile, ProfileCache
+from .utils import set_backend, get_backend, available_backends
 
-def match(src_img: np.ndarray, ref_img: np.ndarray, method: str, mode: str) -> np.ndarray:
-    '''カラーマッチング'''
+__version__ = "0.1.0"
 
-    if method == "hm":
-        if mode == "rgb":
-            matched_img = hm.match_rgb(src_img, ref_img)
-        else:
-            matched_img = hm.match_lab_l(src_img, ref_img)
-    elif method == "reinhard":
-        if mode == "rgb":
-            matched_img = reinhard.match_rgb(src_img, ref_img)
-        else:
-            matched_img = reinhard.match_lab_l(src_img, ref_img)
-    elif method == "mvgd":
-        if mode == "rgb":
-            matched_img = mvgd.match_rgb(src_img, ref_img)
-        else:
-            matched_img = mvgd.match_lab_l(src_img, ref_img)
-    elif method == "mkl":
-        if mode == "rgb":
-            matched_img = mkl.match_rgb(src_img, ref_img)
-        else:
-            matched_img = mkl.match_lab_l(src_img, ref_img)
-    elif method == 'hm-mvgd-hm':
-        if mode == "rgb":
-            matched_img = hm.match_rgb(src_img, ref_img)
-            matched_img = mvgd.match_rgb(matched_img, ref_img)
-            matched_img = hm.match_rgb(matched_img, ref_img)
-        else:
-            matched_img = hm.match_lab_l(src_img, ref_img)
-            matched_img = mvgd.match_lab_l(matched_img, ref_img)
-            matched_img = hm.match_lab_l(matched_img, ref_img)
-    elif method == 'hm-mkl-hm':
-        if mode == "rgb":
-            matched_img = hm.match_rgb(src_img, ref_img)
-            matched_img = mkl.match_rgb(matched_img, ref_img)
-            matched_img = hm.match_rgb(matched_img, ref_img)
-        else:
-            matched_img = hm.match_lab_l(src_img, ref_img)
-            matched_img = mkl.match_lab_l(matched_img, ref_img)
-            matched_img = hm.match_lab_l(matched_img, ref_img)
-    else:
+METHODS = ("hm", "reinhard", "mvgd", "mkl", "hm-mvgd-hm", "hm-mkl-hm", "sliced-ot")
+MODES = ("rgb", "lab")
+
+# 手法名 -> 実装モジュール名
+_MODULE_NAMES = {"hm": "hm", "reinhard": "reinhard", "mvgd": "mvgd", "mkl": "mkl", "sliced-ot": "sliced_ot"}
+
+# 最初に参照した時に import するサブモジュール (color_match.hm 等の属性として参照できる)
+_SUBMODULES = (
+    "hm", "reinhard", "mvgd", "mkl", "sliced_ot", "lut3d", "imagefile", "stream", "session",
+    "batch", "sequence", "bench", "serve",
+)
+
+
+class _LazyModules(Mapping):
+    """
+    手法名 -> 実装モジュール
+
+    実装モジュールは最初に参照した時に import する
+    (.bat 等から画像1枚ごとにインタプリタを起動する為、使わない手法の import の時間を省く)
+    """
+
+    def __init__(self, names: dict):
+        self._names = names
+        self._modules = {}
+
+    def __getitem__(self, name: str):
+        module = self._modules.get(name)
+        if module is None:
+            module = self._modules[name] = importlib.import_module(f"{__name__}.{self._names[name]}")
+        return module
+
+    def __contains__(self, name) -> bool:
+        # Mapping の既定の実装は __getitem__ を呼ぶ為、import せずに判定する
+        return name in self._names
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+
+# 手法名 -> 実装モジュール
+_MODULES = _LazyModules(_MODULE_NAMES)
+
+
+def __getattr__(name: str):
+    """サブモジュールと MatchSession を最初に参照した時に import する"""
+
+    if name in _SUBMODULES:
+        return importlib.import_module(f"{__name__}.{name}")
+    if name == "MatchSession":
+        from .session import MatchSession
+        return MatchSession
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _stages(method: str) -> tuple:
+    """手法を構成する処理段(hm / reinhard / mvgd / mkl / sliced-ot)の並びを返す"""
+
+    if method not in METHODS:
         raise ValueError(f"不明な方法: {method}")
-    
-    matched_img = np.clip(matched_img, 0, 255).astype(np.uint8)
-    return matched_img
+    if method in _MODULES:
+        return (method,)
+    # 複合法は "hm-mvgd-hm" のように処理段を "-" で連結した名前になっている
+    return tuple(method.split("-"))
+
+
+def _check_mode(mode: str) -> None:
+    if mode not in MODES:
+        raise ValueError(f"不明なモード: {mode}")
+
+
+def _check_profile(profile: ReferenceProfile, method: str, mode: str) -> None:
+    """参照プロファイルが指定の手法・モードに利用できるか確認"""
+
+    if profile.mode != mode or any(name not in profile.stats for name in _stages(method)):
+        raise ValueError(
+            f"参照プロファイル({profile.method}, {profile.mode})は {method}, {mode} に利用できません"
+        )
+
+
+def _name(module) -> str:
+    """実装モジュールの手法名 (hm / reinhard / mvgd / mkl / sliced-ot)"""
+
+    return next(name for name, m in _MODULE_NAMES.items() if module.__name__ == f"{__name__}.{m}")
+
+
+def _fitter(module, bins: int = 256):
+    """統計量を計算する関数 (HM はヒストグラムのビン数を指定する)"""
+
+    if _name(module) == "hm":
+        return lambda x: module.fit(x, bins)
+    return module.fit
+
+
+def _transformer(module, ot_iterations: int = None, ot_tol: float = None):
+    """色変換を求める関数 (Sliced OT は反復回数と収束判定の許容誤差を指定する)"""
+
+    if _name(module) == "sliced-ot":
+        return lambda src_stats, ref_stats: module.transform(src_stats, ref_stats, ot_iterations, ot_tol)
+    return module.transform
+
+
+def _fit_stats(module, x: np.ndarray, sample_tol: float, sampling: str, mode: str = None,
+               bins: int = 256, workers: int = None) -> dict:
+    """
+    画素の統計量を計算
+
+    引数:
+        x: 処理対象の色空間の画素 (..., C)
+            mode を指定した場合はRGB画像として扱い、処理対象の色空間に変換してから計算する
+            (画素を抽出する場合は抽出した画素のみ変換する)
+        sample_tol: 画素の抽出による推定の許容誤差(None の場合は全画素から計算)
+        bins: HM のヒストグラムのビン数 (元の画像の utils.levels())
+        workers: 全画素から計算する場合のスレッド数 (parallel.resolve() を参照)
+    """
+
+    fit_work = _fitter(module, bins)
+    if mode is None:
+        fit = fit_work
+    else:
+        fit = lambda pixels: fit_work(utils.to_workspace(pixels, mode)[0])
+    with instrument.stage(f"stats:{_name(module)}"):
+        if sample_tol is None:
+            if _name(module) == "sliced-ot":
+                # 抽出した画素のみを使う為、行ブロックに分けても速くならない (分けると抽出する画素が変わる)
+                return fit(x)
+            return parallel.fit(fit, module.merge, x, workers)
+        return utils.sample_stats(x, fit, module.distance, sample_tol, sampling)
+
+
+def _apply_transforms(work: np.ndarray, stages: tuple, transforms: list, workers: int = None) -> np.ndarray:
+    """
+    処理対象の色空間の画素に処理段ごとの色変換を順に適用
+
+    処理段の間では色空間の変換や uint8 への量子化を行わない
+    (複合法の MVGD / MKL の出力は 0-255 の範囲外になり得るが、次の HM で範囲内に収まる)
+    """
+
+    x = work
+    for name, t in zip(stages, transforms):
+        with instrument.stage(f"apply:{name}"):
+            x = parallel.apply(lambda b: _MODULES[name].apply(b, t), x, workers=workers)
+    return x
+
+
+def _check_dtype(dtype) -> np.dtype:
+    """計算に使う浮動小数点の型 (float64 / float32) を確認"""
+
+    try:
+        dtype = np.dtype(dtype)
+    except TypeError:
+        raise ValueError(f"dtype は float64 / float32 で指定してください: {dtype}") from None
+    if dtype not in (np.float64, np.float32):
+        raise ValueError(f"dtype は float64 / float32 で指定してください: {dtype}")
+    return dtype
+
+
+def _fold_strength(stages: tuple, transforms: list, strength: float) -> tuple:
+    """
+    色変換の強さ(strength)を色変換に反映
+
+    単一の手法では色変換(LUT / 変換行列)自体を恒等変換と補間する為、適用の計算量は変わらない
+    複合法では処理段の間の変換が非線形の為、適用後の画像を入力画像と合成する
+
+    戻り値:
+        (色変換のリスト, 適用後に入力画像との合成が必要か)
+    """
+
+    if not 0.0 <= strength <= 1.0:
+        raise ValueError(f"strength は 0-1 で指定してください: {strength}")
+    if strength == 1.0:
+        return transforms, False
+    if len(stages) == 1:
+        return [_MODULES[stages[0]].interpolate(transforms[0], strength)], False
+    return transforms, True
+
+
+def _finish(src_img: np.ndarray, work: np.ndarray, lab, stages: tuple, transforms: list,
+            mode: str, strength: float, dtype=np.float64, workers: int = None) -> np.ndarray:
+    """
+    処理対象の色空間に変換した入力画像に色変換を適用し、強さを反映したRGB画像(入力画像と同じ型)を返す
+
+    引数:
+        dtype: 色変換の適用に使う型 (色変換を dtype に変換して適用する)
+        workers: スレッド数 (parallel.resolve() を参照)
+    """
+
+    transforms, blend = _fold_strength(stages, transforms, strength)
+    if strength == 0.0:
+        return src_img.copy()
+    transforms = [utils.astype_transform(t, dtype) for t in transforms]
+    x = _apply_transforms(work, stages, transforms, workers)
+    out = parallel.from_workspace(x, lab, mode, src_img.dtype, workers)
+    return parallel.blend(src_img, out, strength, workers) if blend else out
+
+
+def fit_reference(ref_img: np.ndarray, method: str, mode: str,
+                  fit_scale: float = None, max_fit_pixels: int = None,
+                  sample_tol: float = None, sampling: str = "random", workers: int = None) -> ReferenceProfile:
+    """
+    参照画像の統計量を事前に計算
+
+    戻り値の ReferenceProfile は match() の ref_img の代わりに渡すことができ、
+    参照画像の解析を省略できる
+
+    引数:
+        fit_scale / max_fit_pixels / sample_tol / sampling / workers: match() を参照
+    """
+
+    _check_mode(mode)
+    ref_img = utils.downscale(ref_img, fit_scale, max_fit_pixels)
+    bins = utils.levels(ref_img)
+    if sample_tol is None:
+        # 参照画像の色空間の変換は1度だけ行う
+        work, _ = parallel.to_workspace(ref_img, mode, workers=workers)
+    stats = {}
+    for name in _stages(method):
+        if name in stats:
+            continue
+        if sample_tol is None:
+            stats[name] = _fit_stats(_MODULES[name], work, None, sampling, bins=bins, workers=workers)
+        else:
+            stats[name] = _fit_stats(_MODULES[name], ref_img, sample_tol, sampling, mode, bins)
+    return ReferenceProfile(method, mode, stats)
+
+
+def match(src_img: np.ndarray, ref_img, method: str, mode: str,
+          fit_scale: float = None, max_fit_pixels: int = None,
+          sample_tol: float = None, sampling: str = "random", strength: float = 1.0,
+          dtype=np.float64, ot_iterations: int = None, ot_tol: float = None, workers: int = None) -> np.ndarray:
+    """
+    カラーマッチング
 
+    引数:
+        src_img: 入力画像 (RGB, uint8 / uint16 / float32 / float64)
+            出力は入力画像と同じ型 (float は 0-1 を基準とし、HDR の 1 を超える値を含んでもよい)
+            16bit / float の画像は HM のヒストグラムを 65536 段階で計算する
+        ref_img: 参照画像(入力画像と型が異なってもよい)、もしくは fit_reference() で求めた ReferenceProfile
+        fit_scale: 統計量を推定する縮小画像の縦横の縮小率(0-1)
+        max_fit_pixels: 統計量を推定する縮小画像の最大画素数
+        sample_tol: 画素の抽出による統計量の推定の許容誤差(0-1, None の場合は全画素から計算)
+        sampling: 画素の抽出方法(random / stratified)
+        strength: 色変換の強さ(0-1、0 で入力画像のまま、1 で完全にカラーマッチング)
+            HM / Reinhard / MVGD / MKL / Sliced OT は色変換(LUT / 変換行列)に反映する為、追加の計算は不要
+            (lab モードでは L チャネルで補間する)、複合法は結果を入力画像と合成する
+        dtype: 画像サイズの配列(Lab画像・色変換の適用結果)の型 (float64 / float32)
+            float32 の場合はメモリ使用量とメモリの転送量が半分になる
+            (統計量と色変換(LUT / 変換行列)は dtype に関わらず float64 で計算する)
+        ot_iterations: Sliced OT の最大の反復回数 (None の場合は sliced_ot.ITERATIONS)
+        ot_tol: Sliced OT の収束判定の許容誤差(0-1、1回の反復での画素の移動量、None の場合は sliced_ot.TOL)
+        workers: 画素ごとの処理(Lab変換・統計量の計算・色変換の適用・量子化)を行ブロックに分けて並列に処理するスレッド数
+            (None / 1 の場合は並列化しない、0 の場合は CPU のコア数、parallel を参照)
 
-def main() -> int:
+    fit_scale / max_fit_pixels を指定した場合は縮小画像で色変換を推定し、
+    元の解像度の入力画像に適用する
+
+    sample_tol を指定した場合は抽出数を倍にしながら統計量を推定し、
+    推定値の変化が sample_tol 以下になった時点の統計量を利用する
+    (統計量の計算量が画像サイズにほぼ依存しなくなる)
+    """
+
+    stages = _stages(method)
+    dtype = _check_dtype(dtype)
+    profile = _resolve_profile(ref_img, method, mode, fit_scale, max_fit_pixels, sample_tol, sampling, workers)
+
+    # 入力画像を処理対象の色空間に変換 (複合法でも色空間の変換は最初と最後の1度だけ行う)
+    work, lab = parallel.to_workspace(src_img, mode, dtype, workers)
+    bins = utils.levels(src_img)
+    proxy = utils.downscale(src_img, fit_scale, max_fit_pixels)
+    if proxy is src_img and (strength == 1.0 or len(stages) > 1):
+        # 入力画像で色変換を推定しながら適用
+        _, x = _fit_transforms(work, profile, stages, sample_tol, sampling, apply_last=True, dtype=dtype,
+                               bins=bins, ot_iterations=ot_iterations, ot_tol=ot_tol, workers=workers)
+        out = parallel.from_workspace(x, lab, mode, src_img.dtype, workers)
+        return out if strength == 1.0 else parallel.blend(src_img, out, strength, workers)
+
+    # 縮小画像(もしくは入力画像)で色変換を推定し、強さを反映して入力画像に適用
+    fit_work = work if proxy is src_img else parallel.to_workspace(proxy, mode, dtype, workers)[0]
+    transforms, _ = _fit_transforms(fit_work, profile, stages, sample_tol, sampling, dtype=dtype, bins=bins,
+                                    ot_iterations=ot_iterations, ot_tol=ot_tol, workers=workers)
+    return _finish(src_img, work, lab, stages, transforms, mode, strength, dtype, workers)
+
+
+def fit_transforms(src_img: np.ndarray, ref_img, method: str, mode: str,
+                   fit_scale: float = None, max_fit_pixels: int = None,
+                   sample_tol: float = None, sampling: str = "random", dtype=np.float64,
+                   ot_iterations: int = None, ot_tol: float = None, workers: int = None) -> list:
+    """
+    入力画像と参照画像から処理段ごとの色変換(LUTや変換行列)を求める
+
+    引数は match() と同じ
+
+    戻り値:
+        処理段(hm / reinhard / mvgd / mkl / sliced-ot)ごとの色変換のリスト (dtype に関わらず float64)
+    """
+
+    stages = _stages(method)
+    dtype = _check_dtype(dtype)
+    profile = _resolve_profile(ref_img, method, mode, fit_scale, max_fit_pixels, sample_tol, sampling, workers)
+    proxy = utils.downscale(src_img, fit_scale, max_fit_pixels)
+    work, _ = parallel.to_workspace(proxy, mode, dtype, workers)
+    transforms, _ = _fit_transforms(work, profile, stages, sample_tol, sampling, dtype=dtype,
+                                    bins=utils.levels(src_img), ot_iterations=ot_iterations, ot_tol=ot_tol,
+                                    workers=workers)
+    return transforms
+
+
+def apply_transforms(img: np.ndarray, transforms: list, method: str, mode: str,
+                     strength: float = 1.0, dtype=np.float64, workers: int = None) -> np.ndarray:
+    """
+    fit_transforms() で求めた色変換を画像に適用
+
+    引数:
+        strength / dtype / workers: match() を参照
+    """
+
+    _check_mode(mode)
+    dtype = _check_dtype(dtype)
+    work, lab = parallel.to_workspace(img, mode, dtype, workers)
+    return _finish(img, work, lab, _stages(method), transforms, mode, strength, dtype, workers)
+
+
+def bake_lut(src_img: np.ndarray, ref_img, method: str, mode: str, size: int = 33,
+             strength: float = 1.0, **options) -> np.ndarray:
+    """
+    入力画像と参照画像のカラーマッチングを3D LUTに変換
+
+    LUTは lut3d.save_cube() で .cube ファイルに保存、lut3d.apply() で画像に適用できる
+
+    引数:
+        size: 3D LUTの格子点数(33 / 65 等)
+        strength: 色変換の強さ(0-1、match() を参照)
+        options: match() と同じオプション引数(fit_scale 等)
+
+    戻り値:
+        (size, size, size, 3) の float32 配列 lut[r, g, b] = (R, G, B) (値は 0-1)
+    """
+
+    from . import lut3d
+    transforms = fit_transforms(src_img, ref_img, method, mode, **options)
+    return lut3d.bake(transforms, method, mode, size, strength)
+
+
+def _resolve_profile(ref_img, method: str, mode: str, *fit_options) -> ReferenceProfile:
+    """参照画像(もしくは ReferenceProfile)から参照プロファイルを取得"""
+
+    _check_mode(mode)
+    if isinstance(ref_img, ReferenceProfile):
+        _check_profile(ref_img, method, mode)
+        return ref_img
+    return fit_reference(ref_img, method, mode, *fit_options)
+
+
+def _fit_transforms(work: np.ndarray, profile: ReferenceProfile, stages: tuple,
+                    sample_tol: float, sampling: str, apply_last: bool = False, dtype=np.float64,
+                    bins: int = 256, ot_iterations: int = None, ot_tol: float = None,
+                    workers: int = None) -> tuple:
+    """
+    処理対象の色空間の画素から処理段ごとの色変換を求める
+
+    複合法では前の処理段の色変換を適用した画素から次の処理段の統計量を計算する
+
+    引数:
+        apply_last: 最後の処理段の色変換も適用するか
+        dtype: 色変換の適用に使う型 (戻り値の色変換は float64)
+        bins: HM のヒストグラムのビン数 (入力画像の utils.levels())
+        ot_iterations / ot_tol: Sliced OT の反復回数と収束判定の許容誤差 (match() を参照)
+        workers: スレッド数 (parallel.resolve() を参照)
+
+    戻り値:
+        (処理段ごとの色変換のリスト, 色変換を適用した画素)
+    """
+
+    transforms = []
+    x = work
+    for i, name in enumerate(stages):
+        module = _MODULES[name]
+        src_stats = _fit_stats(module, x, sample_tol, sampling, bins=bins, workers=workers)
+        with instrument.stage(f"transform:{name}"):
+            t = _transformer(module, ot_iterations, ot_tol)(src_stats, profile.stats[name])
+        transforms.append(t)
+        if apply_last or i < len(stages) - 1:
+            with instrument.stage(f"apply:{name}"):
+                t_dtype = utils.astype_transform(t, dtype)
+                x = parallel.apply(lambda b: module.apply(b, t_dtype), x, workers=workers)
+    return transforms, x
+
+
+def _add_match_arguments(p: argparse.ArgumentParser) -> None:
+    """コマンドラインの共通オプション(手法・モード等)を追加"""
+
+    p.add_argument("-m", "--method", choices=METHODS, default="mkl")
+    p.add_argument("--mode", choices=MODES, default="rgb")
+    p.add_argument("--fit-scale", type=float, default=None, help="統計量を推定する縮小画像の縦横の縮小率(0-1)")
+    p.add_argument("--max-fit-pixels", type=int, default=None, help="統計量を推定する縮小画像の最大画素数")
+    p.add_argument("--sample-tol", type=float, default=None, help="画素の抽出による統計量の推定の許容誤差(0-1)")
+    p.add_argument("--sampling", choices=("random", "stratified"), default="random", help="画素の抽出方法")
+    p.add_argument("--strength", type=float, default=1.0, help="色変換の強さ(0-1、0 で入力画像のまま)")
+    p.add_argument(
+        "--dtype", choices=("float64", "float32"), default="float64",
+        help="画像サイズの配列の型 (float32 はメモリ使用量が半分、統計量は float64 で計算)",
+    )
+    p.add_argument(
+        "--backend", choices=utils.BACKENDS, default="auto",
+        help="RGB <-> Lab 変換のバックエンド (auto は利用可能なものから最も速いものを計測して選択)",
+    )
+    p.add_argument("--ot-iterations", type=int, default=None, help="sliced-ot の最大の反復回数")
+    p.add_argument("--ot-tol", type=float, default=None, help="sliced-ot の収束判定の許容誤差(0-1)")
+    p.add_argument(
+        "--threads", type=int, default=1,
+        help="画素ごとの処理を行ブロックに分けて並列に処理するスレッド数 (0 の場合は CPU のコア数)",
+    )
+    p.add_argument(
+        "--cache-dir", default=None,
+        help="参照画像の統計量を保存するキャッシュのフォルダ (同じ参照画像の読み込みと解析を次回から省略する)",
+    )
+    p.add_argument("--cache-mb", type=float, default=256, help="キャッシュの合計サイズの上限[MB]")
+
+
+def _match_options(args: argparse.Namespace) -> dict:
+    """コマンドライン引数から match() のオプション引数を取り出す"""
+
+    return {
+        "fit_scale": args.fit_scale,
+        "max_fit_pixels": args.max_fit_pixels,
+        "sample_tol": args.sample_tol,
+        "sampling": args.sampling,
+    }
+
+
+def _ot_options(args: argparse.Namespace) -> dict:
+    """コマンドライン引数から Sliced OT のオプション引数を取り出す (参照画像の解析には使わない)"""
+
+    return {"ot_iterations": args.ot_iterations, "ot_tol": args.ot_tol}
+
+
+def _profile_cache(args: argparse.Namespace):
+    """コマンドライン引数から参照プロファイルのディスクキャッシュを作成 (--cache-dir が無い場合は None)"""
+
+    if not args.cache_dir:
+        return None
+    return ProfileCache(args.cache_dir, args.cache_mb)
+
+
+def _cache_params(method: str, mode: str, **options) -> dict:
+    """参照プロファイルのキャッシュのキーに含める、統計量に影響する条件"""
+
+    params = dict(options, method=method, mode=mode, version=__version__)
+    if mode == "lab":
+        # Lab変換の結果はバックエンドごとにわずかに異なる
+        params["backend"] = utils.get_backend()
+    return params
+
+
+def _load_reference(path: str, method: str, mode: str, cache: ProfileCache = None, workers: int = None,
+                    **options) -> ReferenceProfile:
+    """
+    参照画像(もしくは保存済みの .npz ファイル)から ReferenceProfile を読み込み
+
+    引数:
+        cache: 参照プロファイルのディスクキャッシュ (None の場合は毎回参照画像を読み込んで解析する)
+        workers: 参照画像の解析のスレッド数 (統計量の違いは丸め誤差のみの為、キャッシュのキーには含めない)
+    """
+
+    if path.lower().endswith(".npz"):
+        return ReferenceProfile.load(path)
+    compute = lambda: fit_reference(_open_rgb(path), method, mode, workers=workers, **options)
+    if cache is None:
+        return compute()
+    with instrument.stage("cache"):
+        return cache.load(path, compute, **_cache_params(method, mode, **options))
+
+
+def _open_rgb(path: str) -> np.ndarray:
+    """画像ファイルをRGB画像として読み込み (16bit / float の画像は階調を保つ、imagefile.read() を参照)"""
+
+    from . import imagefile
+    with instrument.stage("decode"):
+        return imagefile.read(path)
+
+
+def _save_rgb(img: np.ndarray, path: str) -> None:
+    """RGB画像を画像ファイルに保存 (imagefile.write() を参照)"""
+
+    from . import imagefile
+    with instrument.stage("encode"):
+        imagefile.write(img, path)
+
+
+def main(argv=None) -> int:
     """コマンドラインインターフェースのエントリポイント"""
 
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # サブコマンド
+    if argv and argv[0] == "batch":
+        from . import batch
+        return batch.main(argv[1:])
+    if argv and argv[0] == "sequence":
+        from . import sequence
+        return sequence.main(argv[1:])
+    if argv and argv[0] == "bench":
+        from . import bench
+        return bench.main(argv[1:])
+    if argv and argv[0] == "serve":
+        from . import serve
+        return serve.main(argv[1:])
+
     # 引数解析
-    p = argparse.ArgumentParser(description="Color Matching")
+    p = argparse.ArgumentParser(
+        description="Color Matching",
+        epilog=(
+            "フォルダ内の画像を一括処理する場合は batch サブコマンドを利用 (python -m color_match batch -h)\n"
+            "動画(連番画像・GIF・マルチページTIFF)を処理する場合は sequence サブコマンドを利用 (python -m color_match sequence -h)\n"
+            "処理時間を計測する場合は bench サブコマンドを利用 (python -m color_match bench -h)\n"
+            "HTTP サーバとして起動する場合は serve サブコマンドを利用 (python -m color_match serve -h)"
+        ),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
     p.add_argument("source", nargs='?', help="入力画像パス")
-    p.add_argument("reference", nargs='?', help="参照画像パス")
+    p.add_argument(
+        "reference", nargs='?',
+        help="参照画像パス(もしくは --save-reference で保存した .npz ファイル、--save-cube で保存した .cube ファイル)",
+    )
     p.add_argument("-o", "--output", help="出力画像パス", default="./output.png")
-    p.add_argument("-m", "--method", choices=("hm", "reinhard", "mvgd", "mkl", "hm-mvgd-hm", "hm-mkl-hm"), default="mkl")
-    p.add_argument("--mode", choices=("rgb", "lab"), default="rgb")
-    args = p.parse_args()
+    _add_match_arguments(p)
+    p.add_argument("--save-reference", help="参照画像の統計量を保存するパス(.npz)")
+    p.add_argument("--save-cube", help="カラーマッチングの色変換を3D LUTとして保存するパス(.cube)")
+    p.add_argument("--cube-size", type=int, default=33, help="保存する3D LUTの格子点数")
+    p.add_argument(
+        "--tile-mb", type=float, default=None,
+        help="行ストリップ単位で処理する場合の作業メモリの上限[MB] (.npy の入出力はメモリマップで読み書き)",
+    )
+    p.add_argument("--profile", action="store_true", help="処理段ごとの処理時間とメモリを表示")
+    p.add_argument("--profile-json", help="処理段ごとの処理時間とメモリを保存するパス(.json)")
+    args = p.parse_args(argv)
 
     if not args.source or not args.reference:
         p.error('source and reference are required')
         return 1
+    set_backend(args.backend)
 
-    # 画像読み込み
-    src_img = np.array(Image.open(args.source).convert("RGB"))
-    ref_img = np.array(Image.open(args.reference).convert("RGB"))
+    if args.profile or args.profile_json:
+        # 処理段ごとの処理時間とメモリを計測
+        with instrument.Recorder(memory=True) as recorder:
+            _run(args)
+        if args.profile:
+            print(recorder.table())
+        if args.profile_json:
+            with open(args.profile_json, "w", encoding="utf-8") as f:
+                json.dump(recorder.to_json(), f, indent=2)
+    else:
+        _run(args)
 
-    # カラーマッチング
-    matched_img = match(src_img, ref_img, args.method, args.mode)
-    
-    # 画像保存
-    Image.fromarray(matched_img).save(args.output)
     if os.path.exists(args.output):
         return 0
     else:
         print(f"保存に失敗しました: {args.output}")
-        return 1
\ No newline at end of file
+        return 1
+
+
+def _run(args: argparse.Namespace) -> None:
+    """コマンドライン引数に従ってカラーマッチングを行い、結果を保存"""
+
+    if args.reference.lower().endswith(".cube"):
+        # 保存済みの3D LUTを適用
+        from . import lut3d
+        src_img = _open_rgb(args.source)
+        _save_rgb(lut3d.apply(src_img, lut3d.load_cube(args.reference)), args.output)
+    elif args.tile_mb:
+        # 行ストリップ単位のカラーマッチング
+        from . import stream
+        cache = _profile_cache(args)
+        compute = lambda: stream.fit_reference(stream.open_image(args.reference), args.method, args.mode, args.tile_mb)
+        if args.reference.lower().endswith(".npz"):
+            reference = ReferenceProfile.load(args.reference)
+        elif cache is not None:
+            # 行ストリップ単位で計算した統計量は全体から計算したものとわずかに異なる場合がある為、別に保存する
+            with instrument.stage("cache"):
+                reference = cache.load(args.reference, compute,
+                                       **_cache_params(args.method, args.mode, tile_mb=args.tile_mb))
+        else:
+            reference = compute()
+        if args.save_reference:
+            reference.save(args.save_reference)
+        stream.match_file(args.source, reference, args.output, args.method, args.mode, args.tile_mb,
+                          strength=args.strength, dtype=args.dtype, **_ot_options(args))
+    else:
+        # 画像読み込み
+        src_img = _open_rgb(args.source)
+        options = _match_options(args)
+        reference = _load_reference(args.reference, args.method, args.mode, _profile_cache(args), args.threads,
+                                    **options)
+        if args.save_reference:
+            reference.save(args.save_reference)
+
+        # カラーマッチング
+        if args.save_cube:
+            # 色変換を3D LUTとして保存し、同じ色変換を入力画像に適用
+            from . import lut3d
+            transforms = fit_transforms(src_img, reference, args.method, args.mode, dtype=args.dtype,
+                                        workers=args.threads, **options, **_ot_options(args))
+            lut3d.save_cube(args.save_cube, lut3d.bake(transforms, args.method, args.mode, args.cube_size,
+                                                       args.strength))
+            matched_img = apply_transforms(src_img, transforms, args.method, args.mode, args.strength, args.dtype,
+                                           args.threads)
+        else:
+            matched_img = match(src_img, reference, args.method, args.mode, strength=args.strength,
+                                dtype=args.dtype, workers=args.threads, **options, **_ot_options(args))
+
+        # 画像保存
+        _save_rgb(matched_img, args.output)
@@ -0,0 +1,158 @@
+"""
+フォルダ内の画像の一括カラーマッチング
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from . import utils
+from . import imagefile
+from . import match, _add_match_arguments, _match_options, _ot_options, _profile_cache, _load_reference
+from .reference import ReferenceProfile
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".webp", ".tif", ".tiff")
+
+# ワーカープロセスごとに保持する参照プロファイル
+_worker_profile = None
+
+
+def find_images(src_dir) -> list:
+    """フォルダ以下(サブフォルダを含む)の画像ファイルを列挙"""
+
+    src_dir = Path(src_dir)
+    return sorted(
+        p for p in src_dir.rglob("*")
+        if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS
+    )
+
+
+def _init_worker(profile: ReferenceProfile, backend: str = "auto") -> None:
+    """
+    ワーカープロセスの初期化(参照プロファイルはプロセスごとに1度だけ受け取る)
+
+    引数:
+        backend: RGB <-> Lab 変換のバックエンド (親プロセスで選択したものを引き継ぐ)
+    """
+
+    global _worker_profile
+    _worker_profile = profile
+    utils.set_backend(backend)
+
+
+def _match_file(src_path: str, out_path: str, method: str, mode: str, options: dict) -> tuple:
+    """
+    1枚の画像をカラーマッチングして保存
+
+    戻り値:
+        (入力画像パス, 処理時間[秒], エラーメッセージ(成功時は None))
+    """
+
+    start = time.perf_counter()
+    try:
+        src_img = imagefile.read(src_path)
+        matched_img = match(src_img, _worker_profile, method, mode, **options)
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        imagefile.write(matched_img, out_path)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return src_path, time.perf_counter() - start, error
+
+
+def run(src_dir, profile: ReferenceProfile, out_dir, method: str, mode: str,
+        workers: int = None, ext: str = None, log=print, threads: int = None, **options) -> list:
+    """
+    フォルダ内の画像を一括でカラーマッチング
+
+    出力先には入力フォルダのフォルダ構成を維持して保存する
+    1枚の処理に失敗しても残りの画像の処理は継続する
+
+    引数:
+        profile: fit_reference() で求めた参照プロファイル
+        workers: ワーカープロセス数(None の場合は CPU コア数、1 の場合はプロセスを起動しない)
+        ext: 出力画像の拡張子(None の場合は入力画像と同じ)
+        log: 進捗の出力先(None の場合は出力しない)
+        threads: 1枚の画像を並列に処理するスレッド数 (match() の workers、プロセス数との積がコア数程度になる様に指定する)
+        options: match() に渡すオプション引数
+
+    戻り値:
+        画像ごとの (入力画像パス, 処理時間[秒], エラーメッセージ) のリスト
+    """
+
+    src_dir = Path(src_dir)
+    out_dir = Path(out_dir)
+    if threads is not None:
+        options = dict(options, workers=threads)
+    tasks = []
+    for src_path in find_images(src_dir):
+        out_path = out_dir / src_path.relative_to(src_dir)
+        if ext:
+            out_path = out_path.with_suffix(ext if ext.startswith(".") else "." + ext)
+        tasks.append((str(src_path), str(out_path), method, mode, options))
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(tasks)))
+
+    results = []
+
+    def _report(result):
+        results.append(result)
+        if log is None:
+            return
+        path, seconds, error = result
+        rel = os.path.relpath(path, src_dir)
+        if error is None:
+            log(f"[{len(results)}/{len(tasks)}] {rel}: {seconds:.2f}s")
+        else:
+            log(f"[{len(results)}/{len(tasks)}] {rel}: 失敗 ({error})")
+
+    # Lab変換のバックエンドは親プロセスで1度だけ決定してワーカーに引き継ぐ
+    backend = utils.get_backend() if mode == "lab" else "auto"
+    if workers == 1:
+        _init_worker(profile, backend)
+        for task in tasks:
+            _report(_match_file(*task))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(profile, backend)) as ex:
+            futures = [ex.submit(_match_file, *task) for task in tasks]
+            for future in as_completed(futures):
+                _report(future.result())
+    return results
+
+
+def main(argv=None) -> int:
+    """batch サブコマンドのエントリポイント"""
+
+    # 引数解析
+    p = argparse.ArgumentParser(prog="color-match batch", description="Color Matching (フォルダ一括処理)")
+    p.add_argument("source_dir", help="入力画像フォルダ")
+    p.add_argument("reference", help="参照画像パス(もしくは --save-reference で保存した .npz ファイル)")
+    p.add_argument("-o", "--output", help="出力フォルダ", default="./output")
+    _add_match_arguments(p)
+    p.add_argument("-w", "--workers", type=int, default=None, help="ワーカープロセス数(省略時は CPU コア数)")
+    p.add_argument("--ext", default=None, help="出力画像の拡張子(省略時は入力画像と同じ)")
+    args = p.parse_args(argv)
+
+    if not os.path.isdir(args.source_dir):
+        p.error(f"入力画像フォルダが見つかりません: {args.source_dir}")
+    utils.set_backend(args.backend)
+
+    # 参照画像の解析は1度だけ行う
+    start = time.perf_counter()
+    options = _match_options(args)
+    profile = _load_reference(args.reference, args.method, args.mode, _profile_cache(args), args.threads, **options)
+
+    # 一括カラーマッチング
+    results = run(args.source_dir, profile, args.output, args.method, args.mode,
+                  args.workers, args.ext, threads=args.threads, strength=args.strength, dtype=args.dtype,
+                  **options, **_ot_options(args))
+
+    failed = [r for r in results if r[2] is not None]
+    elapsed = time.perf_counter() - start
+    print(f"完了: {len(results) - len(failed)}枚 成功, {len(failed)}枚 失敗 ({elapsed:.2f}s)")
+    for path, _, error in failed:
+        print(f"  {path}: {error}")
+    return 1 if failed else 0
@@ -0,0 +1,445 @@
+"""
+ベンチマーク
+
+決定的に生成したテスト画像で、全ての手法・モードの match() と Lab 変換のバックエンドの
+処理時間・スループット・ピークメモリを計測して JSON に保存し、保存済みの結果(ベースライン)と比較する
+(ネットワークや画像ファイルは不要)
+複合法は一体化前の手順(処理段ごとの match_rgb() / match_lab_l())の処理時間も計測して比較する
+コマンドラインの起動時間(新しいインタプリタでの import の時間を含む)も計測する
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from PIL import Image
+from . import utils
+from . import METHODS, MODES, match, _MODULES, _stages
+
+# テスト画像の種類
+IMAGES = ("synthetic", "photo")
+
+# 結果の JSON の形式のバージョン (項目を変更した場合に上げる)
+FORMAT_VERSION = 1
+
+
+def _resize(x: np.ndarray, width: int, height: int) -> np.ndarray:
+    """float の (h, w, C) 配列をバイキュービックで拡大"""
+
+    return np.stack([
+        np.asarray(Image.fromarray(x[..., ch].astype(np.float32), mode="F").resize((width, height), Image.BICUBIC))
+        for ch in range(x.shape[-1])
+    ], axis=-1)
+
+
+def make_image(kind: str, megapixels: float, seed: int = 0, bits: int = 8) -> np.ndarray:
+    """
+    テスト画像(RGB, uint8 / uint16)を生成 (同じ引数からは常に同じ画像を生成する)
+
+    引数:
+        kind: 画像の種類
+            synthetic: グラデーションと単色の矩形 (ヒストグラムに偏りのある人工的な画像)
+            photo: 周波数が低いほど振幅の大きいノイズを重ねた写真に近い画像 (チャンネル間に相関あり)
+        megapixels: 画素数 [MP] (縦横比は 3:2)
+        seed: 乱数シード (入力画像と参照画像で変える)
+        bits: 階調 (8 / 16、16 は 8bit の画像の下位に乱数を加えて 65536 段階の値にする)
+    """
+
+    if kind not in IMAGES:
+        raise ValueError(f"不明な画像の種類: {kind}")
+    if bits not in (8, 16):
+        raise ValueError(f"bits は 8 / 16 で指定してください: {bits}")
+    rng = np.random.default_rng(seed)
+    height = max(2, int(round(np.sqrt(megapixels * 1e6 * 2 / 3))))
+    width = max(2, int(round(height * 3 / 2)))
+
+    if kind == "synthetic":
+        y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+        angle = rng.uniform(0, np.pi)
+        t = (x * np.cos(angle) + y * np.sin(angle)) / (width + height)
+        low, high = rng.uniform(0, 255, (2, 3))
+        img = low + (high - low) * t[..., None]
+        for _ in range(8):
+            x0, y0 = rng.integers(0, width), rng.integers(0, height)
+            img[y0:y0 + height // 4, x0:x0 + width // 4] = rng.uniform(0, 255, 3)
+        img += rng.normal(0, 4, img.shape)
+    else:
+        # オクターブごとに解像度を倍にしたノイズを 1/f の振幅で重ねる
+        img = np.zeros((height, width, 3), dtype=np.float32)
+        size = 4
+        amplitude = 1.0
+        while size < max(width, height) and amplitude > 1 / 64:
+            noise = rng.normal(0, 1, (max(2, size * height // width), size, 3))
+            img += amplitude * _resize(noise, width, height)
+            size *= 2
+            amplitude /= 2
+        # チャンネル間の相関と色かぶり、トーンカーブ
+        mix = np.eye(3) * 0.5 + 0.5 * rng.uniform(0.5, 1.0, (3, 3))
+        img = img @ mix.T.astype(np.float32)
+        img = 255.0 / (1.0 + np.exp(-1.5 * img / img.std() - rng.normal(0, 0.5, 3)))
+        img += rng.normal(0, 2, img.shape)
+    img = np.clip(img, 0, 255).astype(np.uint8)
+    if bits == 16:
+        img = np.minimum(img.astype(np.uint32) * 257 + rng.integers(0, 257, img.shape), 65535).astype(np.uint16)
+    return img
+
+
+def measure(func, repeat: int = 3) -> dict:
+    """
+    関数の処理時間とピークメモリを計測
+
+    処理時間は repeat 回計測した中央値と最小値、ピークメモリは別に1回実行して
+    tracemalloc で計測した実行中に増えたメモリの最大値 (NumPy の配列を含む)
+
+    戻り値:
+        {"seconds", "min_seconds", "peak_mb"}
+    """
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        base, _ = tracemalloc.get_traced_memory()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "seconds": statistics.median(times),
+        "min_seconds": min(times),
+        "peak_mb": (peak - base) / (1 << 20),
+    }
+
+
+# 子プロセスの終了時に import されていたトップレベルのパッケージ名を出力するスクリプト
+_PACKAGES_SCRIPT = "import sys; print(' '.join(sorted({m.split('.')[0] for m in sys.modules})))"
+
+
+def _run_python(code: str, args=()) -> tuple:
+    """
+    新しいインタプリタで -X importtime を指定して code を実行
+
+    戻り値:
+        (処理時間[s] (インタプリタの起動を含む), 入れ子でない import ごとの累積時間[s] の dict,
+         import されたトップレベルのパッケージ名の集合)
+    """
+
+    # 子プロセスでも color_match を import できる様にする
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+
+    cmd = [sys.executable, "-X", "importtime", "-c", f"{code}\n{_PACKAGES_SCRIPT}", *args]
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, capture_output=True, text=True, env=env, check=True)
+    seconds = time.perf_counter() - start
+
+    # "import time: 自身 [us] | 累積 [us] | 名前" (名前は入れ子の深さだけ字下げされる)
+    imports = {}
+    for line in proc.stderr.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and len(fields) == 3 and fields[1].strip().isdigit():
+            if not fields[2].startswith("  "):
+                imports[fields[2].strip()] = int(fields[1]) / 1e6
+    packages = set(proc.stdout.strip().splitlines()[-1].split())
+    return seconds, imports, packages
+
+
+def startup(modes=MODES, method: str = "mkl", repeat: int = 3) -> list:
+    """
+    パッケージの import とコマンドラインの起動時間を新しいインタプリタで計測
+
+    - startup/import: import color_match の時間 (-X importtime の累積時間)
+    - startup/cli/<mode>: 小さな画像(0.01MP)のコマンドラインの処理時間 (インタプリタの起動を含む)
+        import_seconds: その内の import の時間 (何も実行しないインタプリタとの差)
+        packages: 何も実行しないインタプリタに比べて追加で import された標準ライブラリ以外のパッケージ
+
+    戻り値:
+        計測結果のリスト (run() の results と同じ形式、ピークメモリは計測しない)
+    """
+
+    def _entry(name, times, **params):
+        return dict(name=name, megapixels=0.0, seconds=statistics.median(times), min_seconds=min(times),
+                    peak_mb=None, mp_per_s=None, **params)
+
+    stdlib = set(getattr(sys, "stdlib_module_names", ()))
+    _, base_imports, base_packages = _run_python("pass")
+    base_import_seconds = sum(base_imports.values())
+
+    results = [_entry("startup/import", [_run_python("import color_match")[1]["color_match"] for _ in range(repeat)])]
+    with tempfile.TemporaryDirectory() as tmp:
+        src, ref, out = (os.path.join(tmp, name) for name in ("src.png", "ref.png", "out.png"))
+        Image.fromarray(make_image("photo", 0.01, seed=1)).save(src)
+        Image.fromarray(make_image("photo", 0.01, seed=2)).save(ref)
+        for mode in modes:
+            code = "import sys; from color_match import main; main(sys.argv[1:])"
+            runs = [_run_python(code, [src, ref, "-o", out, "-m", method, "--mode", mode]) for _ in range(repeat)]
+            import_seconds = [sum(imports.values()) - base_import_seconds for _, imports, _ in runs]
+            packages = {p for p in runs[0][2] - base_packages
+                        if p not in stdlib and not p.startswith("_") and p != __package__}
+            results.append(_entry(f"startup/cli/{mode}", [r[0] for r in runs], method=method, mode=mode,
+                                  import_seconds=statistics.median(import_seconds), packages=sorted(packages)))
+    return results
+
+
+def staged(src: np.ndarray, ref: np.ndarray, method: str, mode: str) -> np.ndarray:
+    """
+    複合法を一体化前と同じ手順で実行 (一体化した match() との比較用)
+
+    処理段ごとに各手法の match_rgb() / match_lab_l() を呼び、処理段の間は uint8 の RGB で受け渡す
+    (lab モードは処理段ごとに入力画像・参照画像を Lab に変換する)
+    """
+
+    out = src
+    for name in _stages(method):
+        module = _MODULES[name]
+        out = module.match_rgb(out, ref) if mode == "rgb" else module.match_lab_l(out, ref)
+    return out
+
+
+def _result(name: str, pixels: int, stats: dict, **params) -> dict:
+    stats = dict(stats, mp_per_s=pixels / 1e6 / stats["seconds"] if stats["seconds"] > 0 else None)
+    return dict(name=name, megapixels=pixels / 1e6, **params, **stats)
+
+
+def run(sizes=(0.25, 1.0, 4.0), images=IMAGES, methods=METHODS, modes=MODES,
+        backends=None, repeat: int = 3, log=print, dtypes=("float64",), bits=(8,), workers=(1,),
+        startup_time: bool = True) -> dict:
+    """
+    ベンチマークを実行
+
+    引数:
+        sizes: テスト画像の画素数 [MP] のリスト
+        images: テスト画像の種類のリスト
+        backends: 計測する Lab 変換のバックエンド (None の場合は利用可能な全てのバックエンド)
+            match() は実行時に選択されているバックエンドで計測する
+        log: 計測結果を1件ずつ出力する関数 (None の場合は出力しない)
+        dtypes: match() の計測に使う型のリスト (float64 以外は項目名の末尾に型名を付ける)
+        bits: テスト画像の階調のリスト (8 / 16、16 は項目名の末尾に 16bit を付ける)
+        workers: match() の計測に使うスレッド数のリスト (1 以外は項目名の末尾に w と数を付ける、scaling() を参照)
+        startup_time: パッケージの import とコマンドラインの起動時間を計測するか (startup() を参照)
+
+    戻り値:
+        JSON に保存できる計測結果
+    """
+
+    # バックエンドの自動選択の計測を計測対象に含めない
+    backend = utils.get_backend()
+    if backends is None:
+        backends = utils.available_backends()
+
+    results = []
+
+    def _add(result):
+        results.append(result)
+        if log is not None:
+            log(_format_row(result))
+
+    if startup_time:
+        for result in startup(modes, repeat=repeat):
+            _add(result)
+
+    for kind in images:
+        for mp in sizes:
+            for depth in bits:
+                src = make_image(kind, mp, seed=1, bits=depth)
+                ref = make_image(kind, mp, seed=2, bits=depth)
+                pixels = src.shape[0] * src.shape[1]
+                label = f"{kind}/{mp:g}MP" + ("" if depth == 8 else f"/{depth}bit")
+
+                for dtype in dtypes:
+                    for n in workers:
+                        suffix = ("" if dtype == "float64" else f"/{dtype}") + ("" if n == 1 else f"/w{n}")
+                        for method in methods:
+                            for mode in modes:
+                                stats = measure(lambda: match(src, ref, method, mode, dtype=dtype, workers=n), repeat)
+                                _add(_result(f"match/{method}/{mode}/{label}{suffix}", pixels, stats, method=method,
+                                             mode=mode, image=kind, dtype=dtype, bits=depth, workers=n))
+
+                # 複合法の一体化前の手順 (処理段ごとの match_rgb() / match_lab_l()、8bit の画像のみ、fusion() を参照)
+                if depth == 8:
+                    for method in methods:
+                        if len(_stages(method)) < 2:
+                            continue
+                        for mode in modes:
+                            stats = measure(lambda: staged(src, ref, method, mode), repeat)
+                            _add(_result(f"staged/{method}/{mode}/{label}", pixels, stats, method=method,
+                                         mode=mode, image=kind, bits=depth))
+
+                # Lab 変換のバックエンドごとの RGB -> Lab / Lab -> RGB (16bit の画像は丸めずに float で戻す)
+                out_dtype = np.uint8 if depth == 8 else np.float64
+                try:
+                    for name in backends:
+                        utils.set_backend(name)
+                        lab = utils.rgb2lab(src)
+                        for direction, func in (("rgb2lab", lambda: utils.rgb2lab(src)),
+                                                ("lab2rgb", lambda: utils.lab2rgb(lab, out_dtype))):
+                            stats = measure(func, repeat)
+                            _add(_result(f"lab/{name}/{direction}/{label}", pixels, stats,
+                                         backend=name, image=kind, bits=depth))
+                finally:
+                    utils.set_backend(backend)
+
+    return {
+        "format": FORMAT_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "backend": backend,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float = 0.15) -> list:
+    """
+    計測結果をベースラインと比較
+
+    引数:
+        threshold: 処理時間がこの割合より増えた項目を悪化とする
+            (他の処理の影響を受けにくい最小値で比較する)
+
+    戻り値:
+        両方にある項目ごとの (名前, ベースラインの処理時間, 処理時間, 変化率, 悪化したか) のリスト
+    """
+
+    base = {r["name"]: r for r in baseline["results"]}
+    rows = []
+    for r in current["results"]:
+        b = base.get(r["name"])
+        if b is None:
+            continue
+        change = r["min_seconds"] / b["min_seconds"] - 1.0 if b["min_seconds"] > 0 else 0.0
+        rows.append((r["name"], b["min_seconds"], r["min_seconds"], change, change > threshold))
+    return rows
+
+
+def scaling(current: dict) -> list:
+    """
+    match() のスレッド数ごとの処理時間を、同じ条件の1スレッドの処理時間と比較
+
+    戻り値:
+        1スレッド以外の項目ごとの (名前, スレッド数, 速度向上率(1スレッドの処理時間 / 処理時間), 並列化効率(速度向上率 / スレッド数))
+        のリスト (処理時間は最小値で比較する)
+    """
+
+    keys = ("method", "mode", "image", "megapixels", "dtype", "bits")
+    single = {
+        tuple(r.get(k) for k in keys): r for r in current["results"]
+        if r["name"].startswith("match/") and r.get("workers", 1) == 1
+    }
+    rows = []
+    for r in current["results"]:
+        n = r.get("workers", 1)
+        base = single.get(tuple(r.get(k) for k in keys))
+        if not r["name"].startswith("match/") or n == 1 or base is None or r["min_seconds"] <= 0:
+            continue
+        speedup = base["min_seconds"] / r["min_seconds"]
+        rows.append((r["name"], n, speedup, speedup / n))
+    return rows
+
+
+def fusion(current: dict) -> list:
+    """
+    複合法の一体化した match() の処理時間を、同じ条件の一体化前の手順 (staged()) の処理時間と比較
+
+    戻り値:
+        両方を計測した項目ごとの (名前, 一体化前の処理時間, 処理時間, 速度向上率(一体化前の処理時間 / 処理時間)) のリスト
+        (処理時間は最小値で比較し、match() は float64・1スレッドの項目と比較する)
+    """
+
+    results = {r["name"]: r for r in current["results"]}
+    rows = []
+    for r in current["results"]:
+        if not r["name"].startswith("staged/"):
+            continue
+        fused = results.get("match/" + r["name"][len("staged/"):])
+        if fused is None or fused["min_seconds"] <= 0:
+            continue
+        rows.append((fused["name"], r["min_seconds"], fused["min_seconds"], r["min_seconds"] / fused["min_seconds"]))
+    return rows
+
+
+def _format_row(r: dict) -> str:
+    mp_per_s = f"{r['mp_per_s']:9.2f}" if r["mp_per_s"] is not None else f"{'-':>9}"
+    peak_mb = f"{r['peak_mb']:9.1f}" if r["peak_mb"] is not None else f"{'-':>9}"
+    row = f"{r['name']:<40} {r['seconds']:9.4f}s {mp_per_s} MP/s {peak_mb} MB"
+    if "packages" in r:
+        row += f"  (import {r['import_seconds']:.4f}s: {', '.join(r['packages'])})"
+    return row
+
+
+def main(argv=None) -> int:
+    """bench サブコマンドのエントリポイント"""
+
+    # 引数解析
+    p = argparse.ArgumentParser(prog="color-match bench", description="Color Matching (ベンチマーク)")
+    p.add_argument("-o", "--output", default="./benchmark.json", help="計測結果を保存するパス(.json)")
+    p.add_argument("--baseline", help="比較するベースラインの計測結果(.json)")
+    p.add_argument("--sizes", type=float, nargs="+", default=[0.25, 1.0, 4.0], help="テスト画像の画素数[MP]")
+    p.add_argument("--images", choices=IMAGES, nargs="+", default=list(IMAGES), help="テスト画像の種類")
+    p.add_argument("-m", "--methods", choices=METHODS, nargs="+", default=list(METHODS))
+    p.add_argument("--modes", choices=MODES, nargs="+", default=list(MODES))
+    p.add_argument("--dtypes", choices=("float64", "float32"), nargs="+", default=["float64"], help="match() の計測に使う型")
+    p.add_argument("--bits", type=int, choices=(8, 16), nargs="+", default=[8], help="テスト画像の階調")
+    p.add_argument(
+        "--workers", type=int, nargs="+", default=[1],
+        help="match() の計測に使うスレッド数 (1 と複数の値を指定すると1スレッドに対する速度向上率を表示)",
+    )
+    p.add_argument(
+        "--backend", choices=utils.BACKENDS, default="auto",
+        help="match() の計測に使う RGB <-> Lab 変換のバックエンド (Lab 変換は利用可能な全てのバックエンドを計測)",
+    )
+    p.add_argument("--no-startup", action="store_true", help="import とコマンドラインの起動時間を計測しない")
+    p.add_argument("--repeat", type=int, default=3, help="計測の繰り返し回数(中央値と最小値を記録)")
+    p.add_argument("--threshold", type=float, default=0.15, help="ベースラインから処理時間がこの割合より増えた場合に悪化とする")
+    args = p.parse_args(argv)
+
+    utils.set_backend(args.backend)
+    print(f"{'name':<40} {'time':>10} {'MP/s':>14} {'peak':>12}")
+    result = run(args.sizes, args.images, args.methods, args.modes, repeat=args.repeat, dtypes=args.dtypes,
+                 bits=args.bits, workers=args.workers, startup_time=not args.no_startup)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(f"保存しました: {args.output}")
+
+    rows = scaling(result)
+    if rows:
+        print(f"\nスレッド数ごとの速度向上率 (CPU コア数 {os.cpu_count()})")
+        print(f"{'name':<40} {'workers':>8} {'speedup':>8} {'efficiency':>10}")
+        for name, n, speedup, efficiency in rows:
+            print(f"{name:<40} {n:8d} {speedup:7.2f}x {efficiency:10.0%}")
+
+    rows = fusion(result)
+    if rows:
+        print("\n複合法の一体化前の手順(処理段ごとの match_rgb() / match_lab_l())との比較")
+        print(f"{'name':<40} {'staged':>10} {'fused':>10} {'speedup':>8}")
+        for name, staged_s, fused_s, speedup in rows:
+            print(f"{name:<40} {staged_s:9.4f}s {fused_s:9.4f}s {speedup:7.2f}x")
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    rows = compare(result, baseline, args.threshold)
+    print(f"\nベースライン({args.baseline})との比較")
+    print(f"{'name':<40} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, base_s, cur_s, change, worse in rows:
+        mark = " 悪化" if worse else ""
+        print(f"{name:<40} {base_s:9.4f}s {cur_s:9.4f}s {change:+8.1%}{mark}")
+    regressions = sum(row[4] for row in rows)
+    print(f"比較 {len(rows)}件, 悪化 {regressions}件 (閾値 {args.threshold:+.0%})")
+    return 1 if regressions else 0
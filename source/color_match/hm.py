@@ -5,50 +5,204 @@
 import numpy as np
 from . import utils
 
+# 256段階より細かいビンの量子化・集計・LUTの参照を行う画素数 (中間配列をキャッシュに収める為)
+_CHUNK_PIXELS = 1 << 16
+
+# 256段階に切り捨てる前に足す値
+# (Lab変換のバックエンドごとの丸め誤差(1e-13 程度)で、整数になるはずの値(白の L=255 等)が
+#  バックエンドによって1つ下のビンに入らない様にする、uint8 の画像の値と float の計算の誤差より十分小さい)
+_QUANTIZE_EPS = 1e-9
+
+
+def _quantize(x: np.ndarray, bins: int = 256) -> np.ndarray:
+    """
+    0-255 のスケールの値を bins 段階のビンの番号に量子化
+
+    256段階は 0-255 の uint8 に切り捨て (_QUANTIZE_EPS を足してから切り捨てる)、それ以上(16bit / float の画像の 65536 段階等)は
+    最も近いビンに丸めた uint16 にする (画素ごとの並べ替えは行わず、ビンの番号を直接求める)
+    """
+
+    if bins == 256:
+        if x.dtype == np.uint8:
+            return x
+        q = x + _QUANTIZE_EPS
+        np.clip(q, 0, 255, out=q)
+        return q.astype(np.uint8)
+    # 0.5 を足して切り捨てることで丸める (作業用の配列は1つ)
+    q = x * ((bins - 1) / 255.0)
+    q += 0.5
+    np.clip(q, 0, bins - 1, out=q)
+    return q.astype(np.uint16)
+
+
+def _values(bins: int) -> np.ndarray:
+    """ビンごとの値 (0-255 のスケール)"""
+
+    return np.linspace(0.0, 255.0, bins)
+
+
+def fit(x: np.ndarray, bins: int = 256) -> dict:
+    """
+    (..., C) の画素からチャンネルごとのヒストグラムを計算
+
+    引数:
+        bins: ビン数 (8bit の画像は 256、16bit / float の画像は 65536、最大 65536)
+            0-255 のスケールの値を等間隔に分割し、np.bincount で数える
+
+    戻り値:
+        {"hist": (C, bins)}
+    """
+
+    if not 2 <= bins <= 65536:
+        raise ValueError(f"bins は 2-65536 で指定してください: {bins}")
+    if bins == 256:
+        q = _quantize(x)
+        hist = np.stack([
+            np.bincount(q[..., ch].ravel(), minlength=256)
+            for ch in range(q.shape[-1])
+        ]).astype(np.float64)
+        return {"hist": hist}
+
+    # チャンク単位で量子化し、チャンネルごとにビンの番号をずらして1度に数える
+    c = x.shape[-1]
+    v = x.reshape(-1, c)
+    offset = np.arange(c) * bins
+    counts = np.zeros(c * bins, dtype=np.int64)
+    for i in range(0, v.shape[0], _CHUNK_PIXELS):
+        q = _quantize(v[i:i + _CHUNK_PIXELS], bins).astype(np.intp)
+        q += offset
+        counts += np.bincount(q.ravel(), minlength=c * bins)
+    return {"hist": counts.reshape(c, bins).astype(np.float64)}
+
+
+def merge(a: dict, b: dict) -> dict:
+    """分割して計算したヒストグラムを統合"""
+
+    return {"hist": a["hist"] + b["hist"]}
+
+
+def _cdf(hist: np.ndarray) -> np.ndarray:
+    """ヒストグラムから正規化した累積分布関数(CDF)を計算"""
+
+    cdf = np.cumsum(hist, axis=-1)
+    return cdf / cdf[..., -1:]
+
+
+def distance(a: dict, b: dict) -> float:
+    """2つのヒストグラムのCDFの最大差(コルモゴロフ-スミルノフ距離)"""
+
+    return float(np.max(np.abs(_cdf(a["hist"]) - _cdf(b["hist"]))))
+
+
+def transform(src_stats: dict, ref_stats: dict) -> dict:
+    """
+    入力画像と参照画像のヒストグラムからチャンネルごとのLUTを求める
+
+    入力画像と参照画像のビン数は異なっていてもよい (8bit の参照画像と 16bit の入力画像等)
+
+    入力画像と参照画像がともに256段階の場合、LUTの値は整数に切り捨てる
+
+    戻り値:
+        {"lut": (C, 入力画像のビン数)}
+    """
+
+    luts = []
+    ref_values = _values(ref_stats["hist"].shape[-1])
+    for src_hist, ref_hist in zip(src_stats["hist"], ref_stats["hist"]):
+        # CDF(累積分布関数) == 累積ヒストグラム を計算
+        src_cdf = _cdf(src_hist)
+        ref_cdf = _cdf(ref_hist)
+
+        # ヒストグラムマッチングのLUTを作成
+        luts.append(np.interp(src_cdf, ref_cdf, ref_values))
+    lut = np.stack(luts)
+    if lut.shape[-1] == 256 and ref_values.shape[0] == 256:
+        # 8bit 同士の LUT は従来通り整数に切り捨てる (uint8 の LUT と同じ値、出力が従来と一致する)
+        np.floor(lut, out=lut)
+    return {"lut": lut}
+
+
+def apply(x: np.ndarray, t: dict) -> np.ndarray:
+    """
+    (..., C) の画素にLUTを適用
+
+    入力は fit() と同じ(LUTの長さの)ビンで参照し、出力はLUTの値を量子化せずにLUTと同じ型の float で返す
+    (複合法の途中結果を uint8 に丸めない為)
+    """
+
+    lut = t["lut"]
+    bins = lut.shape[-1]
+    if bins == 256:
+        q = _quantize(x)
+        out = np.empty(q.shape, dtype=lut.dtype)
+        for ch in range(q.shape[-1]):
+            out[..., ch] = lut[ch][q[..., ch]]
+        return out
+
+    # 細かいビンはチャンク単位で量子化して参照する
+    c = x.shape[-1]
+    v = x.reshape(-1, c)
+    out = np.empty(v.shape, dtype=lut.dtype)
+    for i in range(0, v.shape[0], _CHUNK_PIXELS):
+        q = _quantize(v[i:i + _CHUNK_PIXELS], bins)
+        for ch in range(c):
+            out[i:i + _CHUNK_PIXELS, ch] = lut[ch][q[:, ch]]
+    return out.reshape(x.shape)
+
+
+def interpolate(t: dict, strength: float) -> dict:
+    """LUTを恒等変換と strength(0-1) で補間 (適用の計算量は変わらない)"""
+
+    return {"lut": (1.0 - strength) * _values(t["lut"].shape[-1]) + strength * t["lut"]}
+
+
+def fit_rgb(img: np.ndarray) -> dict:
+    """RGB色空間のヒストグラムを計算"""
+
+    return fit(img)
+
+
+def fit_lab_l(img: np.ndarray) -> dict:
+    """LAB色空間のLチャネルのヒストグラムを計算"""
+
+    return fit(utils.rgb2lab(img)[..., :1])
+
+
 def match_channel(src_chan: np.ndarray, ref_chan: np.ndarray) -> np.ndarray:
     """単一チャンネルのヒストグラムマッチング"""
 
-    # チャンネルデータを1次元配列に変換
-    src = src_chan.ravel()
-    ref = ref_chan.ravel()
+    t = transform(fit(src_chan[..., None]), fit(ref_chan[..., None]))
+    return _quantize(apply(src_chan[..., None], t)[..., 0])
 
-    # 256段階のヒストグラムを計算
-    src_hist = np.bincount(src, minlength=256).astype(np.float64)
-    ref_hist = np.bincount(ref, minlength=256).astype(np.float64)
 
-    # CDF(累積分布関数) == 累積ヒストグラム を計算
-    src_cdf = np.cumsum(src_hist)   # 累積和を計算
-    src_cdf /= src_cdf[-1]          # 正規化
-    ref_cdf = np.cumsum(ref_hist)
-    ref_cdf /= ref_cdf[-1]
+def match_rgb(src: np.ndarray, ref) -> np.ndarray:
+    """
+    RGB色空間でヒストグラムマッチング
 
-    # ヒストグラムマッチングを適応
-    lut = np.interp(src_cdf, ref_cdf, np.arange(256)).astype(np.uint8)
-    return lut[src_chan]
+    引数:
+        ref: 参照画像、もしくは fit_rgb() で求めた参照画像の統計量
+    """
 
+    ref_stats = ref if isinstance(ref, dict) else fit_rgb(ref)
+    return _quantize(apply(src, transform(fit(src), ref_stats)))
 
-def match_rgb(src: np.ndarray, ref: np.ndarray) -> np.ndarray:
-    """RGB色空間でヒストグラムマッチング"""
 
-    out = np.empty_like(src)
-    for ch in range(src.shape[2]):
-        out[..., ch] = match_channel(src[..., ch], ref[..., ch])
-    return out
+def match_lab_l(src: np.ndarray, ref) -> np.ndarray:
+    """
+    LAB色空間でLチャネルのみヒストグラムマッチング
 
+    引数:
+        ref: 参照画像、もしくは fit_lab_l() で求めた参照画像の統計量
+    """
 
-def match_lab_l(src: np.ndarray, ref: np.ndarray) -> np.ndarray:
-    """LAB色空間でLチャネルのみヒストグラムマッチング"""
+    ref_stats = ref if isinstance(ref, dict) else fit_lab_l(ref)
 
     # RGB -> Lab(0-255)
     src_lab = utils.rgb2lab(src)
-    ref_lab = utils.rgb2lab(ref)
-    
-    # L: 0-255
-    src_L = src_lab[..., 0].astype(np.uint8)
-    ref_L = ref_lab[..., 0].astype(np.uint8)
-    
-    # ヒストグラムマッチング
-    src_lab[..., 0] = match_channel(src_L, ref_L).astype(np.float64)
-    
+
+    # L: 0-255 をヒストグラムマッチング
+    src_L = src_lab[..., :1]
+    src_lab[..., :1] = apply(src_L, transform(fit(src_L), ref_stats))
+
     # Lab -> RGB
     return utils.lab2rgb(src_lab)
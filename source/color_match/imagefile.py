@@ -0,0 +1,337 @@
+"""
+画像ファイルの読み書き (8bit / 16bit / float)
+
+PIL は 16bit の RGB の PNG / TIFF を 8bit に切り捨てて読み込み、float の TIFF や EXR / HDR は開けない為、
+これらは OpenCV (opencv-python) もしくは tifffile がインストールされていれば、それらで読み書きする
+8bit の画像は従来通り PIL で読み書きする
+
+画像は (H, W, 3) の uint8 / uint16 / float32 / float64 の配列で扱う
+(float は 0-1 を基準とし、HDR では 1 を超える値を含む)
+ファイルの代わりにバイト列で読み書きする場合は decode() / encode() を使う
+複数フレームのファイル(アニメーションGIF・マルチページTIFF)は read_frames() / write_frames() を使う
+"""
+
+import io
+import os
+import warnings
+import numpy as np
+from PIL import Image, ImageSequence, UnidentifiedImageError
+from . import utils
+
+# 階調を保って保存できる拡張子
+_UINT16_EXTENSIONS = (".png", ".tif", ".tiff")
+_FLOAT_EXTENSIONS = (".tif", ".tiff", ".exr", ".hdr")
+
+# PIL が 16bit / 32bit のまま読み込めるグレースケールのモード
+_GRAY_HIGH_DEPTH_MODES = ("I;16", "I;16L", "I;16B", "I", "F")
+
+# バイト列の形式の判別に使う先頭のバイト列
+_NPY_MAGIC = b"\x93NUMPY"
+_TIFF_MAGIC = (b"II*\x00", b"MM\x00*")
+
+
+def _cv2():
+    """OpenCV (インストールされていない場合は None)"""
+
+    # OpenCV の EXR の読み書きは環境変数で有効にする必要がある
+    os.environ.setdefault("OPENCV_IO_ENABLE_OPENEXR", "1")
+    try:
+        import cv2
+    except ImportError:
+        return None
+    return cv2
+
+
+def _tifffile():
+    """tifffile (インストールされていない場合は None)"""
+
+    try:
+        import tifffile
+    except ImportError:
+        return None
+    return tifffile
+
+
+def _ext(path) -> str:
+    return os.path.splitext(str(path))[1].lower()
+
+
+def _is_high_depth(im: Image.Image) -> bool:
+    """PIL で開いた画像が 8bit より大きい階調を持つか"""
+
+    if im.mode in _GRAY_HIGH_DEPTH_MODES:
+        return True
+    # 16bit の RGB の PNG / TIFF はモードが RGB になる為、デコーダの rawmode ("RGB;16B" 等) で判定する
+    for tile in getattr(im, "tile", None) or ():
+        args = tile[3]
+        rawmode = args[0] if isinstance(args, tuple) and args else args
+        if isinstance(rawmode, str) and (";16" in rawmode or ";32" in rawmode):
+            return True
+    return False
+
+
+def _to_rgb(img: np.ndarray, bgr: bool) -> np.ndarray:
+    """読み込んだ配列を (H, W, 3) のRGB画像に揃える (グレースケールは複製し、アルファチャンネルは捨てる)"""
+
+    if img.ndim == 2:
+        img = img[..., None]
+    if img.shape[-1] < 3:
+        img = np.repeat(img[..., :1], 3, axis=-1)
+    else:
+        img = img[..., 2::-1] if bgr else img[..., :3]
+    if img.dtype == np.int32:
+        # PIL の 32bit 整数のグレースケール (I モード) は 16bit として扱う
+        img = np.clip(img, 0, 65535).astype(np.uint16)
+    elif img.dtype == np.float16:
+        img = img.astype(np.float32)
+    return np.ascontiguousarray(img)
+
+
+def _read_high_depth(source, ext: str, name: str):
+    """
+    16bit / float の画像をファイルパスもしくは io.BytesIO から読み込み
+
+    OpenCV / tifffile が無い(その形式を読み込めるものが無い)場合は None を返し、
+    あるのに読み込めない場合(壊れたファイル等)は ValueError
+    """
+
+    cv2 = _cv2()
+    tifffile = _tifffile()
+    use_tifffile = tifffile is not None and ext in (".tif", ".tiff")
+    if cv2 is None and not use_tifffile:
+        return None
+    if cv2 is not None:
+        # cv2.imread() は Windows で日本語のパスを開けない為、バイト列からデコードする
+        if isinstance(source, io.BytesIO):
+            buf = np.frombuffer(source.getbuffer(), dtype=np.uint8)
+        else:
+            buf = np.fromfile(source, dtype=np.uint8)
+        img = cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)
+        if img is not None:
+            return _to_rgb(img, bgr=True)
+    if not use_tifffile:
+        # OpenCV の imdecode() は失敗の理由を返さない
+        raise ValueError(f"画像を読み込めません (ファイルが壊れているか、対応していない形式です): {name}")
+    if isinstance(source, io.BytesIO):
+        source.seek(0)
+    try:
+        img = tifffile.imread(source)
+    except Exception as e:
+        raise ValueError(f"画像を読み込めません (ファイルが壊れているか、対応していない形式です): {name}: {e}") from e
+    if img.ndim == 3 and img.shape[0] in (3, 4) and img.shape[-1] not in (3, 4):
+        # チャンネルごとに分かれた (C, H, W) の TIFF
+        img = np.moveaxis(img, 0, -1)
+    return _to_rgb(img, bgr=False)
+
+
+def read(path, mmap: bool = False) -> np.ndarray:
+    """
+    画像ファイルをRGB画像として読み込み
+
+    8bit の画像は uint8、16bit の PNG / TIFF は uint16、float の TIFF / EXR / HDR は float32 の配列を返す
+    16bit / float の RGB の読み込みには OpenCV もしくは tifffile(TIFF のみ) が必要で、
+    どちらも無い場合は警告を出して PIL で 8bit に変換して読み込む
+    壊れたファイル等で読み込めない場合は、パスと元の例外のメッセージを付けた ValueError
+
+    引数:
+        mmap: .npy ファイルをメモリマップで開くか (必要な部分のみ読み込まれる)
+    """
+
+    ext = _ext(path)
+    if ext == ".npy":
+        img = np.load(path, mmap_mode="r" if mmap else None)
+        utils.check_image(img, str(path))
+        return img
+    return _decode(path, ext, str(path))
+
+
+def decode(data: bytes, ext: str = "") -> np.ndarray:
+    """
+    画像ファイルの内容(バイト列)をRGB画像として読み込み (read() と同じ)
+
+    引数:
+        ext: 元のファイルの拡張子 (.npy / TIFF / PIL が判別できる形式は省略可)
+    """
+
+    ext = ext.lower()
+    if ext == ".npy" or data[:len(_NPY_MAGIC)] == _NPY_MAGIC:
+        img = np.load(io.BytesIO(data))
+        utils.check_image(img, "<bytes>")
+        return img
+    if not ext and data[:4] in _TIFF_MAGIC:
+        ext = ".tif"
+    return _decode(io.BytesIO(data), ext, "<bytes>")
+
+
+def _decode(source, ext: str, name: str) -> np.ndarray:
+    """ファイルパスもしくは io.BytesIO の画像を読み込み"""
+
+    try:
+        im = Image.open(source)
+    except UnidentifiedImageError:
+        im = None
+    if im is None:
+        # PIL が開けない float の TIFF / EXR / HDR 等 (OpenCV / tifffile があれば、読み込めない場合の理由はそちらで判定する)
+        img = _read_high_depth(source, ext, name)
+        if img is None:
+            raise ValueError(
+                f"画像を読み込めません (ファイルが壊れているか、16bit / float の画像の場合は opencv-python か tifffile が必要です): {name}"
+            )
+        utils.check_image(img, name)
+        return img
+
+    with im:
+        if not _is_high_depth(im):
+            return np.array(_load(im, name).convert("RGB"))
+        if im.mode in _GRAY_HIGH_DEPTH_MODES:
+            return _to_rgb(np.array(_load(im, name)), bgr=False)
+        img = _read_high_depth(source, ext, name)
+        if img is None:
+            warnings.warn(f"16bit の画像を 8bit に変換して読み込みます (opencv-python か tifffile が必要です): {name}")
+            return np.array(_load(im, name).convert("RGB"))
+    utils.check_image(img, name)
+    return img
+
+
+def _load(im: Image.Image, name: str) -> Image.Image:
+    """PIL で開いた画像の画素を読み込み (途中で切れたファイル等のデコードの失敗は、パスを付けた ValueError にする)"""
+
+    try:
+        im.load()
+    except (OSError, ValueError, SyntaxError) as e:
+        raise ValueError(f"画像を読み込めません (ファイルが壊れています): {name}: {e}") from e
+    return im
+
+
+def read_frames(path):
+    """
+    アニメーションGIF・マルチページTIFFのフレームを順にRGB画像として読み込み
+
+    16bit / float のマルチページTIFFは tifffile がインストールされていれば階調を保って読み込み、
+    無い場合は警告を出して PIL で 8bit に変換して読み込む
+
+    戻り値:
+        RGB画像を列挙するイテレータ
+    """
+
+    name = str(path)
+    with Image.open(path) as im:
+        tifffile = _tifffile()
+        if _ext(path) in (".tif", ".tiff") and _is_high_depth(im):
+            if tifffile is not None:
+                with tifffile.TiffFile(path) as tif:
+                    for page in tif.pages:
+                        img = _to_rgb(page.asarray(), bgr=False)
+                        utils.check_image(img, name)
+                        yield img
+                return
+            warnings.warn(f"16bit / float の画像を 8bit に変換して読み込みます (tifffile が必要です): {name}")
+        for frame in ImageSequence.Iterator(im):
+            yield np.array(_load(frame, name).convert("RGB"))
+
+
+def write_frames(frames: list, path, **info) -> None:
+    """
+    RGB画像のリストをアニメーションGIF・マルチページTIFFとして保存
+
+    16bit / float の画像は .tif であれば tifffile で階調を保って保存し、
+    それ以外(GIF、もしくは tifffile が無い場合)は 8bit に変換して保存する
+
+    引数:
+        info: PIL の保存のオプション (GIF のフレーム間隔 duration・ループ回数 loop 等)
+    """
+
+    name = str(path)
+    ext = _ext(path)
+    if any(frame.dtype != np.uint8 for frame in frames):
+        tifffile = _tifffile()
+        if ext in (".tif", ".tiff") and tifffile is not None:
+            with tifffile.TiffWriter(path) as tif:
+                for frame in frames:
+                    tif.write(frame.astype(np.float32) if frame.dtype == np.float64 else frame, photometric="rgb")
+            return
+        if ext != ".gif":
+            warnings.warn(f"16bit / float の画像を 8bit に変換して保存します (tifffile が必要です): {name}")
+        frames = [to_uint8(frame) for frame in frames]
+    images = [Image.fromarray(frame) for frame in frames]
+    images[0].save(path, save_all=True, append_images=images[1:], **info)
+
+
+def to_uint8(img: np.ndarray) -> np.ndarray:
+    """16bit / float の画像を 8bit に変換 (最も近い値に丸め、float は 0-1 にクリップする)"""
+
+    if img.dtype == np.uint8:
+        return img
+    x = utils.to_float(img)
+    np.clip(x, 0, 255, out=x)
+    np.rint(x, out=x)
+    return x.astype(np.uint8)
+
+
+def _write_high_depth(img: np.ndarray, target, ext: str) -> bool:
+    """16bit / float の画像をファイルパスもしくは io.BytesIO に保存 (OpenCV / tifffile が無い、もしくは保存できない場合は False)"""
+
+    cv2 = _cv2()
+    if cv2 is not None:
+        try:
+            ok, buf = cv2.imencode(ext, np.ascontiguousarray(img[..., ::-1]))
+        except cv2.error:
+            ok = False
+        if ok:
+            if isinstance(target, io.BytesIO):
+                target.write(buf.tobytes())
+            else:
+                buf.tofile(target)
+            return True
+    tifffile = _tifffile()
+    if tifffile is not None and ext in (".tif", ".tiff"):
+        tifffile.imwrite(target, img, photometric="rgb")
+        return True
+    return False
+
+
+def write(img: np.ndarray, path) -> None:
+    """
+    RGB画像を画像ファイルに保存
+
+    uint8 は PIL で保存する
+    16bit は .png / .tif、float は .tif / .exr / .hdr (float32) であれば階調を保って保存し
+    (OpenCV もしくは tifffile(TIFF のみ) が必要)、それ以外の形式は 8bit に変換して保存する
+    .npy は型を変えずに保存する
+    """
+
+    _encode(img, path, _ext(path), str(path))
+
+
+def encode(img: np.ndarray, ext: str = ".png") -> bytes:
+    """RGB画像を ext の形式の画像ファイルの内容(バイト列)に変換 (write() と同じ)"""
+
+    buf = io.BytesIO()
+    _encode(img, buf, ext.lower(), "<bytes>")
+    return buf.getvalue()
+
+
+def _encode(img: np.ndarray, target, ext: str, name: str) -> None:
+    """RGB画像をファイルパスもしくは io.BytesIO に保存"""
+
+    if ext == ".npy":
+        np.save(target, img)
+        return
+    if img.dtype != np.uint8:
+        extensions = _UINT16_EXTENSIONS if img.dtype == np.uint16 else _FLOAT_EXTENSIONS
+        if ext in extensions:
+            if img.dtype == np.float64:
+                img = img.astype(np.float32)
+            if _write_high_depth(img, target, ext):
+                return
+            if ext in (".exr", ".hdr"):
+                raise ValueError(f"{ext} の保存には {ext[1:].upper()} に対応した opencv-python が必要です: {name}")
+            warnings.warn(f"16bit / float の画像を 8bit に変換して保存します (opencv-python か tifffile が必要です): {name}")
+        img = to_uint8(img)
+    if isinstance(target, io.BytesIO):
+        fmt = Image.registered_extensions().get(ext)
+        if fmt is None:
+            raise ValueError(f"不明な画像の形式: {ext}")
+        Image.fromarray(img).save(target, format=fmt)
+    else:
+        Image.fromarray(img).save(target)
@@ -0,0 +1,177 @@
+"""
+処理段ごとの処理時間・メモリの計測
+
+match() や コマンドラインの処理は、画像の読み込み・Lab変換・統計量の計算・色変換の適用等の処理段を
+stage() で囲んでいる
+add_hook() でコールバックを登録すると、処理段が終わるたびに計測結果が渡される
+(コールバックが無い場合は計測を行わない)
+
+使用例:
+    with instrument.Recorder(memory=True) as rec:
+        color_match.match(src_img, ref_img, 'mkl', 'lab')
+    print(rec.table())
+    json.dump(rec.to_json(), f)
+"""
+
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# 登録されたコールバック (処理段ごとの計測結果の dict を受け取る)
+_hooks = []
+_hooks_lock = threading.Lock()
+
+# スレッドごとの実行中の処理段 ([開始時のメモリ, 実行中のメモリの最大値] のスタック)
+_local = threading.local()
+
+
+def add_hook(callback) -> None:
+    """
+    計測結果を受け取るコールバックを登録
+
+    コールバックには処理段が終わるたびに以下の dict が渡される (処理を実行したスレッドから呼ばれる)
+        stage: 処理段の名前 (decode / rgb2lab / stats:hm / transform:mkl / eigh / apply:hm / lab2rgb / encode 等)
+        start: 開始時刻 (time.perf_counter())
+        seconds: 処理時間 [s]
+        peak_mb: 処理段の実行中に増えたメモリの最大値 [MB]
+            (tracemalloc で計測中の場合のみ、それ以外は None)
+        thread: 実行したスレッドの名前
+    """
+
+    with _hooks_lock:
+        _hooks.append(callback)
+
+
+def remove_hook(callback) -> None:
+    """add_hook() で登録したコールバックを削除"""
+
+    with _hooks_lock:
+        _hooks.remove(callback)
+
+
+def _frames() -> list:
+    frames = getattr(_local, "frames", None)
+    if frames is None:
+        frames = _local.frames = []
+    return frames
+
+
+@contextmanager
+def stage(name: str):
+    """
+    処理段を計測する with 文
+
+    入れ子にした場合、外側の処理段の時間・メモリは内側の処理段を含む
+    メモリは tracemalloc で計測中 (Recorder(memory=True) 等) かつ Python 3.9 以降の場合のみ計測する
+    """
+
+    if not _hooks:
+        yield
+        return
+
+    tracing = tracemalloc.is_tracing() and hasattr(tracemalloc, "reset_peak")
+    frames = _frames()
+    if tracing:
+        # 外側の処理段のここまでの最大値を退避してから計測し直す
+        current, peak = tracemalloc.get_traced_memory()
+        if frames:
+            frames[-1][1] = max(frames[-1][1], peak)
+        tracemalloc.reset_peak()
+        frames.append([current, current])
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        peak_mb = None
+        if tracing:
+            frame = frames.pop()
+            peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+            peak_mb = (peak - frame[0]) / (1 << 20)
+            if frames:
+                frames[-1][1] = max(frames[-1][1], peak)
+            tracemalloc.reset_peak()
+        record = {
+            "stage": name,
+            "start": start,
+            "seconds": seconds,
+            "peak_mb": peak_mb,
+            "thread": threading.current_thread().name,
+        }
+        for callback in list(_hooks):
+            callback(record)
+
+
+class Recorder:
+    """
+    with 文の間の計測結果を記録するコールバック
+
+    引数:
+        memory: tracemalloc でメモリも計測するか (計測中は処理が遅くなる)
+    """
+
+    def __init__(self, memory: bool = False):
+        self.memory = memory
+        self.records = []
+        self.wall_seconds = None
+        self._started_tracing = False
+        self._start = None
+
+    def __call__(self, record: dict) -> None:
+        self.records.append(record)
+
+    def __enter__(self) -> "Recorder":
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        add_hook(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.wall_seconds = time.perf_counter() - self._start
+        remove_hook(self)
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def summary(self) -> list:
+        """
+        処理段ごとに集計した計測結果 (最初に実行した順)
+
+        戻り値:
+            {"stage", "calls", "seconds"(合計), "peak_mb"(最大値)} のリスト
+        """
+
+        stages = {}
+        for r in self.records:
+            s = stages.setdefault(r["stage"], {"stage": r["stage"], "calls": 0, "seconds": 0.0, "peak_mb": None})
+            s["calls"] += 1
+            s["seconds"] += r["seconds"]
+            if r["peak_mb"] is not None:
+                s["peak_mb"] = max(s["peak_mb"] or 0.0, r["peak_mb"])
+        return list(stages.values())
+
+    def table(self) -> str:
+        """summary() を表形式の文字列に変換 (処理段は入れ子になり得る為、割合の合計は 100% を超えることがある)"""
+
+        wall = self.wall_seconds or sum(r["seconds"] for r in self.records) or 1.0
+        lines = [f"{'stage':<20} {'calls':>5} {'time':>10} {'%':>6} {'peak':>10}"]
+        for s in self.summary():
+            peak = f"{s['peak_mb']:8.1f}MB" if s["peak_mb"] is not None else f"{'-':>10}"
+            lines.append(
+                f"{s['stage']:<20} {s['calls']:>5} {s['seconds']:9.4f}s {s['seconds'] / wall:6.1%} {peak}"
+            )
+        if self.wall_seconds is not None:
+            lines.append(f"{'total':<20} {'':>5} {self.wall_seconds:9.4f}s")
+        return "\n".join(lines)
+
+    def to_json(self) -> dict:
+        """JSON に保存できる計測結果 (集計結果と処理段ごとの記録)"""
+
+        return {
+            "wall_seconds": self.wall_seconds,
+            "stages": self.summary(),
+            "records": self.records,
+        }
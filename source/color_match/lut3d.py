@@ -0,0 +1,185 @@
+"""
+3D LUTの作成・入出力・適用
+
+カラーマッチングの色変換を RGB の格子点で評価して3D LUTにし、
+Adobe / DaVinci Resolve 形式の .cube ファイルとして書き出す
+"""
+
+import numpy as np
+
+# 1度に補間する画素数 (作業メモリを抑え、中間配列をキャッシュに収める為)
+_CHUNK_PIXELS = 1 << 16
+
+
+def bake(transforms: list, method: str, mode: str, size: int = 33, strength: float = 1.0) -> np.ndarray:
+    """
+    fit_transforms() で求めた色変換を3D LUTに変換
+
+    引数:
+        strength: 色変換の強さ(0-1、match() を参照)
+
+    戻り値:
+        (size, size, size, 3) の float32 配列 lut[r, g, b] = (R, G, B) (値は 0-1)
+    """
+
+    from . import apply_transforms
+
+    # 格子点の色 (色変換は8bitの入力に対して定義される為、最も近い整数値で評価する)
+    grid = np.rint(np.linspace(0, 255, size)).astype(np.uint8)
+    r, g, b = np.meshgrid(grid, grid, grid, indexing="ij")
+    lattice = np.stack([r, g, b], axis=-1).reshape(-1, 1, 3)
+
+    out = apply_transforms(lattice, transforms, method, mode, strength)
+    return (out.reshape(size, size, size, 3) / 255.0).astype(np.float32)
+
+
+def save_cube(path: str, lut: np.ndarray, title: str = "color_match") -> None:
+    """3D LUTを .cube ファイルに保存"""
+
+    size = lut.shape[0]
+    with open(path, "w", encoding="utf-8", newline="\n") as f:
+        f.write(f'TITLE "{title}"\n')
+        f.write(f"LUT_3D_SIZE {size}\n")
+        f.write("DOMAIN_MIN 0.0 0.0 0.0\n")
+        f.write("DOMAIN_MAX 1.0 1.0 1.0\n")
+        # .cube は R が最も速く変化する順に並べる
+        np.savetxt(f, lut.transpose(2, 1, 0, 3).reshape(-1, 3), fmt="%.6f")
+
+
+def load_cube(path: str) -> np.ndarray:
+    """
+    .cube ファイルを読み込み
+
+    戻り値:
+        (size, size, size, 3) の float32 配列 lut[r, g, b] (値は DOMAIN_MIN-DOMAIN_MAX を 0-1 に正規化)
+    """
+
+    size = None
+    domain_min = np.zeros(3)
+    domain_max = np.ones(3)
+    rows = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            key = line.split()[0]
+            if key == "LUT_3D_SIZE":
+                size = int(line.split()[1])
+            elif key == "LUT_1D_SIZE":
+                raise ValueError(f"1D LUTには対応していません: {path}")
+            elif key == "DOMAIN_MIN":
+                domain_min = np.array(line.split()[1:4], dtype=np.float64)
+            elif key == "DOMAIN_MAX":
+                domain_max = np.array(line.split()[1:4], dtype=np.float64)
+            elif key[0].isdigit() or key[0] in "-.":
+                rows.append(line.split()[:3])
+            # TITLE 等のその他のキーワードは無視
+
+    if size is None or len(rows) != size ** 3:
+        raise ValueError(f"3D LUTの形式が不正です: {path}")
+    values = (np.array(rows, dtype=np.float64) - domain_min) / (domain_max - domain_min)
+    return values.reshape(size, size, size, 3).transpose(2, 1, 0, 3).astype(np.float32)
+
+
+def apply(img: np.ndarray, lut: np.ndarray, interpolation: str = "tetrahedral") -> np.ndarray:
+    """
+    RGB画像に3D LUTを適用
+
+    引数:
+        img: RGB画像 (uint8 / uint16 / float、float は 0-1 の範囲外の値をクリップする)
+        lut: bake() / load_cube() で求めた3D LUT
+        interpolation: 補間方法(tetrahedral / trilinear)
+
+    戻り値:
+        RGB画像(入力画像と同じ型)
+    """
+
+    if interpolation not in ("tetrahedral", "trilinear"):
+        raise ValueError(f"不明な補間方法: {interpolation}")
+
+    size = lut.shape[0]
+    flat = lut.reshape(-1, 3).astype(np.float32)
+    # 格子点 (r, g, b) の flat 上のインデックスの増分
+    stride = np.array([size * size, size, 1])
+
+    integer = img.dtype in (np.uint8, np.uint16)
+    if integer:
+        # 値ごとの格子の基準点と端数 (入力は整数の為、画素ごとの計算を表の参照で済ませる)
+        max_value = np.iinfo(img.dtype).max
+        pos = np.arange(max_value + 1) * (size - 1) / max_value
+        base_table = np.minimum(pos.astype(np.intp), size - 2)
+        frac_table = (pos - base_table).astype(np.float32)
+        lookup = lambda chunk: (base_table[chunk], frac_table[chunk])
+    else:
+        def lookup(chunk):
+            pos = np.clip(chunk, 0.0, 1.0) * (size - 1)
+            base = np.minimum(pos.astype(np.intp), size - 2)
+            return base, (pos - base).astype(np.float32)
+
+    src = img.reshape(-1, 3)
+    out = np.empty(src.shape, dtype=img.dtype)
+    for i in range(0, src.shape[0], _CHUNK_PIXELS):
+        chunk = src[i:i + _CHUNK_PIXELS]
+        base, frac = lookup(chunk)
+        index = base[:, 0] * stride[0] + base[:, 1] * stride[1] + base[:, 2]
+        # 軸ごとの端数を連続したメモリにして要素ごとの計算を速くする
+        fr, fg, fb = np.ascontiguousarray(frac.T)
+
+        if interpolation == "trilinear":
+            acc = np.zeros(chunk.shape, dtype=np.float32)
+            for corner in np.ndindex(2, 2, 2):
+                w = np.ones(len(chunk), dtype=np.float32)
+                for c, f in zip(corner, (fr, fg, fb)):
+                    w *= f if c else 1.0 - f
+                acc += w[:, None] * np.take(flat, index + np.dot(corner, stride), axis=0)
+        else:
+            # 端数の大きい軸の順に格子点を辿る4頂点の四面体で補間
+            w_max = np.maximum(np.maximum(fr, fg), fb)
+            w_min = np.minimum(np.minimum(fr, fg), fb)
+            w_mid = fr + fg + fb - w_max - w_min
+            step_max = np.where(fr == w_max, stride[0], np.where(fg == w_max, stride[1], stride[2]))
+            step_min = np.where(fb == w_min, stride[2], np.where(fg == w_min, stride[1], stride[0]))
+            v3 = index + stride.sum()
+            acc = np.take(flat, index, axis=0) * (1.0 - w_max)[:, None]
+            acc += np.take(flat, index + step_max, axis=0) * (w_max - w_mid)[:, None]
+            acc += np.take(flat, v3 - step_min, axis=0) * (w_mid - w_min)[:, None]
+            acc += np.take(flat, v3, axis=0) * w_min[:, None]
+
+        if not integer:
+            out[i:i + _CHUNK_PIXELS] = acc
+            continue
+        acc *= max_value
+        acc += 0.5
+        out[i:i + _CHUNK_PIXELS] = np.clip(acc, 0, max_value).astype(img.dtype)
+    return out.reshape(img.shape)
+
+
+def expand(lut: np.ndarray, interpolation: str = "tetrahedral") -> np.ndarray:
+    """
+    3D LUTを全ての8bitの色(256^3)に展開したテーブルに変換
+
+    同じLUTを多数の画像に適用する場合は、展開したテーブルを apply_table() で参照すると
+    1画素あたり1回の参照で変換できる
+
+    戻り値:
+        (256 * 256 * 256, 3) の uint8 配列
+    """
+
+    v = np.arange(256, dtype=np.uint8)
+    r, g, b = np.meshgrid(v, v, v, indexing="ij")
+    colors = np.stack([r, g, b], axis=-1).reshape(-1, 1, 3)
+    return apply(colors, lut, interpolation).reshape(-1, 3)
+
+
+def apply_table(img: np.ndarray, table: np.ndarray) -> np.ndarray:
+    """expand() で展開したテーブルをRGB画像(uint8)に適用"""
+
+    src = img.reshape(-1, 3)
+    out = np.empty(src.shape, dtype=np.uint8)
+    for i in range(0, src.shape[0], _CHUNK_PIXELS):
+        chunk = src[i:i + _CHUNK_PIXELS]
+        index = (chunk[:, 0].astype(np.intp) << 16) | (chunk[:, 1].astype(np.intp) << 8) | chunk[:, 2]
+        out[i:i + _CHUNK_PIXELS] = table[index]
+    return out.reshape(img.shape)
+
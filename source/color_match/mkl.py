@@ -5,65 +5,113 @@ Monge-Kantorovich Linearization (MKL)実装
 import numpy as np
 from . import utils
 
-def match_rgb(src: np.ndarray, ref: np.ndarray) -> np.ndarray:
-    """RGB色空間でMKLによるカラー・マッチング"""
+def fit(x: np.ndarray) -> dict:
+    """(..., C) の画素の平均と分散共分散行列を計算"""
 
-    h, w, c = src.shape
+    return utils.moments(x)
 
-    # ピクセルを行ベクトルとして展開
-    s = src.reshape(-1, 3).astype(np.float64)
-    r = ref.reshape(-1, 3).astype(np.float64)
 
-    # 列ごとの平均色を計算
-    mu_s = np.mean(s, axis=0)
-    mu_r = np.mean(r, axis=0)
+def merge(a: dict, b: dict) -> dict:
+    """分割して計算した統計量を統合"""
 
-    # 3x3の分散共分散行列を計算
-    cov_s = np.cov(s, rowvar=False, bias=True)
-    cov_r = np.cov(r, rowvar=False, bias=True)
+    return utils.merge_moments(a, b)
 
-    # 共分散行列の平方根と逆平方根を計算
-    S_s_sqrt, S_s_inv_sqrt = utils.cov_sqrt_and_inv(cov_s)
 
-    # MKLの変換行列Aを計算
-    middle = utils.spd_mat_sqrt(S_s_sqrt @ cov_r @ S_s_sqrt)
-    A = S_s_inv_sqrt @ middle @ S_s_inv_sqrt
+def distance(a: dict, b: dict) -> float:
+    """2つの統計量の差(0-1)"""
 
-    # 色変換を適用
-    mapped = ((s - mu_s) @ A.T) + mu_r
+    return utils.moments_distance(a, b)
+
+
+def transform(src_stats: dict, ref_stats: dict) -> dict:
+    """
+    入力画像と参照画像の統計量からMKLの線形変換を求める
+
+    戻り値:
+        {"A": (C, C), "b": (C,)}
+    """
+
+    mu_s = src_stats["mean"]
+    mu_r = ref_stats["mean"]
+    cov_s = src_stats["cov"]
+    cov_r = ref_stats["cov"]
+
+    if cov_s.shape[0] == 1:
+        # 1次元の場合はガウスOT (標準偏差の比)
+        std_s = np.sqrt(cov_s[0, 0])
+        std_r = np.sqrt(cov_r[0, 0])
+        A = np.array([[std_r / max(std_s, 1e-6)]])
+    else:
+        # 共分散行列の平方根と逆平方根を計算
+        S_s_sqrt, S_s_inv_sqrt = utils.cov_sqrt_and_inv(cov_s)
+
+        # MKLの変換行列Aを計算
+        middle = utils.spd_mat_sqrt(S_s_sqrt @ cov_r @ S_s_sqrt)
+        A = S_s_inv_sqrt @ middle @ S_s_inv_sqrt
+
+    # (x - mu_s) A^T + mu_r を y = A x + b の形で表す
+    return {"A": A, "b": mu_r - A @ mu_s}
+
+
+def apply(x: np.ndarray, t: dict) -> np.ndarray:
+    """(..., C) の画素に線形変換を適用"""
+
+    return utils.apply_linear(x, t["A"], t["b"])
+
+
+def interpolate(t: dict, strength: float) -> dict:
+    """線形変換を恒等変換と strength(0-1) で補間 (適用の計算量は変わらない)"""
+
+    return utils.interpolate_linear(t, strength)
 
-    # 元の画像形状に戻す
-    out = mapped.reshape(h, w, 3)
+
+def fit_rgb(img: np.ndarray) -> dict:
+    """RGB色空間の統計量を計算"""
+
+    return fit(img)
+
+
+def fit_lab_l(img: np.ndarray) -> dict:
+    """LAB色空間のLチャネルの統計量を計算"""
+
+    return fit(utils.rgb2lab(img)[..., :1])
+
+
+def match_rgb(src: np.ndarray, ref) -> np.ndarray:
+    """
+    RGB色空間でMKLによるカラー・マッチング
+
+    引数:
+        ref: 参照画像、もしくは fit_rgb() で求めた参照画像の統計量
+    """
+
+    ref_stats = ref if isinstance(ref, dict) else fit_rgb(ref)
+
+    # 色変換を適用
+    out = apply(src, transform(fit(src), ref_stats))
     out = np.clip(out, 0, 255).astype(np.uint8)
     return out
 
 
-def match_lab_l(src: np.ndarray, ref: np.ndarray) -> np.ndarray:
-    """Lab色空間でLチャネルのみMKLによるカラー・マッチング"""
-    
-    # RGB -> Lab
-    src_lab = utils.rgb2lab(src.astype(np.float64))
-    ref_lab = utils.rgb2lab(ref.astype(np.float64))
+def match_lab_l(src: np.ndarray, ref) -> np.ndarray:
+    """
+    Lab色空間でLチャネルのみMKLによるカラー・マッチング
 
-    # Lチャンネルを1次元展開
-    s = src_lab[..., 0].ravel().astype(np.float64)
-    r = ref_lab[..., 0].ravel().astype(np.float64)
+    引数:
+        ref: 参照画像、もしくは fit_lab_l() で求めた参照画像の統計量
+    """
 
-    # 列ごとの平均色を計算
-    mu_s, mu_r = s.mean(), r.mean()
+    ref_stats = ref if isinstance(ref, dict) else fit_lab_l(ref)
 
-    # 標準偏差を計算
-    std_s, std_r = s.std(), r.std()
+    # RGB -> Lab
+    src_lab = utils.rgb2lab(src)
 
     # Lチャネルに対してガウスOTを適用
-    scale = std_r / max(std_s, 1e-6)
-    mapped_L = (s - mu_s) * scale + mu_r
-
-    out_lab = src_lab.copy()
-    out_lab[..., 0] = mapped_L.reshape(src_lab.shape[0], src_lab.shape[1])
+    src_L = src_lab[..., :1]
+    src_lab[..., :1] = apply(src_L, transform(fit(src_L), ref_stats))
 
     # Lab -> RGB
-    out_rgb = utils.lab2rgb(out_lab)
+    out_rgb = utils.lab2rgb(src_lab)
 
     # ここで out_rgb は 0..255 の範囲を想定してクリップ & uint8 化
     out_rgb = np.clip(out_rgb, 0, 255).astype(np.uint8)
@@ -0,0 +1,138 @@
+"""
+行ブロック単位の並列処理
+
+画素ごとの処理 (Lab変換・統計量の計算・色変換の適用・量子化・合成) を画像の行ブロックに分け、
+スレッドプールで並列に実行する
+NumPy の ufunc・bincount・LUT の参照(fancy indexing)・行列積等は計算中に GIL を解放する為、
+スレッドでも複数のコアで並列に処理される
+
+- workers が None / 1 の場合は行ブロックに分けず、これまでと同じ処理を行う
+- 行ブロックの分け方は workers の値に依存しない為、workers が 2 以上の場合の結果は workers の値に関わらず同じ
+  (統計量は行ブロックごとに計算して行ブロックの順に統合する為、workers が 1 の場合とは
+  平均・分散共分散行列の丸め誤差の分だけ異なり、出力がまれに 1 階調(8bit の階調)ずれる場合がある
+  tests/test_parallel.py で全ての手法・モードについて差が 1 階調以内であることを確認している)
+"""
+
+import os
+import threading
+from functools import reduce
+import numpy as np
+from . import utils
+
+# 1つの行ブロックの画素数
+# (スレッドへの受け渡しの負荷が無視できる程度に大きく、コア数より十分多くのブロックに分かれる程度に小さい)
+BLOCK_PIXELS = 1 << 18
+
+# スレッド数ごとのスレッドプール (呼び出しのたびにスレッドを作らない様に使い回す)
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def resolve(workers) -> int:
+    """スレッド数 (None は 1、0 は CPU のコア数)"""
+
+    if workers is None:
+        return 1
+    workers = int(workers)
+    if workers < 0:
+        raise ValueError(f"workers は 0 以上で指定してください: {workers}")
+    return workers or os.cpu_count() or 1
+
+
+def _reset_pools() -> None:
+    # fork したプロセス(batch のワーカー等)には親のプールのスレッドが引き継がれない為、作り直す
+    global _pools, _pools_lock
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pools)
+
+
+def _pool(workers: int):
+    # concurrent.futures は workers が 2 以上の場合のみ import する (起動時間の短縮)
+    from concurrent.futures import ThreadPoolExecutor
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = _pools[workers] = ThreadPoolExecutor(workers, thread_name_prefix="color_match")
+        return pool
+
+
+def blocks(x: np.ndarray) -> list:
+    """(H, W, C) (もしくは (n, C)) の配列を先頭の軸で分ける、約 BLOCK_PIXELS 画素ごとの行ブロック(slice)のリスト"""
+
+    row_pixels = int(np.prod(x.shape[1:-1], dtype=np.int64))
+    rows = max(1, BLOCK_PIXELS // max(row_pixels, 1))
+    return [slice(y0, min(y0 + rows, x.shape[0])) for y0 in range(0, x.shape[0], rows)]
+
+
+def apply(func, *arrays: np.ndarray, workers: int = None) -> np.ndarray:
+    """
+    画素ごとの処理 func(*arrays) を行ブロックごとに並列に実行し、1つの配列にまとめる
+
+    引数:
+        func: 行ブロックごとの配列を受け取り、同じ行数の配列を返す関数 (func の中で apply() を呼ばないこと)
+        arrays: 先頭の軸の長さが同じ配列 (行ブロックは最初の配列で決める)
+        workers: スレッド数 (resolve() を参照、1 の場合は func(*arrays) をそのまま呼ぶ)
+    """
+
+    workers = resolve(workers)
+    parts = blocks(arrays[0])
+    if workers <= 1 or len(parts) <= 1:
+        return func(*arrays)
+
+    # 最初の行ブロックの結果から出力の型と形状を決める (結果を連結するコピーを避ける)
+    # (Lab変換のバックエンド等の初回の初期化も呼び出し元のスレッドで済ませる)
+    first = func(*(a[parts[0]] for a in arrays))
+    out = np.empty((arrays[0].shape[0],) + first.shape[1:], dtype=first.dtype)
+    out[parts[0]] = first
+
+    def _run(s):
+        out[s] = func(*(a[s] for a in arrays))
+
+    for _ in _pool(workers).map(_run, parts[1:]):
+        pass
+    return out
+
+
+def fit(func, merge, x: np.ndarray, workers: int = None) -> dict:
+    """
+    統計量 func(x) を行ブロックごとに並列に計算し、merge で行ブロックの順に統合
+
+    引数:
+        func / merge: 実装モジュールの fit() / merge() に相当する関数
+        workers: スレッド数 (1 の場合は func(x) をそのまま呼ぶ)
+    """
+
+    workers = resolve(workers)
+    parts = blocks(x)
+    if workers <= 1 or len(parts) <= 1:
+        return func(x)
+    return reduce(merge, _pool(workers).map(lambda s: func(x[s]), parts))
+
+
+def to_workspace(img: np.ndarray, mode: str, dtype=np.float64, workers: int = None) -> tuple:
+    """utils.to_workspace() を行ブロックごとに並列に実行"""
+
+    if resolve(workers) <= 1 or (mode == "rgb" and img.dtype == np.uint8):
+        return utils.to_workspace(img, mode, dtype)
+    if mode == "rgb":
+        return apply(lambda b: utils.to_workspace(b, mode, dtype)[0], img, workers=workers), None
+    lab = apply(lambda b: utils.to_workspace(b, mode, dtype)[1], img, workers=workers)
+    return lab[..., :1], lab
+
+
+def from_workspace(work: np.ndarray, lab, mode: str, img_dtype=np.uint8, workers: int = None) -> np.ndarray:
+    """utils.from_workspace() を行ブロックごとに並列に実行"""
+
+    if mode == "rgb":
+        return apply(lambda w: utils.from_workspace(w, None, mode, img_dtype), work, workers=workers)
+    return apply(lambda w, l: utils.from_workspace(w, l, mode, img_dtype), work, lab, workers=workers)
+
+
+def blend(src: np.ndarray, out: np.ndarray, strength: float, workers: int = None) -> np.ndarray:
+    """utils.blend() を行ブロックごとに並列に実行"""
+
+    return apply(lambda s, o: utils.blend(s, o, strength), src, out, workers=workers)
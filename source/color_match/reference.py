@@ -0,0 +1,165 @@
+"""
+参照画像の統計量(リファレンスプロファイル)
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import numpy as np
+
+class ReferenceProfile:
+    """
+    参照画像から事前に計算した手法ごとの統計量を保持するクラス
+
+    同じ参照画像を多数の入力画像に適用する場合に、参照画像の解析を1度で済ませる為に利用する
+
+    属性:
+        method: カラーマッチング手法
+        mode: モード(rgb / lab)
+        stats: 手法(hm / reinhard / mvgd / mkl / sliced-ot)ごとの統計量 {手法: {名前: 配列}}
+    """
+
+    def __init__(self, method: str, mode: str, stats: dict):
+        self.method = method
+        self.mode = mode
+        self.stats = stats
+
+    def __repr__(self) -> str:
+        return f"ReferenceProfile(method={self.method!r}, mode={self.mode!r})"
+
+    def save(self, path) -> None:
+        """npz 形式でファイルに保存"""
+
+        arrays = {
+            f"{name}.{key}": np.asarray(value)
+            for name, stats in self.stats.items()
+            for key, value in stats.items()
+        }
+        meta = {"method": self.method, "mode": self.mode}
+        arrays["__meta__"] = np.array(json.dumps(meta))
+        # np.savez_compressed は拡張子が無い場合に .npz を付与する為、ファイルオブジェクトで書き込む
+        with open(path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+
+    @classmethod
+    def load(cls, path) -> "ReferenceProfile":
+        """save() で保存したファイルを読み込み"""
+
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["__meta__"]))
+            stats = {}
+            for key in data.files:
+                if key == "__meta__":
+                    continue
+                name, stat = key.split(".", 1)
+                stats.setdefault(name, {})[stat] = data[key]
+        return cls(meta["method"], meta["mode"], stats)
+
+
+class ProfileCache:
+    """
+    参照プロファイルのディスクキャッシュ
+
+    参照画像のファイルの内容のハッシュ値と、統計量に影響する条件 (手法・モード・推定のオプション・
+    Lab変換のバックエンド・ライブラリのバージョン等) から求めたキーごとに .npz ファイルとして保存し、
+    同じ参照画像を再び使う場合は画像の読み込みと解析を省略する
+
+    合計サイズが max_mb を超えた場合は、最後に使われた時刻(ファイルの更新時刻)の古いものから削除する
+    複数のプロセスから同時に使ってもよい (保存は一時ファイルに書き込んでから置き換える)
+
+    引数:
+        directory: キャッシュのフォルダ (無い場合は作成する)
+        max_mb: キャッシュの合計サイズの上限 [MB]
+    """
+
+    # 保存形式のバージョン (ReferenceProfile の保存形式を変更した場合に上げる)
+    FORMAT_VERSION = 1
+
+    def __init__(self, directory, max_mb: float = 256):
+        self.directory = Path(directory)
+        self.max_bytes = int(max_mb * (1 << 20))
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def file_hash(path) -> str:
+        """ファイルの内容の SHA-256"""
+
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    def key(self, path, **params) -> str:
+        """参照画像のファイルと統計量に影響する条件(JSON に変換できる値)から求めたキー"""
+
+        params = dict(params, file=self.file_hash(path), format=self.FORMAT_VERSION)
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        """キーの参照プロファイル (無い場合は None)"""
+
+        path = self.directory / f"{key}.npz"
+        try:
+            profile = ReferenceProfile.load(path)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # 書き込み途中で中断した等の壊れたファイルは削除して計算し直す
+            path.unlink(missing_ok=True)
+            return None
+        # 最後に使われた時刻を更新 (LRU)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return profile
+
+    def put(self, key: str, profile: ReferenceProfile) -> None:
+        """参照プロファイルを保存し、上限を超えた分を削除"""
+
+        path = self.directory / f"{key}.npz"
+        tmp = self.directory / f"{key}.{os.getpid()}.tmp"
+        profile.save(tmp)
+        os.replace(tmp, path)
+        self._evict(keep=path)
+
+    def _evict(self, keep: Path) -> None:
+        """合計サイズが上限以下になるまで、最後に使われた時刻の古いものから削除 (keep は削除しない)"""
+
+        entries = []
+        for p in self.directory.glob("*.npz"):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            if p == keep:
+                continue
+            try:
+                p.unlink()
+            except OSError:
+                continue
+            total -= size
+
+    def load(self, path, compute, **params) -> ReferenceProfile:
+        """
+        参照画像の参照プロファイルをキャッシュから読み込み (無い場合は compute() で計算して保存する)
+
+        引数:
+            path: 参照画像のファイルパス
+            compute: 参照プロファイルを計算する関数
+            params: 統計量に影響する条件 (key() を参照)
+        """
+
+        key = self.key(path, **params)
+        profile = self.get(key)
+        if profile is None:
+            profile = compute()
+            self.put(key, profile)
+        return profile
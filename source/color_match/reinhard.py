@@ -5,55 +5,110 @@ Reinhard実装
 import numpy as np
 from . import utils
 
+def fit(x: np.ndarray) -> dict:
+    """(..., C) の画素の平均と分散共分散行列を計算"""
+
+    return utils.moments(x)
+
+
+def merge(a: dict, b: dict) -> dict:
+    """分割して計算した統計量を統合"""
+
+    return utils.merge_moments(a, b)
+
+
+def distance(a: dict, b: dict) -> float:
+    """2つの統計量の差(0-1)"""
+
+    return utils.moments_distance(a, b)
+
+
+def transform(src_stats: dict, ref_stats: dict) -> dict:
+    """
+    入力画像と参照画像の統計量からチャンネルごとの線形変換を求める
+
+    戻り値:
+        {"A": (C, C) の対角行列, "b": (C,)}
+    """
+
+    src_mean = src_stats["mean"]
+    ref_mean = ref_stats["mean"]
+    src_std = np.sqrt(np.diag(src_stats["cov"]))
+    ref_std = np.sqrt(np.diag(ref_stats["cov"]))
+
+    # 標準偏差がゼロのチャンネルは変換しない
+    valid = src_std > 0
+    scale = np.where(valid, ref_std / np.where(valid, src_std, 1.0), 1.0)
+    offset = np.where(valid, ref_mean - src_mean * scale, 0.0)
+
+    # Reinhard の色変換式 (x - src_mean) * A + ref_mean を y = A x + b の形で表す
+    return {"A": np.diag(scale), "b": offset}
+
+
+def apply(x: np.ndarray, t: dict) -> np.ndarray:
+    """(..., C) の画素に線形変換を適用"""
+
+    out = utils.apply_linear(x, t["A"], t["b"])
+
+    # 値を 0-255 にクリップ
+    return np.clip(out, 0, 255)
+
+
+def interpolate(t: dict, strength: float) -> dict:
+    """線形変換を恒等変換と strength(0-1) で補間 (適用の計算量は変わらない)"""
+
+    return utils.interpolate_linear(t, strength)
+
+
+def fit_rgb(img: np.ndarray) -> dict:
+    """RGB色空間の統計量を計算"""
+
+    return fit(img)
+
+
+def fit_lab_l(img: np.ndarray) -> dict:
+    """LAB色空間のLチャネルの統計量を計算"""
+
+    return fit(utils.rgb2lab(img)[..., :1])
+
+
 def match_channel(src_chan: np.ndarray, ref_chan: np.ndarray) -> np.ndarray:
     """単一チャンネルのReinhardマッチング"""
-    
-    # チャンネルデータを float に変換
-    src = src_chan.astype(np.float64)
-    ref = ref_chan.astype(np.float64)
-    
-    # 統計量を計算
-    src_mean = np.mean(src)
-    ref_mean = np.mean(ref)
-    src_std = np.std(src)
-    ref_std = np.std(ref)
-    
-    # 標準偏差がゼロの場合の処理
-    if src_std == 0:
-        return src_chan
-    
-    # Reinhard の色変換式を適用
-    A = ref_std / src_std
-    out = (src - src_mean) * A + ref_mean
-    
-    # 値を 0-255 にクリップ
-    out = np.clip(out, 0, 255)
+
+    t = transform(fit(src_chan[..., None]), fit(ref_chan[..., None]))
+    out = apply(src_chan[..., None], t)[..., 0]
     return out.astype(src_chan.dtype)
 
 
-def match_rgb(src: np.ndarray, ref: np.ndarray) -> np.ndarray:
-    """RGB色空間でReinhardマッチング"""
-    
-    out = np.empty_like(src, dtype=np.float64)
-    for ch in range(src.shape[2]):
-        out[..., ch] = match_channel(src[..., ch], ref[..., ch])
-    
-    return out
+def match_rgb(src: np.ndarray, ref) -> np.ndarray:
+    """
+    RGB色空間でReinhardマッチング
+
+    引数:
+        ref: 参照画像、もしくは fit_rgb() で求めた参照画像の統計量
+    """
+
+    ref_stats = ref if isinstance(ref, dict) else fit_rgb(ref)
+    out = apply(src, transform(fit(src), ref_stats))
+    return out.astype(src.dtype)
+
 
+def match_lab_l(src: np.ndarray, ref) -> np.ndarray:
+    """
+    LAB色空間でLチャネルのみReinhardマッチング
+
+    引数:
+        ref: 参照画像、もしくは fit_lab_l() で求めた参照画像の統計量
+    """
+
+    ref_stats = ref if isinstance(ref, dict) else fit_lab_l(ref)
 
-def match_lab_l(src: np.ndarray, ref: np.ndarray) -> np.ndarray:
-    """LAB色空間でLチャネルのみReinhardマッチング"""
-    
     # RGB -> Lab(0-255)
     src_lab = utils.rgb2lab(src)
-    ref_lab = utils.rgb2lab(ref)
-    
-    # L: 0-255
-    src_L = src_lab[..., 0]
-    ref_L = ref_lab[..., 0]
-    
-    # Reinhardマッチング
-    src_lab[..., 0] = match_channel(src_L, ref_L)
-    
+
+    # L: 0-255 をReinhardマッチング
+    src_L = src_lab[..., :1]
+    src_lab[..., :1] = apply(src_L, transform(fit(src_L), ref_stats))
+
     # Lab -> RGB
     return utils.lab2rgb(src_lab)
@@ -0,0 +1,341 @@
+"""
+動画(連番画像・アニメーションGIF・マルチページTIFF)のカラーマッチング
+
+参照画像の解析は1度だけ行い、入力画像の統計量はフレーム間で指数移動平均により平滑化する
+(フレームごとの統計量の揺らぎによるちらつきを抑える)
+"""
+
+import argparse
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+import numpy as np
+from PIL import Image
+from . import utils
+from . import imagefile
+from . import parallel
+from . import _MODULES, _stages, _check_dtype, _resolve_profile, _fit_stats, _transformer, _finish
+from . import _add_match_arguments, _match_options, _ot_options, _profile_cache, _load_reference
+from .batch import IMAGE_EXTENSIONS
+
+# 複数フレームを1ファイルに格納する形式
+CONTAINER_EXTENSIONS = (".gif", ".tif", ".tiff")
+
+
+def _normalize_stats(stats: dict) -> dict:
+    """ヒストグラムを画素数で正規化 (解像度の異なるフレームの統計量を平均できるようにする)"""
+
+    if "hist" not in stats:
+        return stats
+    hist = stats["hist"]
+    return {"hist": hist / np.maximum(hist.sum(axis=-1, keepdims=True), 1.0)}
+
+
+def smooth_stats(prev: dict, cur: dict, alpha: float) -> dict:
+    """
+    統計量の指数移動平均
+
+    引数:
+        prev: これまでのフレームの平滑化した統計量 (None の場合は cur をそのまま返す)
+        alpha: 新しいフレームの重み(0-1、1 の場合は平滑化しない)
+    """
+
+    cur = _normalize_stats(cur)
+    if prev is None or ("hist" in cur and prev["hist"].shape != cur["hist"].shape):
+        # 階調(ヒストグラムのビン数)の異なるフレームは平均できない為、平滑化をやり直す
+        return cur
+    if "samples" in cur:
+        return {"samples": _mix_samples(prev["samples"], cur["samples"], alpha), "count": cur["count"]}
+    out = {}
+    for key, value in cur.items():
+        out[key] = value if key == "count" else (1.0 - alpha) * prev[key] + alpha * value
+    return out
+
+
+def _mix_samples(prev: np.ndarray, cur: np.ndarray, alpha: float) -> np.ndarray:
+    """
+    抽出した画素(Sliced OT の統計量)の指数移動平均
+
+    画素ごとには平均できない (フレームにより画素数も異なる) 為、これまでのフレームと新しいフレームの画素を
+    (1 - alpha) : alpha の比で等間隔に抽出して混ぜる (分布の指数移動平均、最大 sliced_ot.SAMPLES 画素)
+    """
+
+    if alpha >= 1.0:
+        return cur
+    n = min(len(prev) / (1.0 - alpha), len(cur) / alpha, _MODULES["sliced-ot"].SAMPLES)
+    parts = []
+    for samples, k in ((prev, int(round(n * (1.0 - alpha)))), (cur, int(round(n * alpha)))):
+        parts.append(samples[np.linspace(0, len(samples) - 1, k).astype(np.intp)] if k < len(samples) else samples)
+    return np.concatenate(parts)
+
+
+class SequenceMatcher:
+    """
+    フレームを順にカラーマッチングする
+
+    - 入力フレームの統計量は処理段ごとに指数移動平均で平滑化してから色変換を求める
+    - 1段目の処理段の平滑化した統計量が、前回色変換を求めた時点から reuse_tol 以下しか変化していなければ
+      前回の色変換をそのまま使う (複合法の2段目以降の統計量の計算も省略する)
+    """
+
+    def __init__(self, ref, method: str, mode: str, smoothing: float = 0.2, reuse_tol: float = 0.002,
+                 fit_scale: float = None, max_fit_pixels: int = None,
+                 sample_tol: float = None, sampling: str = "random", strength: float = 1.0,
+                 dtype=np.float64, ot_iterations: int = None, ot_tol: float = None, workers: int = None):
+        """
+        引数:
+            ref: 参照画像、もしくは ReferenceProfile
+            smoothing: 統計量の指数移動平均の新しいフレームの重み(0-1、1 の場合は平滑化しない)
+            reuse_tol: 前回の色変換を使い回す統計量の変化の上限(0-1、統計量の差は sample_tol と同じ尺度)
+            fit_scale / max_fit_pixels / sample_tol / sampling / strength / dtype / ot_iterations / ot_tol / workers:
+                match() を参照
+        """
+
+        if not 0.0 < smoothing <= 1.0:
+            raise ValueError(f"smoothing は 0 より大きく 1 以下で指定してください: {smoothing}")
+        if not 0.0 <= strength <= 1.0:
+            raise ValueError(f"strength は 0-1 で指定してください: {strength}")
+        self.method = method
+        self.mode = mode
+        self.stages = _stages(method)
+        self.profile = _resolve_profile(ref, method, mode, fit_scale, max_fit_pixels, sample_tol, sampling, workers)
+        self.smoothing = smoothing
+        self.reuse_tol = reuse_tol
+        self.fit_scale = fit_scale
+        self.max_fit_pixels = max_fit_pixels
+        self.sample_tol = sample_tol
+        self.sampling = sampling
+        self.strength = strength
+        self.dtype = _check_dtype(dtype)
+        self.ot_iterations = ot_iterations
+        self.ot_tol = ot_tol
+        self.workers = workers
+
+        # 処理段ごとの平滑化した統計量と、色変換を求めた時点の1段目の統計量
+        self._stats = [None] * len(self.stages)
+        self._bins = 256
+        self._raw_stats = None
+        self._fitted_stats = None
+        self.transforms = None
+
+        # 処理したフレーム数と、色変換を使い回したフレーム数
+        self.frames = 0
+        self.reused = 0
+
+    def _fit_first(self, x: np.ndarray) -> dict:
+        """1段目の統計量を計算して平滑化"""
+
+        self._raw_stats = _fit_stats(_MODULES[self.stages[0]], x, self.sample_tol, self.sampling,
+                                     bins=self._bins, workers=self.workers)
+        self._stats[0] = smooth_stats(self._stats[0], self._raw_stats, self.smoothing)
+        return self._stats[0]
+
+    def match(self, frame: np.ndarray) -> np.ndarray:
+        """1フレーム(RGB画像、uint8 / uint16 / float)をカラーマッチング (出力はフレームと同じ型)"""
+
+        # HM のヒストグラムのビン数はフレームの階調に合わせる
+        self._bins = utils.levels(frame)
+        work, lab = parallel.to_workspace(frame, self.mode, self.dtype, self.workers)
+        proxy = utils.downscale(frame, self.fit_scale, self.max_fit_pixels)
+        x = work if proxy is frame else parallel.to_workspace(proxy, self.mode, self.dtype, self.workers)[0]
+
+        first = _MODULES[self.stages[0]]
+        stats = self._fit_first(x)
+        self.frames += 1
+        if self.transforms is not None and first.distance(stats, self._fitted_stats) <= self.reuse_tol:
+            self.reused += 1
+        else:
+            # 2段目以降の統計量は、そのフレームの(平滑化しない)統計量から求めた前の処理段の色変換を適用した画素で計算する
+            # (平滑化した色変換を適用すると、後段がフレームごとのずれを打ち消そうとして却ってちらつく為)
+            transforms = []
+            for i, name in enumerate(self.stages):
+                module = _MODULES[name]
+                transform = _transformer(module, self.ot_iterations, self.ot_tol)
+                if i > 0:
+                    prev = _MODULES[self.stages[i - 1]]
+                    x = parallel.apply(lambda b: prev.apply(b, raw), x, workers=self.workers)
+                    raw_stats = _fit_stats(module, x, self.sample_tol, self.sampling, bins=self._bins,
+                                           workers=self.workers)
+                    stats = self._stats[i] = smooth_stats(self._stats[i], raw_stats, self.smoothing)
+                else:
+                    raw_stats = self._raw_stats
+                if i < len(self.stages) - 1:
+                    raw = transform(raw_stats, self.profile.stats[name])
+                transforms.append(transform(stats, self.profile.stats[name]))
+            self.transforms = transforms
+            self._fitted_stats = self._stats[0]
+
+        return _finish(frame, work, lab, self.stages, self.transforms, self.mode, self.strength, self.dtype,
+                       self.workers)
+
+
+def iter_frames(path):
+    """
+    フレームを順に読み込み
+
+    引数:
+        path: 連番画像のフォルダ(ファイル名順)、アニメーションGIF、もしくはマルチページTIFF
+
+    戻り値:
+        (フレーム名, RGB画像(uint8 / uint16 / float、imagefile.read() を参照)) を列挙するイテレータ
+        (1ファイルのフレームの名前は、16bit / float のフレームは階調を保てる .tif にする)
+    """
+
+    path = Path(path)
+    if path.is_dir():
+        for p in sorted(p for p in path.iterdir() if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS):
+            yield p.name, imagefile.read(p)
+    else:
+        for i, frame in enumerate(imagefile.read_frames(path)):
+            yield f"{path.stem}_{i:05d}{'.png' if frame.dtype == np.uint8 else '.tif'}", frame
+
+
+def _prefetch(iterable, depth: int = 2):
+    """別スレッドで iterable を先読みしながら列挙 (フレームの読み込みと色変換を並行させる)"""
+
+    q = queue.Queue(maxsize=depth)
+    end = object()
+
+    def _produce():
+        try:
+            for item in iterable:
+                q.put(item)
+            q.put(end)
+        except BaseException as e:
+            q.put(e)
+
+    threading.Thread(target=_produce, daemon=True).start()
+    while True:
+        item = q.get()
+        if item is end:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+class _FrameWriter:
+    """
+    別スレッドでフレームを保存 (色変換と書き出しを並行させる)
+
+    出力先が .gif / .tif の場合は全フレームを1ファイルに(imagefile.write_frames())、
+    それ以外はフォルダに1フレームずつ保存する(imagefile.write()、16bit / float のフレームは階調を保てる形式であれば保つ)
+    """
+
+    def __init__(self, out_path, info: dict, depth: int = 2):
+        self.out_path = Path(out_path)
+        self.container = self.out_path.suffix.lower() in CONTAINER_EXTENSIONS
+        self.info = info
+        self.frames = []
+        if not self.container:
+            os.makedirs(self.out_path, exist_ok=True)
+        self._queue = queue.Queue(maxsize=depth)
+        self._error = None
+        self._thread = threading.Thread(target=self._consume, daemon=True)
+        self._thread.start()
+
+    def _consume(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            name, frame = item
+            try:
+                if self.container:
+                    self.frames.append(frame)
+                else:
+                    imagefile.write(frame, self.out_path / name)
+            except Exception as e:
+                self._error = e
+
+    def write(self, name: str, frame: np.ndarray) -> None:
+        self._queue.put((name, frame))
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        if self.container and self.frames:
+            os.makedirs(self.out_path.parent, exist_ok=True)
+            imagefile.write_frames(self.frames, self.out_path, **self.info)
+
+
+def _container_info(path) -> dict:
+    """アニメーションGIFのフレーム間隔とループ回数 (出力をGIFにする場合に引き継ぐ)"""
+
+    path = Path(path)
+    if path.is_dir() or path.suffix.lower() != ".gif":
+        return {}
+    with Image.open(path) as img:
+        return {key: img.info[key] for key in ("duration", "loop") if key in img.info}
+
+
+def run(src, ref, out, method: str, mode: str, smoothing: float = 0.2, reuse_tol: float = 0.002,
+        log=print, **options) -> SequenceMatcher:
+    """
+    フレームを順にカラーマッチングして保存
+
+    フレームの読み込み・色変換・書き出しは別スレッドで並行して行う
+
+    引数:
+        src: 連番画像のフォルダ、アニメーションGIF、もしくはマルチページTIFF
+        ref: 参照画像、もしくは ReferenceProfile
+        out: 出力先 (.gif / .tif の場合は1ファイル、それ以外はフォルダ)
+        log: 進捗を出力する関数 (None の場合は出力しない)
+        options: match() に渡すオプション引数(fit_scale 等)
+
+    戻り値:
+        処理に利用した SequenceMatcher (処理したフレーム数等を参照できる)
+    """
+
+    matcher = SequenceMatcher(ref, method, mode, smoothing, reuse_tol, **options)
+    writer = _FrameWriter(out, _container_info(src) if Path(out).suffix.lower() == ".gif" else {})
+    try:
+        for name, frame in _prefetch(iter_frames(src)):
+            start = time.perf_counter()
+            reused = matcher.reused
+            writer.write(name, matcher.match(frame))
+            if log is not None:
+                state = " (色変換を再利用)" if matcher.reused > reused else ""
+                log(f"[{matcher.frames}] {name}: {time.perf_counter() - start:.2f}s{state}")
+    finally:
+        writer.close()
+    return matcher
+
+
+def main(argv=None) -> int:
+    """sequence サブコマンドのエントリポイント"""
+
+    # 引数解析
+    p = argparse.ArgumentParser(prog="color-match sequence", description="Color Matching (動画・連番画像)")
+    p.add_argument("source", help="入力の連番画像フォルダ、アニメーションGIF、もしくはマルチページTIFF")
+    p.add_argument("reference", help="参照画像パス(もしくは --save-reference で保存した .npz ファイル)")
+    p.add_argument("-o", "--output", help="出力先 (.gif / .tif の場合は1ファイル、それ以外はフォルダ)", default="./output")
+    _add_match_arguments(p)
+    p.add_argument(
+        "--smoothing", type=float, default=0.2,
+        help="統計量の指数移動平均の新しいフレームの重み(0-1、1 の場合は平滑化しない)",
+    )
+    p.add_argument("--reuse-tol", type=float, default=0.002, help="前回の色変換を使い回す統計量の変化の上限(0-1)")
+    args = p.parse_args(argv)
+
+    if not os.path.exists(args.source):
+        p.error(f"入力が見つかりません: {args.source}")
+    utils.set_backend(args.backend)
+
+    # 参照画像の解析は1度だけ行う
+    start = time.perf_counter()
+    options = _match_options(args)
+    profile = _load_reference(args.reference, args.method, args.mode, _profile_cache(args), args.threads, **options)
+
+    matcher = run(args.source, profile, args.output, args.method, args.mode,
+                  args.smoothing, args.reuse_tol, strength=args.strength, dtype=args.dtype,
+                  workers=args.threads, **options, **_ot_options(args))
+    elapsed = time.perf_counter() - start
+    print(f"完了: {matcher.frames}フレーム (色変換の再利用 {matcher.reused}フレーム, {elapsed:.2f}s)")
+    return 0 if matcher.frames else 1
@@ -0,0 +1,399 @@
+"""
+カラーマッチングの HTTP サーバ (serve サブコマンド)
+
+プロセスを起動したまま複数のリクエストを処理する為、リクエストごとの Python の起動や
+参照画像の読み込み・解析が不要になる
+
+- 参照画像は事前に登録(アップロード、もしくは --references のフォルダ)し、ID で指定する
+- 参照画像の統計量(ReferenceProfile)は (ID, 手法, モード, 推定のオプション) ごとに LRU キャッシュで保持する
+- 同時にカラーマッチングするリクエスト数は workers(既定値は CPU コア数)に制限する
+  (NumPy の計算の多くは GIL を解放する為、スレッドで並列に処理できる)
+
+API:
+    POST /references[?id=名前]
+        本文: 参照画像 (もしくは --save-reference で保存した .npz ファイル)
+        応答: {"id": 参照画像の ID} (id を省略した場合は内容のハッシュ値)
+    GET  /references
+        応答: {"references": 登録済みの参照画像の ID のリスト}
+    POST /match?ref=ID&method=mkl&mode=rgb&format=.png (その他のオプションは match() と同じ名前)
+        本文: 入力画像
+        応答: カラーマッチングした画像 (format の形式、16bit / float の画像は .png / .tif 等で階調を保つ)
+    GET  /health
+        応答: キャッシュの状態等
+
+    エラーの応答は {"error": メッセージ} で、登録されていない参照画像は 404、不正なオプション
+    (dtype は float64 / float32) や Content-Length は 400、Content-Length の省略は 411 を返す
+
+使用例:
+    python -m color_match serve --port 8000 --references ./references
+    curl --data-binary @src.png "http://127.0.0.1:8000/match?ref=sunset.png&method=mkl" -o out.png
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+from . import utils
+from . import imagefile
+from . import instrument
+from . import METHODS, MODES, fit_reference, match
+from .batch import IMAGE_EXTENSIONS
+from .reference import ReferenceProfile
+
+# 応答の本文を書き出す単位
+_WRITE_CHUNK = 1 << 20
+
+# .npz (zip) ファイルの先頭のバイト列
+_ZIP_MAGIC = b"PK\x03\x04"
+
+# dtype に指定できる型
+_DTYPES = ("float64", "float32")
+
+
+class UnknownReferenceError(KeyError):
+    """登録されていない参照画像の ID (応答は 404)"""
+
+
+def _dtype(value: str) -> str:
+    """dtype の値を確認 (不正な値は ValueError)"""
+
+    if value not in _DTYPES:
+        raise ValueError(value)
+    return value
+
+
+# クエリ文字列のオプション -> 型 (変換できない値は ValueError)
+_FIT_OPTIONS = {"fit_scale": float, "max_fit_pixels": int, "sample_tol": float, "sampling": str}
+_MATCH_OPTIONS = {"strength": float, "dtype": _dtype, "ot_iterations": int, "ot_tol": float}
+
+
+class ReferenceStore:
+    """
+    参照画像と参照プロファイルのキャッシュ (スレッドセーフ)
+
+    参照画像は ID ごとに、アップロードされたファイルの内容(バイト列)もしくはフォルダ内のファイルパスを保持し、
+    参照プロファイルは必要になった時点で計算して最大 cache_size 件を保持する
+    (最も長く使われていないものから破棄する)
+
+    引数:
+        directory: 参照画像のフォルダ (ファイル名を ID として利用できる、None の場合はアップロードのみ)
+        cache_size: 参照プロファイルのキャッシュの最大件数
+        max_uploads: アップロードされた参照画像を保持する最大件数
+    """
+
+    def __init__(self, directory=None, cache_size: int = 64, max_uploads: int = 256):
+        self.directory = Path(directory) if directory else None
+        self.cache_size = cache_size
+        self.max_uploads = max_uploads
+        self._lock = threading.Lock()
+        self._uploads = OrderedDict()
+        self._profiles = OrderedDict()
+        # 同じ参照プロファイルを複数のスレッドで同時に計算しない為のキーごとのロック
+        self._fitting = {}
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, data: bytes, ref_id: str = None) -> str:
+        """参照画像(もしくは .npz の参照プロファイル)のファイルの内容を登録して ID を返す"""
+
+        if ref_id is None:
+            ref_id = hashlib.sha256(data).hexdigest()[:16]
+        if data[:len(_ZIP_MAGIC)] == _ZIP_MAGIC:
+            # 参照プロファイルは読み込んで保持する (手法・モードは保存時のものに限られる)
+            value = ReferenceProfile.load(io.BytesIO(data))
+        else:
+            value = data
+        with self._lock:
+            self._uploads[ref_id] = value
+            self._uploads.move_to_end(ref_id)
+            while len(self._uploads) > self.max_uploads:
+                old, _ = self._uploads.popitem(last=False)
+                self._discard(old)
+            self._discard(ref_id)
+        return ref_id
+
+    def _discard(self, ref_id: str) -> None:
+        """ID の参照プロファイルをキャッシュから削除 (self._lock を取得した状態で呼ぶ)"""
+
+        for key in [key for key in self._profiles if key[0] == ref_id]:
+            del self._profiles[key]
+
+    def ids(self) -> list:
+        """登録済みの参照画像の ID"""
+
+        with self._lock:
+            ids = list(self._uploads)
+        if self.directory is not None:
+            ids += sorted(
+                p.name for p in self.directory.iterdir()
+                if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS + (".npz",) and p.name not in ids
+            )
+        return ids
+
+    def _source(self, ref_id: str):
+        """ID の参照画像 (ReferenceProfile、もしくはRGB画像)"""
+
+        with self._lock:
+            value = self._uploads.get(ref_id)
+        if isinstance(value, ReferenceProfile):
+            return value
+        if value is not None:
+            with instrument.stage("decode"):
+                return imagefile.decode(value)
+        if self.directory is not None and ref_id == Path(ref_id).name:
+            path = self.directory / ref_id
+            if path.is_file():
+                if path.suffix.lower() == ".npz":
+                    return ReferenceProfile.load(path)
+                with instrument.stage("decode"):
+                    return imagefile.read(path)
+        raise UnknownReferenceError(ref_id)
+
+    def profile(self, ref_id: str, method: str, mode: str, **options) -> ReferenceProfile:
+        """
+        参照プロファイルを取得 (キャッシュに無い場合は参照画像から計算する)
+
+        引数:
+            options: fit_reference() のオプション引数 (fit_scale 等)
+        """
+
+        key = (ref_id, method, mode, tuple(sorted(options.items())))
+        with self._lock:
+            if key in self._profiles:
+                self.hits += 1
+                self._profiles.move_to_end(key)
+                return self._profiles[key]
+            lock = self._fitting.setdefault(key, threading.Lock())
+
+        with lock:
+            with self._lock:
+                if key in self._profiles:
+                    # 他のスレッドが計算し終えるのを待った場合も、最近使われたものとして扱う
+                    self.hits += 1
+                    self._profiles.move_to_end(key)
+                    return self._profiles[key]
+                self.misses += 1
+            try:
+                source = self._source(ref_id)
+                if isinstance(source, ReferenceProfile):
+                    profile = source
+                else:
+                    profile = fit_reference(source, method, mode, **options)
+                with self._lock:
+                    self._profiles[key] = profile
+                    while len(self._profiles) > self.cache_size:
+                        self._profiles.popitem(last=False)
+            finally:
+                with self._lock:
+                    self._fitting.pop(key, None)
+        return profile
+
+    def stats(self) -> dict:
+        """キャッシュの状態"""
+
+        with self._lock:
+            return {
+                "uploads": len(self._uploads),
+                "profiles": len(self._profiles),
+                "cache_size": self.cache_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def _options(query: dict, types: dict) -> dict:
+    """クエリ文字列から指定された名前のオプションを型を変換して取り出す"""
+
+    options = {}
+    for name, cast in types.items():
+        if name in query:
+            try:
+                options[name] = cast(query[name])
+            except ValueError:
+                raise ValueError(f"{name} の値が不正です: {query[name]}") from None
+    return options
+
+
+class MatchServer(ThreadingHTTPServer):
+    """
+    カラーマッチングの HTTP サーバ
+
+    引数:
+        address: (ホスト, ポート)
+        store: 参照画像と参照プロファイルのキャッシュ
+        workers: 同時にカラーマッチングするリクエスト数の上限 (None の場合は CPU コア数)
+        max_mb: リクエストの本文の最大サイズ [MB]
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple, store: ReferenceStore, workers: int = None, max_mb: float = 512):
+        super().__init__(address, _Handler)
+        self.store = store
+        self.workers = workers or os.cpu_count() or 1
+        self.slots = threading.BoundedSemaphore(self.workers)
+        self.max_bytes = int(max_mb * (1 << 20))
+        self.active = 0
+        self.served = 0
+        self._counter_lock = threading.Lock()
+
+    def match(self, data: bytes, query: dict) -> tuple:
+        """
+        入力画像のファイルの内容をカラーマッチングして、指定の形式のファイルの内容に変換
+
+        戻り値:
+            (画像ファイルの内容, 拡張子)
+        """
+
+        if "ref" not in query:
+            raise ValueError("ref (参照画像の ID) を指定してください")
+        method = query.get("method", "mkl")
+        mode = query.get("mode", "rgb")
+        if method not in METHODS:
+            raise ValueError(f"不明な方法: {method}")
+        if mode not in MODES:
+            raise ValueError(f"不明なモード: {mode}")
+        ext = query.get("format", ".png").lower()
+        ext = ext if ext.startswith(".") else "." + ext
+        fit_options = _options(query, _FIT_OPTIONS)
+        match_options = _options(query, _MATCH_OPTIONS)
+
+        with self.slots:
+            with self._counter_lock:
+                self.active += 1
+            try:
+                profile = self.store.profile(query["ref"], method, mode, **fit_options)
+                with instrument.stage("decode"):
+                    src_img = imagefile.decode(data)
+                out = match(src_img, profile, method, mode, **fit_options, **match_options)
+                with instrument.stage("encode"):
+                    body = imagefile.encode(out, ext)
+            finally:
+                with self._counter_lock:
+                    self.active -= 1
+                    self.served += 1
+        return body, ext
+
+    def stats(self) -> dict:
+        """サーバの状態"""
+
+        with self._counter_lock:
+            state = {"workers": self.workers, "active": self.active, "served": self.served}
+        return dict(state, backend=utils.get_backend(), references=self.store.stats())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """リクエストごとの処理 (ThreadingHTTPServer によりリクエストごとのスレッドで実行される)"""
+
+    protocol_version = "HTTP/1.1"
+    server_version = "color-match"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/health":
+            self._send_json(200, self.server.stats())
+        elif url.path == "/references":
+            self._send_json(200, {"references": self.server.store.ids()})
+        else:
+            self._send_json(404, {"error": f"不明なパス: {url.path}"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            data = self._read_body()
+            if data is None:
+                return
+            if url.path == "/references":
+                ref_id = self.server.store.add(data, query.get("id"))
+                self._send_json(200, {"id": ref_id})
+            elif url.path == "/match":
+                body, ext = self.server.match(data, query)
+                self._send(200, body, mimetypes.guess_type("x" + ext)[0] or "application/octet-stream")
+            else:
+                self._send_json(404, {"error": f"不明なパス: {url.path}"})
+        except UnknownReferenceError as e:
+            self._send_json(404, {"error": f"参照画像が登録されていません: {e.args[0]}"})
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+        except Exception as e:
+            self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+    def _read_body(self):
+        """リクエストの本文 (エラーの場合は応答を返して None)"""
+
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self._send_json(411, {"error": "Content-Length を指定してください"})
+            return None
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self._send_json(400, {"error": f"Content-Length が不正です: {self.headers.get('Content-Length')}"})
+            self.close_connection = True
+            return None
+        if length > self.server.max_bytes:
+            self._send_json(413, {"error": f"本文が大きすぎます: {length} bytes"})
+            self.close_connection = True
+            return None
+        return self.rfile.read(length)
+
+    def _send(self, status: int, body: bytes, content_type: str) -> None:
+        """応答を返す (本文は _WRITE_CHUNK ずつ書き出す)"""
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        view = memoryview(body)
+        for i in range(0, len(view), _WRITE_CHUNK):
+            self.wfile.write(view[i:i + _WRITE_CHUNK])
+
+    def _send_json(self, status: int, value: dict) -> None:
+        self._send(status, json.dumps(value, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8")
+
+
+def main(argv=None) -> int:
+    """serve サブコマンドのエントリポイント"""
+
+    # 引数解析
+    p = argparse.ArgumentParser(prog="color-match serve", description="Color Matching (HTTP サーバ)")
+    p.add_argument("--host", default="127.0.0.1", help="待ち受けるアドレス")
+    p.add_argument("--port", type=int, default=8000, help="待ち受けるポート")
+    p.add_argument("--references", help="参照画像のフォルダ (ファイル名を参照画像の ID として利用できる)")
+    p.add_argument("-w", "--workers", type=int, default=None, help="同時にカラーマッチングする数(省略時は CPU コア数)")
+    p.add_argument("--cache-size", type=int, default=64, help="参照画像の統計量のキャッシュの最大件数")
+    p.add_argument("--max-references", type=int, default=256, help="アップロードされた参照画像を保持する最大件数")
+    p.add_argument("--max-mb", type=float, default=512, help="リクエストの本文の最大サイズ[MB]")
+    p.add_argument(
+        "--backend", choices=utils.BACKENDS, default="auto",
+        help="RGB <-> Lab 変換のバックエンド (auto は利用可能なものから最も速いものを計測して選択)",
+    )
+    args = p.parse_args(argv)
+
+    if args.references and not os.path.isdir(args.references):
+        p.error(f"参照画像のフォルダが見つかりません: {args.references}")
+    utils.set_backend(args.backend)
+    # バックエンドの自動選択は最初のリクエストの前に済ませる
+    utils.get_backend()
+
+    store = ReferenceStore(args.references, args.cache_size, args.max_references)
+    server = MatchServer((args.host, args.port), store, args.workers, args.max_mb)
+    host, port = server.server_address[:2]
+    print(f"http://{host}:{port}/ で待ち受けています (同時処理数 {server.workers}, Ctrl+C で終了)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
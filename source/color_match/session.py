@@ -0,0 +1,215 @@
+"""
+同じ入力画像・参照画像の組で手法・モードを切り替えながらカラーマッチングする
+
+手法・モードの間で共通の中間結果 (Lab画像、ヒストグラム、平均・分散共分散行列、色変換、
+複合法の途中結果等) を必要になった時点で計算して保持し、メモリ使用量の上限を超えた場合は
+最も長く使われていないものから破棄する
+"""
+
+from collections import OrderedDict
+import numpy as np
+from . import utils
+from . import _MODULES, _stages, _check_mode, _fit_stats, _transformer
+from .reference import ReferenceProfile
+
+
+def _kind(name: str) -> str:
+    """処理段の統計量の種類 (Reinhard / MVGD / MKL は同じ平均・分散共分散行列を使う)"""
+
+    return {"hm": "hist", "sliced-ot": "samples"}.get(name, "moments")
+
+
+def _nbytes(value) -> int:
+    """キャッシュする値(配列、もしくは配列の dict / list / tuple)のメモリ使用量"""
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+
+class MatchSession:
+    """
+    入力画像と参照画像の組に対するカラーマッチング
+
+    例えば lab モードの入力画像・参照画像のLab変換は全ての手法で1度だけ、
+    平均・分散共分散行列は Reinhard / MVGD / MKL で、1段目の HM の色変換と適用結果は
+    HM / HM-MVGD-HM / HM-MKL-HM で共有する為、全ての手法・モードを試しても
+    最も重い手法を1回実行する程度の計算量で済む
+
+    スレッドセーフではない (複数のスレッドから使う場合は呼び出し側で排他する)
+    """
+
+    def __init__(self, src_img: np.ndarray, ref_img: np.ndarray,
+                 fit_scale: float = None, max_fit_pixels: int = None,
+                 sample_tol: float = None, sampling: str = "random", max_mb: float = 1024,
+                 ot_iterations: int = None, ot_tol: float = None):
+        """
+        引数:
+            src_img: 入力画像 (RGB, uint8 / uint16 / float)
+            ref_img: 参照画像 (RGB, uint8 / uint16 / float)
+            fit_scale / max_fit_pixels / sample_tol / sampling: match() を参照
+            max_mb: 中間結果のキャッシュのメモリ使用量の上限 [MB]
+            ot_iterations / ot_tol: match() を参照
+        """
+
+        self.src_img = src_img
+        self.ref_img = ref_img
+        self.sample_tol = sample_tol
+        self.sampling = sampling
+        self.max_bytes = int(max_mb * (1 << 20))
+        self.ot_iterations = ot_iterations
+        self.ot_tol = ot_tol
+
+        # 画像の種類 -> RGB画像 (統計量の推定用の縮小画像が入力画像と同じ場合は "src" を共有する)
+        proxy = utils.downscale(src_img, fit_scale, max_fit_pixels)
+        self._images = {
+            "src": src_img,
+            "fit": proxy,
+            "ref": utils.downscale(ref_img, fit_scale, max_fit_pixels),
+        }
+        self._fit_side = "src" if proxy is src_img else "fit"
+
+        self._cache = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self) -> None:
+        """キャッシュした中間結果を全て破棄"""
+
+        self._cache.clear()
+        self.nbytes = 0
+
+    def _get(self, key: tuple, compute):
+        """
+        中間結果をキャッシュから取得 (無ければ compute() で計算してキャッシュ)
+
+        上限を超えた場合は最も長く使われていないものから破棄する
+        (上限より大きい値はキャッシュしない)
+        """
+
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return self._cache[key]
+        self.misses += 1
+        value = compute()
+        size = _nbytes(value)
+        if size <= self.max_bytes:
+            self._cache[key] = value
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, old = self._cache.popitem(last=False)
+                self.nbytes -= _nbytes(old)
+        return value
+
+    def _lab(self, side: str) -> np.ndarray:
+        """Lab画像 (読み取り専用、from_workspace() に渡す場合は複製する)"""
+
+        return self._get(("lab", side), lambda: utils.to_workspace(self._images[side], "lab")[1])
+
+    def _work(self, side: str, mode: str) -> np.ndarray:
+        """処理対象の色空間の画素 (to_workspace() を参照)"""
+
+        if mode == "rgb":
+            return utils.to_workspace(self._images[side], mode)[0]
+        return self._lab(side)[..., :1]
+
+    def _bins(self, side: str) -> int:
+        """HM のヒストグラムのビン数 (画像の型で決まる)"""
+
+        return utils.levels(self._images[side])
+
+    def _ref_stats(self, name: str, mode: str) -> dict:
+        """参照画像の統計量 (fit_reference() と同じ)"""
+
+        def _compute():
+            bins = self._bins("ref")
+            if self.sample_tol is None:
+                return _fit_stats(_MODULES[name], self._work("ref", mode), None, self.sampling, bins=bins)
+            # 抽出した画素のみ処理対象の色空間に変換する
+            return _fit_stats(_MODULES[name], self._images["ref"], self.sample_tol, self.sampling, mode, bins)
+
+        return self._get(("stats", "ref", mode, _kind(name)), _compute)
+
+    def _transform(self, mode: str, stages: tuple) -> dict:
+        """stages[:-1] の色変換を適用した縮小画像の統計量から求めた stages[-1] の処理段の色変換"""
+
+        def _compute():
+            name = stages[-1]
+            module = _MODULES[name]
+            x = self._chain(self._fit_side, mode, stages[:-1])
+            src_stats = self._get(
+                ("stats", self._fit_side, mode, stages[:-1], _kind(name)),
+                lambda: _fit_stats(module, x, self.sample_tol, self.sampling, bins=self._bins("src")),
+            )
+            transform = _transformer(module, self.ot_iterations, self.ot_tol)
+            return transform(src_stats, self._ref_stats(name, mode))
+
+        return self._get(("transform", mode, stages), _compute)
+
+    def _chain(self, side: str, mode: str, stages: tuple) -> np.ndarray:
+        """処理対象の色空間の画素に stages の色変換を順に適用した画素 (読み取り専用)"""
+
+        if not stages:
+            return self._work(side, mode)
+        return self._get(
+            ("chain", side, mode, stages),
+            lambda: _MODULES[stages[-1]].apply(self._chain(side, mode, stages[:-1]), self._transform(mode, stages)),
+        )
+
+    def fit_transforms(self, method: str, mode: str) -> list:
+        """処理段ごとの色変換のリスト (color_match.fit_transforms() と同じ)"""
+
+        _check_mode(mode)
+        stages = _stages(method)
+        return [self._transform(mode, stages[:i + 1]) for i in range(len(stages))]
+
+    def reference(self, method: str, mode: str) -> ReferenceProfile:
+        """参照画像の統計量 (color_match.fit_reference() と同じ)"""
+
+        _check_mode(mode)
+        stages = _stages(method)
+        return ReferenceProfile(method, mode, {name: self._ref_stats(name, mode) for name in stages})
+
+    def _matched(self, method: str, mode: str) -> np.ndarray:
+        """強さ 1 のカラーマッチング結果 (RGB、入力画像と同じ型)"""
+
+        def _compute():
+            stages = _stages(method)
+            transforms = self.fit_transforms(method, mode)
+            # 最後の処理段の適用結果は他の手法と共有しない為、キャッシュせずに適用する
+            x = _MODULES[stages[-1]].apply(self._chain("src", mode, stages[:-1]), transforms[-1])
+            lab = None if mode == "rgb" else self._lab("src").copy()
+            return utils.from_workspace(x, lab, mode, self.src_img.dtype)
+
+        return self._get(("matched", method, mode), _compute)
+
+    def match(self, method: str, mode: str, strength: float = 1.0) -> np.ndarray:
+        """
+        カラーマッチング (color_match.match() と同じ結果)
+
+        戻り値は読み取り専用として扱う (強さ 1 の場合はキャッシュした配列を返す)
+        """
+
+        _check_mode(mode)
+        stages = _stages(method)
+        if not 0.0 <= strength <= 1.0:
+            raise ValueError(f"strength は 0-1 で指定してください: {strength}")
+        if strength == 1.0:
+            return self._matched(method, mode)
+        if strength == 0.0:
+            return self.src_img.copy()
+        if len(stages) > 1:
+            # 複合法は結果を入力画像と合成
+            return utils.blend(self.src_img, self._matched(method, mode), strength)
+
+        # 単一の手法は色変換に強さを反映して適用
+        t = _MODULES[stages[0]].interpolate(self._transform(mode, stages), strength)
+        x = _MODULES[stages[0]].apply(self._work("src", mode), t)
+        lab = None if mode == "rgb" else self._lab("src").copy()
+        return utils.from_workspace(x, lab, mode, self.src_img.dtype)
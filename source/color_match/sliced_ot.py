@@ -0,0 +1,262 @@
+"""
+Sliced Optimal Transport (Sliced OT)実装
+
+ランダムに回転した軸への1次元の射影ごとに分布(分位点)を合わせる処理を反復し、
+チャンネル間の相関を含む色の分布全体を参照画像に近づける
+(HM はチャンネルごとに独立、MVGD / MKL は平均と分散共分散行列のみを合わせる)
+
+- 統計量は画像から抽出した画素 (推定は抽出した画素のみで行い、画像サイズに依存しない)
+- 反復は全ての軸をまとめて行列演算・ソートで計算する
+- 反復ごとの回転と射影した軸上の移動量の表を色変換とし、全画素にも抽出した画素と同じ計算で反復を適用する
+  (8bit の RGB 画像は出現する色ごとに1回だけ計算する)
+"""
+
+import numpy as np
+
+# 統計量として抽出する最大の画素数
+SAMPLES = 1 << 16
+
+# 反復回数と収束判定の許容誤差(0-1、1回の反復での画素の移動量の二乗平均平方根を 255 で割った値)の既定値
+ITERATIONS = 20
+TOL = 0.001
+
+# 射影ごとの写像を表す分位点の数
+_QUANTILES = 256
+
+# 射影した軸上の移動量を平滑化するガウス関数の標準偏差と、その範囲 (0-255 の階調)
+_SIGMA = 1.0
+_PAD = 4.0 * _SIGMA
+
+# 移動量の表の間隔 (0-255 の階調)
+_TABLE_STEP = _SIGMA / 8.0
+
+# 分位点から離れた値で、前後の分位点の移動量の線形補間に切り替える重み
+_EPS = 1e-3
+
+# 全画素に適用する際に一度に計算する画素数
+_CHUNK_PIXELS = 1 << 16
+
+
+def fit(x: np.ndarray) -> dict:
+    """
+    (..., C) の画素から最大 SAMPLES 画素を抽出
+
+    戻り値:
+        {"samples": (n, C), "count": 元の画素数}
+    """
+
+    v = x.reshape(-1, x.shape[-1])
+    count = v.shape[0]
+    index = sample_index(count)
+    if index is not None:
+        v = v[index]
+    return {"samples": v.astype(np.float64), "count": np.array(count)}
+
+
+def sample_index(count: int):
+    """
+    count 画素の画像から抽出する画素の番号 (昇順、count が SAMPLES 以下の場合は None)
+
+    同じ画素数の画像からは常に同じ画素を抽出する
+    (行ストリップ単位で処理する場合も、画像全体の番号から各ストリップの画素を取り出せば同じ画素になる)
+    """
+
+    if count <= SAMPLES:
+        return None
+    return np.sort(np.random.default_rng(0).integers(0, count, SAMPLES))
+
+
+def merge(a: dict, b: dict) -> dict:
+    """分割して計算した統計量を統合 (元の画素数の比で画素を抽出し直す)"""
+
+    count_a = int(a["count"])
+    count_b = int(b["count"])
+    n = min(SAMPLES, len(a["samples"]) + len(b["samples"]))
+    n_a = min(len(a["samples"]), int(round(n * count_a / max(count_a + count_b, 1))))
+    n_b = min(len(b["samples"]), n - n_a)
+
+    def _take(samples, k):
+        return samples[np.linspace(0, len(samples) - 1, k).astype(np.intp)] if k < len(samples) else samples
+
+    samples = np.concatenate([_take(a["samples"], n_a), _take(b["samples"], n_b)])
+    return {"samples": samples, "count": np.array(count_a + count_b)}
+
+
+def distance(a: dict, b: dict) -> float:
+    """2つの統計量の差(0-1、チャンネルごとの 1-99% の分位点の差の最大値を 255 で割った値)"""
+
+    p = np.linspace(0.01, 0.99, 99)
+    qa = np.quantile(a["samples"], p, axis=0)
+    qb = np.quantile(b["samples"], p, axis=0)
+    return float(np.max(np.abs(qa - qb)) / 255.0)
+
+
+def _rotation(rng: np.random.Generator, c: int) -> np.ndarray:
+    """ランダムな (c, c) の直交行列 (行が射影する軸)"""
+
+    q, r = np.linalg.qr(rng.normal(size=(c, c)))
+    # QR 分解の符号の不定性を除き、一様な分布にする
+    return (q * np.sign(np.diag(r))).T
+
+
+def _quantiles(p: np.ndarray) -> np.ndarray:
+    """射影した値 (n, C) の軸ごとの _QUANTILES 個の分位点 (_QUANTILES, C) (全ての軸をまとめてソートする)"""
+
+    s = np.sort(p, axis=0)
+    idx = ((np.arange(_QUANTILES) + 0.5) * (len(s) / _QUANTILES)).astype(np.intp)
+    return s[idx]
+
+
+def _table(src_q: np.ndarray, ref_q: np.ndarray) -> tuple:
+    """
+    1つの軸の分位点 (_QUANTILES,) から、射影した値ごとの移動量の表を求める
+
+    分位点ごとの移動量(参照画像の分位点 - 入力画像の分位点)をガウス関数で重み付けして平均し(標準偏差 _SIGMA)、
+    間隔 _TABLE_STEP の表にする
+    単色の領域が広い画像等では入力画像の分位点が同じ値に重なり、分位点の間を区分線形に写すと写像が不連続(急峻)になって
+    わずかな値の差(float32 の丸め誤差等)が反復で増幅される為、写像を分位点の値に対して連続かつなだらかにする
+    (重なった分位点には、その分位点の移動量の平均が割り当てられる)
+    分位点から離れた値(分位点の間の広い隙間)の移動量は、前後の分位点の移動量を線形補間した値に近づける
+
+    戻り値:
+        (表の始点の値, 移動量の表 (n,))
+    """
+
+    lo = src_q[0] - _PAD
+    n = int((src_q[-1] - src_q[0] + 2.0 * _PAD) / _TABLE_STEP) + 2
+    delta = ref_q - src_q
+
+    # 分位点を前後の表の点に線形に振り分けて(分位点の値に対して連続にする)、ガウス関数を畳み込む
+    f = (src_q - lo) / _TABLE_STEP
+    i = f.astype(np.intp)
+    w = f - i
+    weight = np.bincount(i, 1.0 - w, n) + np.bincount(i + 1, w, n)
+    total = np.bincount(i, (1.0 - w) * delta, n) + np.bincount(i + 1, w * delta, n)
+    kernel = np.exp(-0.5 * (np.arange(-_PAD, _PAD + _TABLE_STEP / 2, _TABLE_STEP) / _SIGMA) ** 2)
+    weight = np.convolve(weight, kernel, "same")
+    total = np.convolve(total, kernel, "same")
+
+    linear = np.interp(lo + np.arange(n) * _TABLE_STEP, src_q, delta)
+    return lo, (total + _EPS * linear) / (weight + _EPS)
+
+
+def _step(x: np.ndarray, rot: np.ndarray, lo: np.ndarray, table: np.ndarray) -> np.ndarray:
+    """
+    1回の反復の写像による (n, C) の画素の移動量
+
+    rot で回転した軸に射影した値の移動量を軸ごとの表 table (C, n) から線形補間し、元の色空間に戻す
+    (表の範囲外の値は表の端と同じだけ移動する)
+    """
+
+    # 軸ごとの値を連続したメモリに置く
+    p = rot @ x.T
+    last = table.shape[1] - 1
+    for ch in range(len(p)):
+        f = p[ch]
+        f -= lo[ch]
+        f *= 1.0 / _TABLE_STEP
+        np.clip(f, 0.0, last, out=f)
+        i = np.minimum(f.astype(np.intp), last - 1)
+        f -= i
+        d = table[ch]
+        f *= d[i + 1] - d[i]
+        f += d[i]
+    return (rot.T @ p).T
+
+
+def transform(src_stats: dict, ref_stats: dict, iterations: int = None, tol: float = None) -> dict:
+    """
+    入力画像と参照画像の抽出した画素から Sliced OT の写像を求める
+
+    反復ごとにランダムな直交行列で回転した軸へ両方の画素を射影し、軸ごとの分位点を合わせるように
+    入力画像の画素を移動する (画素の移動量が tol 以下になるか、iterations 回反復したら終了)
+
+    引数:
+        iterations: 最大の反復回数 (None の場合は ITERATIONS)
+        tol: 収束判定の許容誤差(0-1、None の場合は TOL)
+
+    戻り値:
+        {"rot": 反復ごとの回転 (k, C, C), "lo": 反復ごとの移動量の表の始点 (k, C),
+         "table": 反復ごとの移動量の表 (k, C, n), "strength": 写像の強さ ()}
+    """
+
+    iterations = ITERATIONS if iterations is None else iterations
+    tol = TOL if tol is None else tol
+    if iterations < 1:
+        raise ValueError(f"反復回数は 1 以上で指定してください: {iterations}")
+
+    x = src_stats["samples"].astype(np.float64)
+    ref = ref_stats["samples"]
+    c = x.shape[1]
+
+    rng = np.random.default_rng(0)
+    rots, los, tables = [], [], []
+    for _ in range(iterations):
+        rot = _rotation(rng, c)
+        src_q = _quantiles(x @ rot.T)
+        ref_q = _quantiles(ref @ rot.T)
+        lo, table = zip(*(_table(src_q[:, ch], ref_q[:, ch]) for ch in range(c)))
+        rots.append(rot)
+        los.append(np.array(lo))
+        tables.append(_pad(table))
+
+        # 全画素に適用する場合と同じ計算で移動する
+        delta = _step(x, rot, los[-1], tables[-1])
+        x += delta
+
+        if np.sqrt(np.mean(delta ** 2)) <= tol * 255.0:
+            break
+
+    return {"rot": np.stack(rots), "lo": np.stack(los), "table": _pad(tables), "strength": np.array(1.0)}
+
+
+def _pad(tables) -> np.ndarray:
+    """
+    最後の軸の長さが異なる表を最長の表に揃えて1つの配列にする
+
+    末尾は最後の値で埋める (表の範囲外の値と同じ移動量になる為、適用結果は変わらない)
+    """
+
+    n = max(t.shape[-1] for t in tables)
+    return np.stack([np.pad(t, [(0, 0)] * (t.ndim - 1) + [(0, n - t.shape[-1])], mode="edge") for t in tables])
+
+
+def _transport(v: np.ndarray, t: dict) -> np.ndarray:
+    """(n, C) の画素に反復ごとの写像を順に適用 (_CHUNK_PIXELS 画素ずつ、中間配列をキャッシュに収める)"""
+
+    rot = t["rot"].astype(np.float64)
+    lo = t["lo"].astype(np.float64)
+    table = t["table"].astype(np.float64)
+    out = np.empty(v.shape, dtype=t["table"].dtype)
+    for i in range(0, len(v), _CHUNK_PIXELS):
+        x = v[i:i + _CHUNK_PIXELS].astype(np.float64)
+        origin = x.copy()
+        for k in range(len(rot)):
+            x += _step(x, rot[k], lo[k], table[k])
+        if t["strength"] != 1.0:
+            x = origin + t["strength"] * (x - origin)
+        out[i:i + _CHUNK_PIXELS] = x
+    return out
+
+
+def apply(x: np.ndarray, t: dict) -> np.ndarray:
+    """
+    (..., C) の画素に写像を適用 (抽出した画素の反復と同じ計算を全画素に行う)
+
+    8bit の RGB 画像は出現する色ごとに1回だけ計算する (写真でも色の種類は画素数より十分少ない)
+    """
+
+    c = x.shape[-1]
+    v = x.reshape(-1, c)
+    if x.dtype == np.uint8 and c == 3:
+        code = (v[:, 0].astype(np.int32) << 16) | (v[:, 1].astype(np.int32) << 8) | v[:, 2]
+        code, inverse = np.unique(code, return_inverse=True)
+        colors = np.stack([code >> 16, (code >> 8) & 0xFF, code & 0xFF], axis=1)
+        return _transport(colors, t)[inverse.reshape(-1)].reshape(x.shape)
+    return _transport(v, t).reshape(x.shape)
+
+
+def interpolate(t: dict, strength: float) -> dict:
+    """写像による移動量を strength(0-1) 倍にする (適用の計算量は変わらない)"""
+
+    return dict(t, strength=np.asarray(t["strength"] * strength, dtype=t["strength"].dtype))
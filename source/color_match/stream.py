@@ -0,0 +1,182 @@
+"""
+大きな画像の行ストリップ単位のカラーマッチング
+
+統計量の計算(1パス目)と色変換の適用(2パス目)を行ストリップごとに行い、
+作業メモリを画像サイズに関係なく tile_mb 程度に抑える
+"""
+
+import numpy as np
+from . import utils
+from . import instrument
+from . import imagefile
+from . import _MODULES, _name, _fitter, _transformer, _stages, _check_mode, _check_dtype, _check_profile, _apply_transforms, _finish
+from .reference import ReferenceProfile
+
+# 1画素あたりの作業メモリの目安 (float64 の中間配列数個分)
+_WORK_BYTES_PER_PIXEL = 128
+
+
+def strip_rows(width: int, tile_mb: float) -> int:
+    """作業メモリが tile_mb [MB] に収まるストリップの行数"""
+
+    return max(1, int(tile_mb * 1024 * 1024) // (width * _WORK_BYTES_PER_PIXEL))
+
+
+def iter_strips(height: int, rows: int):
+    """画像を rows 行ずつに分割したスライスを列挙"""
+
+    for y0 in range(0, height, rows):
+        yield slice(y0, min(height, y0 + rows))
+
+
+def open_image(path: str) -> np.ndarray:
+    """
+    画像を読み込み
+
+    .npy ファイル((H, W, 3) の uint8 / uint16 / float 配列)はメモリマップで開く為、
+    ストリップごとに必要な部分のみ読み込まれる
+    それ以外の形式は imagefile.read() で全体を読み込む
+    """
+
+    if path.lower().endswith(".npy"):
+        return imagefile.read(path, mmap=True)
+    with instrument.stage("decode"):
+        return imagefile.read(path)
+
+
+def _apply_stages(img: np.ndarray, stages: tuple, transforms: list, mode: str,
+                  strength: float = 1.0, dtype=np.float64) -> np.ndarray:
+    """RGB画像に処理段ごとの色変換を順に適用"""
+
+    work, lab = utils.to_workspace(img, mode, dtype)
+    return _finish(img, work, lab, stages, transforms, mode, strength, dtype)
+
+
+def _fit_strips(img: np.ndarray, module, mode: str, rows: int,
+                stages: tuple = (), transforms: list = ()) -> dict:
+    """ストリップごとに統計量を計算して統合 (先に stages の色変換を適用する)"""
+
+    if _name(module) == "sliced-ot":
+        return _sample_strips(img, module, mode, rows, stages, transforms)
+
+    # HM のビン数は画像の型で決める (全てのストリップで同じビン数にする)
+    fit = _fitter(module, utils.levels(img))
+    stats = None
+    for sl in iter_strips(img.shape[0], rows):
+        work, _ = utils.to_workspace(np.asarray(img[sl]), mode)
+        x = _apply_transforms(work, stages, transforms)
+        with instrument.stage(f"stats:{_name(module)}"):
+            s = fit(x)
+        stats = s if stats is None else module.merge(stats, s)
+    return stats
+
+
+def _sample_strips(img: np.ndarray, module, mode: str, rows: int,
+                   stages: tuple = (), transforms: list = ()) -> dict:
+    """
+    Sliced OT の統計量(抽出した画素)をストリップ単位で計算
+
+    画像全体から抽出する画素の番号を先に決めてストリップごとに取り出す為、
+    画像全体を一度に処理する場合(color_match.match())と同じ画素になり、同じ色変換が求まる
+    """
+
+    width = img.shape[1]
+    count = img.shape[0] * width
+    index = module.sample_index(count)
+    parts = []
+    for sl in iter_strips(img.shape[0], rows):
+        pixels = np.asarray(img[sl]).reshape(-1, 1, img.shape[-1])
+        if index is not None:
+            lo, hi = np.searchsorted(index, [sl.start * width, sl.stop * width])
+            pixels = pixels[index[lo:hi] - sl.start * width]
+        work, _ = utils.to_workspace(pixels, mode)
+        x = _apply_transforms(work, stages, transforms)
+        with instrument.stage(f"stats:{_name(module)}"):
+            parts.append(x.reshape(-1, x.shape[-1]).astype(np.float64))
+    return {"samples": np.concatenate(parts), "count": np.array(count)}
+
+
+def fit_reference(ref_img: np.ndarray, method: str, mode: str, tile_mb: float = 256) -> ReferenceProfile:
+    """参照画像の統計量をストリップ単位で計算"""
+
+    _check_mode(mode)
+    rows = strip_rows(ref_img.shape[1], tile_mb)
+    stats = {}
+    for name in _stages(method):
+        if name not in stats:
+            stats[name] = _fit_strips(ref_img, _MODULES[name], mode, rows)
+    return ReferenceProfile(method, mode, stats)
+
+
+def match(src_img: np.ndarray, ref, method: str, mode: str,
+          out: np.ndarray = None, tile_mb: float = 256, strength: float = 1.0,
+          dtype=np.float64, ot_iterations: int = None, ot_tol: float = None) -> np.ndarray:
+    """
+    ストリップ単位でカラーマッチング
+
+    複合法では処理段ごとに、それまでの処理段の色変換を適用したストリップから統計量を計算する為、
+    入力画像を (処理段の数 + 1) 回走査する
+
+    引数:
+        src_img: 入力画像 (uint8 / uint16 / float、メモリマップ可)
+        ref: 参照画像 (メモリマップ可)、もしくは ReferenceProfile
+        out: 出力先の配列 (入力画像と同じ型、メモリマップ可、None の場合は新たに確保)
+        tile_mb: ストリップごとの作業メモリの上限の目安 [MB]
+        strength / dtype / ot_iterations / ot_tol: color_match.match() を参照
+            (dtype は色変換の適用のみ、統計量の計算は float64)
+    """
+
+    _check_mode(mode)
+    dtype = _check_dtype(dtype)
+    if not 0.0 <= strength <= 1.0:
+        raise ValueError(f"strength は 0-1 で指定してください: {strength}")
+    stages = _stages(method)
+    if isinstance(ref, ReferenceProfile):
+        profile = ref
+        _check_profile(profile, method, mode)
+    else:
+        profile = fit_reference(ref, method, mode, tile_mb)
+
+    rows = strip_rows(src_img.shape[1], tile_mb)
+
+    # 1パス目: 処理段ごとに統計量を計算して色変換を求める
+    transforms = []
+    for i, name in enumerate(stages):
+        module = _MODULES[name]
+        src_stats = _fit_strips(src_img, module, mode, rows, stages[:i], transforms)
+        with instrument.stage(f"transform:{name}"):
+            transforms.append(_transformer(module, ot_iterations, ot_tol)(src_stats, profile.stats[name]))
+
+    # 2パス目: 色変換を適用
+    if out is None:
+        out = np.empty(src_img.shape, dtype=src_img.dtype)
+    for sl in iter_strips(src_img.shape[0], rows):
+        out[sl] = _apply_stages(np.asarray(src_img[sl]), stages, transforms, mode, strength, dtype)
+    return out
+
+
+def match_file(src_path: str, ref, out_path: str, method: str, mode: str, tile_mb: float = 256,
+               strength: float = 1.0, dtype=np.float64, ot_iterations: int = None, ot_tol: float = None) -> None:
+    """
+    画像ファイルをストリップ単位でカラーマッチングして保存
+
+    入力・出力が .npy ファイルの場合はメモリマップで読み書きする為、
+    メモリ使用量は画像サイズに関係なく tile_mb 程度に収まる
+    (それ以外の形式は画像全体を保持するが、float64 の中間配列はストリップ単位になる)
+
+    引数:
+        ref: 参照画像パス、もしくは ReferenceProfile
+    """
+
+    src_img = open_image(src_path)
+    if not isinstance(ref, ReferenceProfile):
+        ref = fit_reference(open_image(ref), method, mode, tile_mb)
+
+    if out_path.lower().endswith(".npy"):
+        out = np.lib.format.open_memmap(out_path, mode="w+", dtype=src_img.dtype, shape=src_img.shape)
+        match(src_img, ref, method, mode, out, tile_mb, strength, dtype, ot_iterations, ot_tol)
+        out.flush()
+    else:
+        out = match(src_img, ref, method, mode, None, tile_mb, strength, dtype, ot_iterations, ot_tol)
+        with instrument.stage("encode"):
+            imagefile.write(out, out_path)
@@ -2,98 +2,289 @@
 カラーマッチング用ユーティリティ関数
 """
 
+import time
 import numpy as np
+from . import instrument
+
+# ==================================================
+# RGB <-> Lab 変換のバックエンド
+# ==================================================
+# Labの範囲は全てのバックエンドで L:0-255, a:0-255, b:0-255 (a, b は +128 したもの) に揃える
+# (hm 等はLチャネルを 0-255 の256段階のビンで扱う為)
+# 入力の RGB は uint8 / uint16、もしくは to_float() で 0-255 のスケールに変換した浮動小数点 (float の画像)
+
+BACKENDS = ("auto", "skimage", "cv2", "numpy")
+
+# 選択中のバックエンド名と、その変換関数 (rgb2lab, lab2rgb) (auto は最初の変換時に決定)
+_backend_name = "auto"
+_backend_funcs = None
+
+# auto で選択したバックエンド名 (計測はプロセスごとに1度だけ行う)
+_auto_backend = None
+
+
+def _rgb_max(rgb: np.ndarray) -> float:
+    """rgb2lab() の入力の白の値 (uint16 は 65535、uint8 と float は 0-255 のスケールの為 255)"""
+
+    return 65535.0 if rgb.dtype == np.uint16 else 255.0
+
+
+def _skimage_backend() -> tuple:
+    """scikit-image による変換関数"""
 
-try:
-    # scikit-imageを利用
     import skimage.color
 
-    def rgb2lab(rgb: np.ndarray) -> np.ndarray:
-        """sRGB (uint8, 0-255) -> Lab"""
+    def rgb2lab(rgb: np.ndarray, dtype=np.float64) -> np.ndarray:
+        """sRGB (uint8、もしくは 0-255 のスケールの float) -> Lab"""
+
+        # sRGB(0-1) -> Lab(L:0-100, a:-128~127, b:-128~127) (除算で float64 になる為、型変換のコピーは作らない)
+        lab = skimage.color.rgb2lab(rgb / _rgb_max(rgb))
 
-        # 入力を float に正規化 (0-1)
-        rgb_f = rgb.astype(np.float64)
-        rgb_f = rgb_f / 255.0
+        # Labの範囲を0～255にリスケール
+        lab[..., 0] *= 255.0 / 100.0
+        lab[..., 1:] += 128.0
+        return lab.astype(dtype, copy=False)
 
-        # sRGB -> Lab
-        return skimage.color.rgb2lab(rgb_f).astype(np.float64)
+    def lab2rgb(lab: np.ndarray, dtype=np.uint8) -> np.ndarray:
+        """Lab -> sRGB (0-255)"""
+
+        # Lab(0-255) -> Lab(L:0-100, a:-128~127, b:-128~127)
+        lab = lab.astype(np.float64)
+        lab[..., 0] *= 100.0 / 255.0
+        lab[..., 1:] -= 128.0
 
-    def lab2rgb(lab: np.ndarray) -> np.ndarray:
-        """Lab -> sRGB (uint8, 0-255)"""
-        
         # Lab -> sRGB
         rgb_f = skimage.color.lab2rgb(lab)
 
-        # uint8 に変換
-        rgb_f = np.clip(rgb_f, 0.0, 1.0)
-        rgb_u8 = (rgb_f * 255.0).astype(np.uint8)
-        return rgb_u8
-    
-except ImportError:
-    try:
-        # OpenCV2を利用
-        import cv2
-        
-        def rgb2lab(rgb: np.ndarray) -> np.ndarray:
-            """sRGB (uint8, 0-255) -> Lab"""
-
-            # convert RGB -> Lab (OpenCVの出力するLabの範囲はL:0-255, a:0-255, b:0-255)
-            lab = cv2.cvtColor(rgb, cv2.COLOR_RGB2LAB).astype(np.float64)
-            return lab
-        
-        def lab2rgb(lab: np.ndarray) -> np.ndarray:
-            """Lab -> sRGB (uint8, 0-255)"""
-
-            rgb = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB)
-            return rgb
-        
-    except ImportError:
-        # NumPy のみで RGB <-> Lab 変換を実装
-
-        def rgb2lab(rgb: np.ndarray) -> np.ndarray:
-            """sRGB (uint8, 0-255) -> Lab"""
-            
-            # 入力を float に正規化 (0-1)
-            rgb_f = rgb.astype(np.float64)
-            rgb_f = rgb_f / 255.0
-
-            # sRGB -> linear RGB
-            rgb_linear = sRGBtoRGB(rgb_f)
-            
-            # RGB -> XYZ
-            xyz = RGBtoXYZ(rgb_linear)
-
-            # XYZ -> Lab(L:0-100, a:-128~127, b:-128~127)
-            L, a, b = XYZtoLab(xyz)
-
-            # Labの範囲を0～255にリスケール
-            L = L * (255.0 / 100.0)
-            a = a + 128.0
-            b = b + 128.0
-            
-            return np.stack([L, a, b], axis=-1)
-        
-        def lab2rgb(lab: np.ndarray) -> np.ndarray:
-            """Lab -> sRGB (uint8, 0-255)"""
-
-            # Lab(L:0-100, a:-128~127, b:-128~127)
-            lab = lab.astype(np.float64)
-            L = lab[..., 0] * (100.0 / 255.0)
-            a = lab[..., 1] - 128.0
-            b = lab[..., 2] - 128.0
-
-            # Lab -> XYZ
-            xyz = LabtoXYZ(L, a, b)
-            
-            # XYZ -> RGB
-            rgb_linear = XYZtoRGB(xyz)
-
-            # linear RGB -> sRGB
-            rgb_f = RGBtosRGB(rgb_linear)
-            
-            # uint8 に変換 (0-255)
-            rgb_u8 = np.clip(rgb_f * 255.0, 0, 255).astype(np.uint8)
-            return rgb_u8
+        # uint8 (もしくは float) に変換
+        np.clip(rgb_f, 0.0, 1.0, out=rgb_f)
+        rgb_f *= 255.0
+        return rgb_f.astype(dtype, copy=False)
+
+    return rgb2lab, lab2rgb
+
+
+def _cv2_backend() -> tuple:
+    """OpenCV による変換関数"""
+
+    import cv2
+
+    def rgb2lab(rgb: np.ndarray, dtype=np.float64) -> np.ndarray:
+        """sRGB (uint8、もしくは 0-255 のスケールの float) -> Lab"""
+
+        # OpenCVは (H, W, 3) の float32 のみ受け付ける (uint8 では出力のLabも8bitに量子化される)
+        rgb_f = rgb.reshape(-1, 1, 3).astype(np.float32)
+        rgb_f *= 1.0 / _rgb_max(rgb)
+        lab = cv2.cvtColor(rgb_f, cv2.COLOR_RGB2LAB).astype(dtype, copy=False).reshape(rgb.shape)
+
+        # Lab(L:0-100, a:-128~127, b:-128~127) を0～255にリスケール
+        lab[..., 0] *= 255.0 / 100.0
+        lab[..., 1:] += 128.0
+        return lab
+
+    def lab2rgb(lab: np.ndarray, dtype=np.uint8) -> np.ndarray:
+        """Lab -> sRGB (0-255)"""
+
+        # Lab(0-255) -> Lab(L:0-100, a:-128~127, b:-128~127)
+        lab_f = lab.reshape(-1, 1, 3).astype(np.float32)
+        lab_f[..., 0] *= 100.0 / 255.0
+        lab_f[..., 1:] -= 128.0
+
+        # Lab -> sRGB(0-1) -> uint8 (もしくは float)
+        rgb_f = cv2.cvtColor(lab_f, cv2.COLOR_LAB2RGB)
+        np.clip(rgb_f, 0.0, 1.0, out=rgb_f)
+        rgb_f *= 255.0
+        return rgb_f.astype(dtype, copy=False).reshape(lab.shape)
+
+    return rgb2lab, lab2rgb
+
+
+def _numpy_backend() -> tuple:
+    """NumPy のみによる変換関数 (表の参照で高速化)"""
+
+    def rgb2lab(rgb: np.ndarray, dtype=np.float64) -> np.ndarray:
+        """sRGB (uint8、もしくは 0-255 のスケールの float) -> Lab"""
+
+        # uint8 / uint16 は表の参照、float の画像は定義式で計算する
+        if rgb.dtype == np.uint8:
+            convert = _rgb2lab_lut
+        elif rgb.dtype == np.uint16:
+            table = _srgb16_to_linear()
+            convert = lambda chunk: _rgb2lab_lut(chunk, table)
+        else:
+            convert = rgb2lab_exact
+
+        # 計算は小さなチャンク単位で float64 で行い、出力のみ dtype にする
+        src = rgb.reshape(-1, 3)
+        out = np.empty(src.shape, dtype=dtype)
+        for i in range(0, src.shape[0], _LAB_CHUNK_PIXELS):
+            out[i:i + _LAB_CHUNK_PIXELS] = convert(src[i:i + _LAB_CHUNK_PIXELS])
+        return out.reshape(rgb.shape)
+
+    def lab2rgb(lab: np.ndarray, dtype=np.uint8) -> np.ndarray:
+        """Lab -> sRGB (0-255)"""
+
+        # uint8 は表の参照、float (16bit / float の画像) は定義式で計算する
+        convert = _lab2rgb_lut if dtype == np.uint8 else _lab2rgb_float
+        src = lab.reshape(-1, 3)
+        out = np.empty(src.shape, dtype=dtype)
+        for i in range(0, src.shape[0], _LAB_CHUNK_PIXELS):
+            out[i:i + _LAB_CHUNK_PIXELS] = convert(src[i:i + _LAB_CHUNK_PIXELS])
+        return out.reshape(lab.shape)
+
+    return rgb2lab, lab2rgb
+
+
+_BACKEND_LOADERS = {
+    "skimage": _skimage_backend,
+    "cv2": _cv2_backend,
+    "numpy": _numpy_backend,
+}
+
+
+def available_backends() -> list:
+    """インストールされていて利用可能なバックエンド名の一覧"""
+
+    names = []
+    for name, loader in _BACKEND_LOADERS.items():
+        try:
+            loader()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def _select_fastest_backend() -> str:
+    """利用可能なバックエンドの RGB -> Lab -> RGB の変換時間を計測し、最も速いバックエンド名を返す"""
+
+    img = np.random.default_rng(0).integers(0, 256, (256, 256, 3), dtype=np.uint8)
+    best_name, best_time = "numpy", float("inf")
+    for name in available_backends():
+        rgb2lab, lab2rgb = _BACKEND_LOADERS[name]()
+        lab2rgb(rgb2lab(img))  # 初回の呼び出しのオーバーヘッドを除く
+        elapsed = float("inf")
+        for _ in range(3):
+            start = time.perf_counter()
+            lab2rgb(rgb2lab(img))
+            elapsed = min(elapsed, time.perf_counter() - start)
+        if elapsed < best_time:
+            best_name, best_time = name, elapsed
+    return best_name
+
+
+def set_backend(name: str) -> None:
+    """
+    RGB <-> Lab 変換のバックエンドを選択
+
+    引数:
+        name: auto / skimage / cv2 / numpy
+              auto は利用可能なバックエンドを最初の変換時に計測し、最も速いものを選択する
+    """
+
+    global _backend_name, _backend_funcs
+    if name not in BACKENDS:
+        raise ValueError(f"不明なバックエンド: {name}")
+    if name == "auto":
+        _backend_funcs = None
+    else:
+        try:
+            _backend_funcs = _BACKEND_LOADERS[name]()
+        except ImportError as e:
+            raise ValueError(f"バックエンド {name} は利用できません ({e})") from e
+    _backend_name = name
+
+
+def get_backend() -> str:
+    """選択中のバックエンド名 (auto の場合は計測して選択したバックエンド名)"""
+
+    global _auto_backend
+    if _backend_name != "auto":
+        return _backend_name
+    if _auto_backend is None:
+        _auto_backend = _select_fastest_backend()
+    return _auto_backend
+
+
+def _backend() -> tuple:
+    """選択中のバックエンドの変換関数 (rgb2lab, lab2rgb)"""
+
+    global _backend_funcs
+    if _backend_funcs is None:
+        _backend_funcs = _BACKEND_LOADERS[get_backend()]()
+    return _backend_funcs
+
+
+def rgb2lab(rgb: np.ndarray, dtype=np.float64) -> np.ndarray:
+    """
+    sRGB (uint8 / uint16、もしくは 0-255 のスケールの float) -> Lab (L:0-255, a:0-255, b:0-255)
+
+    引数:
+        dtype: 出力の型 (float64 / float32)
+    """
+
+    with instrument.stage("rgb2lab"):
+        return _backend()[0](rgb, dtype)
+
+
+def lab2rgb(lab: np.ndarray, dtype=np.uint8) -> np.ndarray:
+    """
+    Lab (L:0-255, a:0-255, b:0-255) -> sRGB (0-255)
+
+    引数:
+        dtype: 出力の型 (uint8、もしくは 16bit / float の画像用に丸めずに返す float64 / float32)
+            いずれも sRGB の範囲(0-255)にクリップする
+    """
+
+    with instrument.stage("lab2rgb"):
+        return _backend()[1](lab, dtype)
+
+
+def rgb2lab_exact(rgb: np.ndarray) -> np.ndarray:
+    """sRGB (0-255) -> Lab (表を使わずに定義式で計算)"""
+
+    # 入力を float に正規化 (0-1)
+    rgb_f = rgb.astype(np.float64)
+    rgb_f = rgb_f / 255.0
+
+    # sRGB -> linear RGB
+    rgb_linear = sRGBtoRGB(rgb_f)
+
+    # RGB -> XYZ
+    xyz = RGBtoXYZ(rgb_linear)
+
+    # XYZ -> Lab(L:0-100, a:-128~127, b:-128~127)
+    L, a, b = XYZtoLab(xyz)
+
+    # Labの範囲を0～255にリスケール
+    L = L * (255.0 / 100.0)
+    a = a + 128.0
+    b = b + 128.0
+
+    return np.stack([L, a, b], axis=-1)
+
+
+def lab2rgb_exact(lab: np.ndarray) -> np.ndarray:
+    """Lab -> sRGB (uint8, 0-255) (表を使わずに定義式で計算)"""
+
+    # Lab(L:0-100, a:-128~127, b:-128~127)
+    lab = lab.astype(np.float64)
+    L = lab[..., 0] * (100.0 / 255.0)
+    a = lab[..., 1] - 128.0
+    b = lab[..., 2] - 128.0
+
+    # Lab -> XYZ
+    xyz = LabtoXYZ(L, a, b)
+
+    # XYZ -> RGB
+    rgb_linear = XYZtoRGB(xyz)
+
+    # linear RGB -> sRGB
+    rgb_f = RGBtosRGB(rgb_linear)
+
+    # uint8 に変換 (0-255)
+    rgb_u8 = np.clip(rgb_f * 255.0, 0, 255).astype(np.uint8)
+    return rgb_u8
 
 
 def sRGBtoRGB(rgb_f):
@@ -193,6 +384,101 @@ def LabtoXYZ(L, a, b) -> np.ndarray:
     return xyz
 
 
+# ==================================================
+# 表の参照による RGB <-> Lab 変換
+# ==================================================
+
+# 1度に変換する画素数 (中間配列をキャッシュに収める為)
+_LAB_CHUNK_PIXELS = 1 << 16
+
+# D65 ホワイトポイント
+_REF_WHITE = np.array([0.95047, 1.00000, 1.08883])
+
+# linear RGB -> XYZ/白色点 と、その逆変換の行列
+_RGB_TO_XYZN = RGBtoXYZ(np.eye(3)).T / _REF_WHITE[:, None]
+_XYZN_TO_RGB = XYZtoRGB(np.eye(3) * _REF_WHITE[:, None]).T
+
+# 8bitの値ごとの linear RGB (sRGBtoRGB の256段階の表)
+_SRGB_TO_LINEAR = sRGBtoRGB(np.arange(256) / 255.0)
+
+# 16bitの値ごとの linear RGB (最初に 16bit の画像を変換する時に作成する)
+_SRGB16_TO_LINEAR = None
+
+
+def _srgb16_to_linear() -> np.ndarray:
+    """16bitの値ごとの linear RGB (sRGBtoRGB の65536段階の表)"""
+
+    global _SRGB16_TO_LINEAR
+    if _SRGB16_TO_LINEAR is None:
+        _SRGB16_TO_LINEAR = sRGBtoRGB(np.arange(65536) / 65535.0)
+    return _SRGB16_TO_LINEAR
+
+# sRGB の8bit値 k になる linear RGB の下限 (k = 0 は -inf、256 は +inf)
+_LINEAR_THRESHOLD = np.concatenate([[-np.inf], sRGBtoRGB(np.arange(1, 256) / 255.0), [np.inf]])
+
+# linear RGB の値域 [0, 1] を _LINEAR_SIZE 等分した各区間の先頭の8bit値
+# (8bit値の境界の間隔は最小で約 3.0e-4 の為、1区間に含まれる境界は高々1つ)
+_LINEAR_SIZE = 4096
+_LINEAR_TO_CODE = (np.searchsorted(_LINEAR_THRESHOLD, np.arange(_LINEAR_SIZE) / _LINEAR_SIZE, side="right") - 1)
+
+
+def _rgb2lab_lut(rgb: np.ndarray, table: np.ndarray = _SRGB_TO_LINEAR) -> np.ndarray:
+    """(N, 3) の sRGB (uint8、もしくは 16bit の表を指定した場合は uint16) -> Lab"""
+
+    # sRGB -> linear RGB (表の参照) -> XYZ/白色点
+    t = table[rgb] @ _RGB_TO_XYZN.T
+
+    # XYZ/白色点 -> f(t) (np.power(t, 1/3) より高速な np.cbrt を利用し、暗部のみ線形の式で置き換え)
+    f = np.cbrt(t)
+    dark = t <= (6.0 / 29.0) ** 3
+    if dark.any():
+        f[dark] = t[dark] * (1.0 / (3.0 * (6.0 / 29.0) ** 2.0)) + (16.0 / 116.0)
+
+    # Lab (L:0-255, a,b:0-255)
+    lab = np.empty(rgb.shape, dtype=np.float64)
+    lab[:, 0] = f[:, 1] * (116.0 * 255.0 / 100.0) - (16.0 * 255.0 / 100.0)
+    lab[:, 1] = (f[:, 0] - f[:, 1]) * 500.0 + 128.0
+    lab[:, 2] = (f[:, 1] - f[:, 2]) * 200.0 + 128.0
+    return lab
+
+
+def _lab2linear(lab: np.ndarray) -> np.ndarray:
+    """(N, 3) の Lab -> linear RGB"""
+
+    # Lab -> f(XYZ/白色点)
+    f = np.empty(lab.shape, dtype=np.float64)
+    f[:, 1] = lab[:, 0] * (100.0 / 255.0 / 116.0) + (16.0 / 116.0)
+    f[:, 0] = f[:, 1] + (lab[:, 1] - 128.0) * (1.0 / 500.0)
+    f[:, 2] = f[:, 1] - (lab[:, 2] - 128.0) * (1.0 / 200.0)
+
+    # f -> XYZ/白色点 -> linear RGB
+    t = f * f * f
+    dark = f <= 6.0 / 29.0
+    if dark.any():
+        t[dark] = (f[dark] - 16.0 / 116.0) * (3.0 * (6.0 / 29.0) ** 2.0)
+    return t @ _XYZN_TO_RGB.T
+
+
+def _lab2rgb_lut(lab: np.ndarray) -> np.ndarray:
+    """(N, 3) の Lab -> sRGB (uint8)"""
+
+    linear = _lab2linear(lab)
+
+    # linear RGB -> sRGB の8bit値 (区間の先頭の値に、区間内の境界を超えていれば1を足す)
+    index = linear * _LINEAR_SIZE
+    np.clip(index, 0, _LINEAR_SIZE - 1, out=index)
+    code = np.take(_LINEAR_TO_CODE, index.astype(np.intp))
+    code += linear >= np.take(_LINEAR_THRESHOLD, code + 1)
+    return code.astype(np.uint8)
+
+
+def _lab2rgb_float(lab: np.ndarray) -> np.ndarray:
+    """(N, 3) の Lab -> sRGB (0-255 の float64、量子化しない)"""
+
+    linear = np.clip(_lab2linear(lab), 0.0, 1.0)
+    return RGBtosRGB(linear) * 255.0
+
+
 def cov_sqrt_and_inv(cov: np.ndarray, eps: float = 1e-6) -> tuple[np.ndarray, np.ndarray]:
     """共分散行列の平方根と逆平方根を固有値分解で求める"""
     
@@ -201,7 +487,8 @@ def cov_sqrt_and_inv(cov: np.ndarray, eps: float = 1e-6) -> tuple[np.ndarray, np
     cov = cov + eps * np.eye(cov.shape[0])
     
     # 対称行列を V, λ に固有値分解
-    w, v = np.linalg.eigh(cov)
+    with instrument.stage("eigh"):
+        w, v = np.linalg.eigh(cov)
     
     # 数値的安定化
     w = np.clip(w, eps, None)
@@ -226,7 +513,8 @@ def spd_mat_sqrt(A):
 
     # 対称行列を V, λ に固有値分解
     # (eigh()は高速・安定だが対称行列専用)
-    w, v = np.linalg.eigh(A)
+    with instrument.stage("eigh"):
+        w, v = np.linalg.eigh(A)
 
     # 数値誤差で負になるのを防ぐ
     w = np.maximum(w, 0)
@@ -249,7 +537,8 @@ def spd_mat_sqrt_inv(A):
 
     # 対称行列を V, λ に固有値分解
     # (eigh()は高速・安定だが対称行列専用)
-    w, v = np.linalg.eigh(A)
+    with instrument.stage("eigh"):
+        w, v = np.linalg.eigh(A)
 
     # 数値誤差で負になるのを防ぐ(0除算防止の為に eps を加える)
     w = np.maximum(w, 1e-10)
@@ -257,3 +546,340 @@ def spd_mat_sqrt_inv(A):
     sqrt_w = np.sqrt(w)
     inv_sqrt = (v * (1.0 / sqrt_w)) @ v.T
     return inv_sqrt
+
+
+class Moments:
+    """
+    画素数・平均・分散共分散行列のアキュムレータ
+
+    画素をチャンク単位で1度だけ走査して統計量を更新する
+    分割して計算したアキュムレータ(チャンク・スレッド・別ファイル等)は merge() で統合できる
+    (Chanらの並列アルゴリズム)
+
+    使用例:
+        acc = Moments(3)
+        for chunk in chunks:
+            acc.update(chunk)
+        stats = acc.stats()
+    """
+
+    # 1度に float64 に変換する画素数 (キャッシュに収まる程度)
+    chunk_pixels = 65536
+
+    def __init__(self, channels: int):
+        self.count = 0.0
+        self.mean = np.zeros(channels)
+        self.m2 = np.zeros((channels, channels))  # 平均からの偏差の外積和
+
+    @classmethod
+    def from_stats(cls, stats: dict) -> "Moments":
+        """stats() の戻り値からアキュムレータを復元"""
+
+        acc = cls(len(stats["mean"]))
+        acc.count = float(stats["count"])
+        acc.mean = np.asarray(stats["mean"], dtype=np.float64).copy()
+        acc.m2 = np.asarray(stats["cov"], dtype=np.float64) * acc.count
+        return acc
+
+    def stats(self) -> dict:
+        """
+        統計量を取得
+
+        戻り値:
+            {"count": 画素数, "mean": (C,), "cov": (C, C)}
+        """
+
+        cov = self.m2 / self.count if self.count > 0 else np.zeros_like(self.m2)
+        return {"count": np.float64(self.count), "mean": self.mean.copy(), "cov": cov}
+
+    def _merge(self, n: float, mean: np.ndarray, m2: np.ndarray) -> None:
+        total = self.count + n
+        if n == 0:
+            return
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (n / total)
+        self.m2 = self.m2 + m2 + np.outer(delta, delta) * (self.count * n / total)
+        self.count = total
+
+    def update(self, x: np.ndarray) -> "Moments":
+        """(..., C) の画素を追加"""
+
+        v = x.reshape(-1, x.shape[-1])
+        for i in range(0, v.shape[0], self.chunk_pixels):
+            chunk = v[i:i + self.chunk_pixels].astype(np.float64)
+            mean = chunk.mean(axis=0)
+            chunk -= mean
+            self._merge(float(chunk.shape[0]), mean, chunk.T @ chunk)
+        return self
+
+    def merge(self, other: "Moments") -> "Moments":
+        """別のアキュムレータの統計量を統合"""
+
+        self._merge(other.count, other.mean, other.m2)
+        return self
+
+
+def moments(x: np.ndarray) -> dict:
+    """
+    (..., C) の画素集合から画素数・平均・分散共分散行列を求める
+
+    戻り値:
+        {"count": 画素数, "mean": (C,), "cov": (C, C)}
+    """
+
+    return Moments(x.shape[-1]).update(x).stats()
+
+
+def apply_linear(x: np.ndarray, A: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """(..., C) の画素に線形変換 y = A x + b を適用"""
+
+    # A, b の型(通常は float64、float32 の色変換では float32)で計算する
+    c = x.shape[-1]
+    v = x.reshape(-1, c).astype(A.dtype)
+    out = v @ A.T + b
+    return out.reshape(x.shape)
+
+
+def interpolate_linear(t: dict, strength: float) -> dict:
+    """
+    線形変換 y = A x + b を恒等変換と strength(0-1) で補間した線形変換
+
+    (1 - s) x + s (A x + b) = ((1 - s) I + s A) x + s b
+    """
+
+    A = t["A"]
+    return {"A": (1.0 - strength) * np.eye(A.shape[0]) + strength * A, "b": strength * t["b"]}
+
+
+def blend(src: np.ndarray, out: np.ndarray, strength: float) -> np.ndarray:
+    """
+    同じ型の画像 src と out を strength(0-1) で合成 (src * (1 - strength) + out * strength)
+
+    uint8 は重みを 1/256 単位に丸めた整数演算で計算する
+    (16bit / float の画像は float64 で計算して元の型に戻す)
+    """
+
+    if src.dtype != np.uint8:
+        mixed = src.astype(np.float64) * (1.0 - strength)
+        mixed += out * strength
+        if np.issubdtype(src.dtype, np.integer):
+            np.rint(mixed, out=mixed)
+        return mixed.astype(src.dtype)
+
+    w = np.uint16(round(strength * 256))
+    mixed = src.astype(np.uint16) * (np.uint16(256) - w)
+    mixed += out.astype(np.uint16) * w
+    mixed += np.uint16(128)
+    mixed >>= 8
+    return mixed.astype(np.uint8)
+
+
+def astype_transform(t: dict, dtype) -> dict:
+    """色変換(LUT / 変換行列)の配列を dtype に変換 (適用時の計算は色変換の型で行われる)"""
+
+    if all(v.dtype == dtype for v in t.values()):
+        return t
+    return {key: v.astype(dtype) for key, v in t.items()}
+
+
+# ==================================================
+# 画像の型 (8bit / 16bit / float)
+# ==================================================
+# カラーマッチングの処理は全ての型で画素値を 0-255 のスケールで扱い、
+# 16bit (0-65535) / float (0-1、HDR では 1 を超える値を含む) の画像は to_float() で変換する
+
+IMAGE_DTYPES = (np.uint8, np.uint16, np.float32, np.float64)
+
+
+def check_image(img: np.ndarray, name: str = "画像") -> None:
+    """(H, W, 3) の uint8 / uint16 / float32 / float64 の配列であることを確認"""
+
+    if img.ndim != 3 or img.shape[2] != 3 or img.dtype not in IMAGE_DTYPES:
+        raise ValueError(f"(H, W, 3) の uint8 / uint16 / float 配列ではありません: {name} ({img.dtype}, {img.shape})")
+
+
+def levels(img: np.ndarray) -> int:
+    """
+    画像の階調数 (HM のヒストグラムのビン数)
+
+    uint8 は 256、16bit / float の画像は 65536
+    (float の画像は 0-1 を 65536 段階に分割する、1 を超える値は最上位のビンに含める)
+    """
+
+    return 256 if img.dtype == np.uint8 else 65536
+
+
+def _scale(img_dtype) -> float:
+    """画像の画素値を 0-255 のスケールに変換する係数"""
+
+    if img_dtype == np.uint16:
+        return 255.0 / 65535.0
+    if np.issubdtype(img_dtype, np.floating):
+        return 255.0
+    return 1.0
+
+
+def to_float(img: np.ndarray, dtype=np.float64) -> np.ndarray:
+    """画像(uint8 / uint16 / float)の画素値を 0-255 のスケールの dtype の配列に変換"""
+
+    x = img.astype(dtype)
+    scale = _scale(img.dtype)
+    if scale != 1.0:
+        x *= scale
+    return x
+
+
+def from_float(x: np.ndarray, img_dtype=np.uint8) -> np.ndarray:
+    """
+    0-255 のスケールの画素値を画像の型に変換
+
+    uint8 は 0-255 にクリップして切り捨て、uint16 は 0-65535 にクリップして丸める
+    float は負の値のみクリップする (HDR の 1 を超える値は残す)
+    """
+
+    img_dtype = np.dtype(img_dtype)
+    if img_dtype == np.uint8:
+        return np.clip(x, 0, 255).astype(np.uint8)
+    if img_dtype == np.uint16:
+        y = np.clip(x, 0, 255)
+        y *= 65535.0 / 255.0
+        np.rint(y, out=y)
+        return y.astype(np.uint16)
+    y = np.maximum(x, 0)
+    y *= 1.0 / 255.0
+    return y.astype(img_dtype, copy=False)
+
+
+def to_workspace(img: np.ndarray, mode: str, dtype=np.float64) -> tuple:
+    """
+    RGB画像をカラーマッチングを行う色空間の画素に変換
+
+    引数:
+        img: RGB画像 (uint8 / uint16 / float)
+            rgb モードでは 16bit / float の画像は 0-255 のスケールの dtype の配列に変換する
+        dtype: Lab画像(もしくは 16bit / float の画像の画素)の型 (float64 / float32)
+
+    戻り値:
+        (処理対象の画素 (..., C), Lab画像(rgb モードの場合は None))
+    """
+
+    if mode == "rgb":
+        return (img if img.dtype == np.uint8 else to_float(img, dtype)), None
+    # rgb2lab() は uint8 / uint16 をそのまま受け付ける (float の画像のみ 0-255 のスケールに変換する)
+    if np.issubdtype(img.dtype, np.floating):
+        img = to_float(img, dtype)
+    lab = rgb2lab(img, dtype)
+    return lab[..., :1], lab
+
+
+def from_workspace(work: np.ndarray, lab, mode: str, img_dtype=np.uint8) -> np.ndarray:
+    """
+    to_workspace() で変換した色空間の画素をRGB画像に戻す
+
+    引数:
+        img_dtype: 出力の画像の型 (入力画像と同じ uint8 / uint16 / float)
+            lab モードでは sRGB の範囲にクリップする為、float の画像でも 1 を超える値は残らない
+    """
+
+    if mode == "rgb":
+        return from_float(work, img_dtype)
+    lab[..., :1] = work
+    if img_dtype == np.uint8:
+        return np.clip(lab2rgb(lab), 0, 255).astype(np.uint8)
+    return from_float(lab2rgb(lab, lab.dtype), img_dtype)
+
+
+def downscale(img: np.ndarray, scale: float = None, max_pixels: int = None) -> np.ndarray:
+    """
+    統計量の推定用に画像を縮小(間引き)
+
+    平均化による縮小は色の分布(分散やヒストグラム)を変えてしまう為、
+    一定間隔で画素を間引いて元画像の色の分布を保つ
+
+    引数:
+        scale: 縦横の縮小率(0-1)
+        max_pixels: 縮小後の最大画素数
+    """
+
+    h, w = img.shape[:2]
+    step = 1
+    if scale is not None and scale < 1.0:
+        step = max(step, int(np.ceil(1.0 / scale)))
+    if max_pixels is not None and h * w > max_pixels:
+        step = max(step, int(np.ceil(np.sqrt(h * w / max_pixels))))
+    if step == 1:
+        return img
+    return img[::step, ::step]
+
+
+def moments_distance(a: dict, b: dict) -> float:
+    """
+    2つの moments() の差を 0-1 のスケールで求める
+
+    平均の差と分散共分散行列の(符号付き)平方根の差のうち大きい方を画素値の範囲(255)で割った値
+    """
+
+    d_mean = np.max(np.abs(a["mean"] - b["mean"]))
+    sa = np.sign(a["cov"]) * np.sqrt(np.abs(a["cov"]))
+    sb = np.sign(b["cov"]) * np.sqrt(np.abs(b["cov"]))
+    d_cov = np.max(np.abs(sa - sb))
+    return float(max(d_mean, d_cov) / 255.0)
+
+
+def sample_stats(img: np.ndarray, fit, distance, tol: float, sampling: str = "random",
+                 min_samples: int = 16384, seed: int = 0):
+    """
+    画像から画素を抽出して統計量を推定
+
+    抽出数を倍にしながら統計量を計算し、前回との差が tol 以下になった時点の統計量を返す
+    (全画素の半数以上の抽出が必要な場合は全画素から計算する)
+
+    引数:
+        img: 画像 (..., C)
+        fit: 画素 (n, 1, C) から統計量を求める関数
+        distance: 2つの統計量の差(0-1)を求める関数
+        tol: 許容誤差(0-1)
+        sampling: 抽出方法
+            random: 一様ランダムに抽出
+            stratified: 全画素を抽出数で等分し、各区間から1画素ずつランダムに抽出
+        min_samples: 最初の抽出数
+        seed: 乱数シード(同じ画像からは常に同じ結果が得られる)
+    """
+
+    if sampling not in ("random", "stratified"):
+        raise ValueError(f"不明な抽出方法: {sampling}")
+
+    v = img.reshape(-1, img.shape[-1])
+    total = v.shape[0]
+    rng = np.random.default_rng(seed)
+
+    def _sample(n):
+        if sampling == "random":
+            idx = rng.integers(0, total, n)
+        else:
+            step = total // n
+            idx = np.arange(n) * step + rng.integers(0, step, n)
+        return fit(v[idx][:, None, :])
+
+    n = min_samples
+    if n * 2 > total:
+        return fit(img)
+    prev = _sample(n)
+    while True:
+        n *= 2
+        if n * 2 > total:
+            return fit(img)
+        cur = _sample(n)
+        if distance(prev, cur) <= tol:
+            return cur
+        prev = cur
+
+
+def merge_moments(a: dict, b: dict) -> dict:
+    """
+    2つの画素集合の moments() を統合
+
+    画像を分割して計算した統計量から画像全体の統計量を求める
+    """
+
+    return Moments.from_stats(a).merge(Moments.from_stats(b)).stats()
@@ -5,7 +5,9 @@
 Color Matchのアプリケーション
 """
 
+import queue
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # リポジトリ直下から実行した場合に color_match を import できるようにする
@@ -24,6 +26,76 @@ except Exception as e:
     print("必要なライブラリが見つかりません")
     raise
 
+# 表示用の縮小画像のピラミッドの最小サイズ（これより小さい段は作らない）
+_PYRAMID_MIN_SIZE = 128
+# これ以下の画素数の画像（中央のプレビュー等）はピラミッドを Tk のスレッドでその場で作成する
+_PYRAMID_SYNC_PIXELS = 1 << 21
+
+
+def _build_pyramid(img):
+    """
+    表示用の縮小画像のピラミッド（段ごとに縦横 1/2 に縮小した画像のリスト、先頭は元の画像）
+
+    縮小は 2x2 画素の平均（Image.reduce）で行う
+    """
+    levels = [img]
+    while min(levels[-1].size) >= _PYRAMID_MIN_SIZE * 2:
+        levels.append(levels[-1].reduce(2))
+    return levels
+
+
+def _fit_size(size, w, h):
+    """size の画像を縦横比を保って (w, h) に収まるように縮小した大きさ（拡大はしない）"""
+    scale = min(w / size[0], h / size[1], 1.0)
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+
+def _preview_session(src_arr, ref_arr):
+    """プレビュー用の縮小画像の MatchSession"""
+    return color_match.MatchSession(src_arr, ref_arr, max_mb=256)
+
+
+def _match_full(src_arr, ref_arr, method, mode, strength, progress=None):
+    """
+    元の解像度でカラーマッチングし、Strength値に応じて元画像と合成した配列（保存用）
+
+    プレビューと同じく、強度 1 の結果と元画像を RGB で合成する（utils.blend）
+    （色変換に Strength値を反映すると lab モードでは L のみが補間され、プレビューと結果が異なる為）
+    色変換は1度だけ推定し、約 1MP の行単位に分割して適用する
+
+    引数:
+        progress: 分割ごとに進捗(0-1)を受け取る関数
+    """
+    transforms = color_match.fit_transforms(src_arr, ref_arr, method, mode)
+    out = np.empty_like(src_arr)
+    rows = max(1, (1 << 20) // max(1, src_arr.shape[1]))
+    for y0 in range(0, src_arr.shape[0], rows):
+        sl = slice(y0, y0 + rows)
+        matched = color_match.apply_transforms(src_arr[sl], transforms, method, mode, 1.0)
+        out[sl] = color_match.utils.blend(src_arr[sl], matched, strength)
+        if progress is not None:
+            progress(min(1.0, (y0 + rows) / src_arr.shape[0]))
+    return out
+
+
+def _same_key(a, b):
+    """
+    キャッシュのキーの比較（画像は同じオブジェクトかを is で、その他の値は == で比較する）
+
+    id() は破棄された画像の値が新しい画像に再利用される場合がある為、キーには画像そのものを保持する
+    """
+    if a is None or b is None or len(a) != len(b):
+        return False
+    return all(x is y if isinstance(x, Image.Image) else x == y for x, y in zip(a, b))
+
+
+def _pyramid_level(levels, size):
+    """縮小後の大きさ size 以上の大きさを持つ最も小さい段"""
+    for level in reversed(levels):
+        if level.width >= size[0] and level.height >= size[1]:
+            return level
+    return levels[0]
+
 
 class ColorMatchApp(TkinterDnD.Tk):
     """
@@ -36,7 +108,7 @@ class ColorMatchApp(TkinterDnD.Tk):
         self.geometry("1000x400")
 
         # color_match の method / mode 選択肢（__init__.py の match() に合わせる）
-        self._methods = ("hm", "reinhard", "mvgd", "mkl", "hm-mvgd-hm", "hm-mkl-hm")
+        self._methods = ("hm", "reinhard", "mvgd", "mkl", "hm-mvgd-hm", "hm-mkl-hm", "sliced-ot")
         self._modes = ("rgb", "lab")
 
         # 上部: Method / Mode / Strength 用フレーム
@@ -88,6 +160,14 @@ class ColorMatchApp(TkinterDnD.Tk):
         self.strength_entry.bind("<Return>", lambda e: self._apply_strength_entry())
         self.strength_entry.bind("<FocusOut>", lambda e: self._apply_strength_entry())
 
+        # 処理中の表示（カラーマッチングの実行中のみ表示）
+        self.busy_label = ttk.Label(self.top_frame, text="処理中...")
+        self.busy_bar = ttk.Progressbar(self.top_frame, mode="indeterminate", length=80)
+
+        # 保存中の表示（元の解像度でのカラーマッチングの進捗）
+        self.save_label = ttk.Label(self.top_frame, text="保存中...")
+        self.save_bar = ttk.Progressbar(self.top_frame, mode="determinate", length=120, maximum=1.0)
+
         # プレビュー用フレーム（左・中央・右の画像エリア）
         self.main_frame = ttk.Frame(self)
         self.main_frame.pack(fill=tk.BOTH, expand=True)
@@ -133,7 +213,11 @@ class ColorMatchApp(TkinterDnD.Tk):
         self.center_image_label.grid(row=0, column=0, sticky="nsew", padx=5, pady=5)
         self.center_image_label.bind("<Button-3>", self._on_center_context_menu)
 
-        self._matched_image_cache = None  # カラーマッチング画像のキャッシュ
+        self._matched_image_cache = None  # カラーマッチング画像(プレビュー用の縮小画像)のキャッシュ
+        self._matched_cache_key = None  # キャッシュを計算した時の (入力画像, 参照画像, method, mode, 縮小サイズ)
+        self._proxy_cache = {}  # プレビュー用の縮小画像のキャッシュ (side -> ((画像, 縮小サイズ), 配列))
+        self._session = None  # プレビュー用の MatchSession ((入力画像, 参照画像, 縮小サイズ), セッション)
+        self._preview_size = (0, 0)  # プレビュー用の縮小画像の最大サイズ
         self.center_original_image = None  # PIL Image (RGB)
         self.center_tkimage = None
         self._center_resize_job = None
@@ -164,9 +248,38 @@ class ColorMatchApp(TkinterDnD.Tk):
         self._right_hq_job = None
         self._right_last_size = (0, 0)
 
+        # カラーマッチングはバックグラウンドのスレッドで実行し、結果はキューを介して Tk のスレッドで受け取る
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._results = queue.Queue()
+        self._job_id = 0  # 最新のジョブID（これより古いジョブの結果は破棄）
+        self._busy = False
+        self._poll_job = None
+
+        # 保存は元の解像度で行う為、プレビューとは別のスレッドで実行
+        self._save_executor = ThreadPoolExecutor(max_workers=1)
+        self._save_results = queue.Queue()
+        self._saving = False
+
+        # 表示用の縮小画像のピラミッドは画像ごとに1度だけバックグラウンドのスレッドで作成
+        self._pyramid_executor = ThreadPoolExecutor(max_workers=1)
+        self._pyramid_results = queue.Queue()
+        self._pyramids = {}  # side -> (元の画像, ピラミッド)
+        self._pyramid_pending = {}  # side -> 作成中のピラミッドの元の画像
+        self._pyramid_poll_job = None
+
         # ウィンドウリサイズ時のイベントをバインド
         self.bind("<Configure>", self._on_resize)
-    
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
+
+    def _on_close(self):
+        """ウィンドウを閉じる時のコールバック"""
+        # 実行待ちのジョブを破棄してスレッドを終了
+        self._job_id += 1
+        self._executor.shutdown(wait=False)
+        self._save_executor.shutdown(wait=False)
+        self._pyramid_executor.shutdown(wait=False)
+        self.destroy()
+
     def _on_resize(self, event):
         """ウィンドウリサイズ時のイベントハンドラ"""
         # 左・中央・右の画像サイズを更新
@@ -324,6 +437,12 @@ class ColorMatchApp(TkinterDnD.Tk):
         )
         self._left_last_size = (0, 0)
         self._right_last_size = (0, 0)
+        # 作成済みのピラミッドも入れ替える（作成中のものは作り直す）
+        left_pyramid, right_pyramid = self._pyramids.pop("left", None), self._pyramids.pop("right", None)
+        if right_pyramid is not None:
+            self._pyramids["left"] = right_pyramid
+        if left_pyramid is not None:
+            self._pyramids["right"] = left_pyramid
         self.update_idletasks()  # レイアウト確定後に幅・高さを取得するため
         # プレビューを更新
         self._update_image("left")
@@ -333,10 +452,18 @@ class ColorMatchApp(TkinterDnD.Tk):
         self._update_center_preview()
 
     def _save_center_image(self):
-        """適応画像をファイルに保存"""
-        if self.center_original_image is None:
+        """
+        適応画像をファイルに保存
+
+        プレビューは縮小画像で計算している為、保存時に元の解像度でカラーマッチングをやり直す
+        (バックグラウンドのスレッドで実行し、進捗を表示する)
+        """
+        if self.left_original_image is None or self.right_original_image is None:
             messagebox.showinfo("保存", "保存する画像がありません。")
             return
+        if self._saving:
+            messagebox.showinfo("保存", "保存中です。")
+            return
         # ファイルダイアログ起動時の初期ディレクトリを設定(最後に開いた画像のディレクトリを優先)
         initialdir = None
         if self.left_image_path:
@@ -352,12 +479,59 @@ class ColorMatchApp(TkinterDnD.Tk):
         )
         if not path:
             return
-        # 画像を保存
+        # 元の解像度でカラーマッチングして保存
+        self._set_saving(True)
+        self._save_executor.submit(
+            self._run_save_job,
+            path,
+            self.left_original_image,
+            self.right_original_image,
+            self.method_var.get(),
+            self.mode_var.get(),
+            self.strength_var.get() / 100.0,
+        )
+        self.after(50, self._poll_save_results)
+
+    def _run_save_job(self, path, src_img, ref_img, method, mode, strength):
+        """元の解像度でカラーマッチングして保存するジョブ（バックグラウンドのスレッドで実行）"""
         try:
-            self.center_original_image.save(path)
+            src_arr = np.array(src_img.convert("RGB"))
+            ref_arr = np.array(ref_img.convert("RGB"))
+            # 分割ごとに進捗を通知
+            out = _match_full(src_arr, ref_arr, method, mode, strength,
+                              lambda value: self._save_results.put(("progress", value)))
+            Image.fromarray(out).save(path)
+            self._save_results.put(("done", None))
         except Exception as e:
-            messagebox.showerror("エラー", str(e))
-    
+            self._save_results.put(("done", e))
+
+    def _poll_save_results(self):
+        """保存ジョブの進捗を受け取って表示を更新（Tk のスレッドで after() により定期的に実行）"""
+        while True:
+            try:
+                kind, value = self._save_results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                self.save_bar["value"] = value
+            else:
+                self._set_saving(False)
+                if value is not None:
+                    messagebox.showerror("エラー", str(value))
+                return
+        self.after(50, self._poll_save_results)
+
+    def _set_saving(self, saving: bool):
+        """保存中の表示を切り替え"""
+        self._saving = saving
+        if saving:
+            self.save_bar["value"] = 0.0
+            self.save_label.pack(side=tk.LEFT, padx=(16, 4))
+            self.save_bar.pack(side=tk.LEFT)
+        else:
+            self.save_bar.pack_forget()
+            self.save_label.pack_forget()
+
     def _update_image(self, side: str, low_quality: bool = False):
         """指定側のラベルに現在の元画像をリサイズして表示"""
         if side == "left":
@@ -382,10 +556,21 @@ class ColorMatchApp(TkinterDnD.Tk):
         if w <= 1 or h <= 1:
             return
 
+        # 中央パネルがプレビュー用の縮小画像より大きくなった場合は、表示サイズでプレビューを計算し直す
+        if side == "center" and not low_quality and (w > self._preview_size[0] or h > self._preview_size[1]):
+            src_w, src_h = self.left_original_image.size
+            if original.width < src_w and original.height < src_h:
+                self._center_hq_job = None
+                self._update_center_preview(True)
+                return
+
+        # ピラミッドの縮小後の大きさ以上の最も小さい段から縮小する（作成前は元の画像から縮小する）
+        size = _fit_size(original.size, w, h)
+        levels = self._pyramid(side, original)
+        source = original if levels is None else _pyramid_level(levels, size)
         resample = Image.NEAREST if low_quality else Image.LANCZOS
         try:
-            img = original.copy()
-            img.thumbnail((w, h), resample)
+            img = source.resize(size, resample) if source.size != size else source
             photo = ImageTk.PhotoImage(img)
             setattr(self, tkimage_attr, photo)
             label.config(image=photo, text="")
@@ -406,38 +591,196 @@ class ColorMatchApp(TkinterDnD.Tk):
                 else:
                     self._right_hq_job = None
 
+    def _original_image(self, side: str):
+        """指定側の元画像"""
+        if side == "left":
+            return self.left_original_image
+        if side == "center":
+            return self.center_original_image
+        return self.right_original_image
+
+    def _pyramid(self, side: str, img):
+        """
+        画像の表示用の縮小画像のピラミッド
+
+        作成済みでなければバックグラウンドのスレッドで作成を開始して None を返す
+        （作成が完了すると、その時点でも同じ画像を表示していればプレビューを更新する）
+        """
+        cached = self._pyramids.get(side)
+        if cached is not None and cached[0] is img:
+            return cached[1]
+        if img.width * img.height <= _PYRAMID_SYNC_PIXELS:
+            self._pyramid_pending.pop(side, None)
+            self._pyramids[side] = (img, _build_pyramid(img))
+            return self._pyramids[side][1]
+        if self._pyramid_pending.get(side) is not img:
+            self._pyramid_pending[side] = img
+            self._pyramid_executor.submit(self._run_pyramid_job, side, img)
+            if self._pyramid_poll_job is None:
+                self._pyramid_poll_job = self.after(50, self._poll_pyramid_results)
+        return None
+
+    def _run_pyramid_job(self, side: str, img):
+        """ピラミッドを作成するジョブ（バックグラウンドのスレッドで実行）"""
+        # 作成待ちの間に別の画像に切り替わっていれば何もしない
+        if self._pyramid_pending.get(side) is not img:
+            return
+        try:
+            self._pyramid_results.put((side, img, _build_pyramid(img)))
+        except Exception:
+            self._pyramid_results.put((side, img, None))
+
+    def _poll_pyramid_results(self):
+        """作成したピラミッドを受け取って表示を更新（Tk のスレッドで after() により定期的に実行）"""
+        self._pyramid_poll_job = None
+        while True:
+            try:
+                side, img, levels = self._pyramid_results.get_nowait()
+            except queue.Empty:
+                break
+            if self._pyramid_pending.get(side) is not img:
+                continue
+            del self._pyramid_pending[side]
+            # 作成に失敗した場合は元の画像だけのピラミッドにする（元の画像から縮小する）
+            self._pyramids[side] = (img, levels or [img])
+            if self._original_image(side) is img:
+                self._update_image(side)
+        if self._pyramid_pending:
+            self._pyramid_poll_job = self.after(50, self._poll_pyramid_results)
+
     def _update_center_preview(self, use_cached_image: bool = False):
-        """中央プレビューを更新"""
-        self.center_original_image = None
-        self.center_image_label.config(image="", text="結果を表示")
+        """
+        中央プレビューの更新を要求
+
+        カラーマッチングはバックグラウンドのスレッドで実行し、完了するまでは直前のプレビューを表示したままにする
+        実行中に新たな要求があった場合、古い要求の結果は破棄される
+
+        引数:
+            use_cached_image: 入力画像・参照画像・method・mode が変わっていなければ前回のカラーマッチング結果を再利用
+        """
+        # 新しいジョブIDを発行（実行待ち・実行中の古いジョブは無効になる）
+        self._job_id += 1
+        job_id = self._job_id
 
         if self.left_original_image is None or self.right_original_image is None:
+            self.center_original_image = None
+            self.center_image_label.config(image="", text="結果を表示")
+            self._set_busy(False)
             return
 
+        # Tk の変数はメインスレッドで読み取ってからジョブに渡す
+        src_img = self.left_original_image
+        ref_img = self.right_original_image
+        method = self.method_var.get()
+        mode = self.mode_var.get()
+        strength = self.strength_var.get() / 100.0
+
+        # プレビューは中央パネルの表示サイズに縮小した画像で計算する
+        self._preview_size = self._center_display_size()
+        size = self._preview_size
+        key = (src_img, ref_img, method, mode, size)
+        cached = self._matched_image_cache if use_cached_image and _same_key(key, self._matched_cache_key) else None
+
+        self._set_busy(True)
+        self._executor.submit(
+            self._run_match_job, job_id, key, src_img, ref_img, method, mode, strength, size, cached
+        )
+        if self._poll_job is None:
+            self._poll_job = self.after(30, self._poll_match_results)
+
+    def _center_display_size(self):
+        """中央パネルの表示サイズ（ウィンドウ表示前は既定のサイズ）"""
+        w, h = self.center_image_label.winfo_width(), self.center_image_label.winfo_height()
+        if w <= 1 or h <= 1:
+            return (640, 640)
+        return (w, h)
+
+    def _proxy(self, side, img, size):
+        """
+        プレビュー用に画像を size に収まるように縮小した配列（バックグラウンドのスレッドで実行）
+
+        縮小画像は画像と縮小サイズが変わるまで side ごとにキャッシュする
+        """
+        key = (img, size)
+        cached = self._proxy_cache.get(side)
+        if cached is not None and _same_key(cached[0], key):
+            return cached[1]
+        proxy = img.convert("RGB")
+        proxy.thumbnail(size, Image.BILINEAR, reducing_gap=2.0)
+        arr = np.array(proxy)
+        self._proxy_cache[side] = (key, arr)
+        return arr
+
+    def _match_session(self, src_img, ref_img, size, src_arr):
+        """
+        プレビュー用の縮小画像の MatchSession（バックグラウンドのスレッドで実行）
+
+        method・mode を切り替えても、入力画像・参照画像・縮小サイズが同じ間は Lab 変換や統計量を再利用する
+        """
+        key = (src_img, ref_img, size)
+        if self._session is None or not _same_key(self._session[0], key):
+            ref_arr = self._proxy("right", ref_img, size)
+            self._session = (key, _preview_session(src_arr, ref_arr))
+        return self._session[1]
+
+    def _run_match_job(self, job_id, key, src_img, ref_img, method, mode, strength, size, cached):
+        """プレビュー用のカラーマッチングのジョブ（バックグラウンドのスレッドで実行）"""
+        # 実行前に新しいジョブが要求されていれば何もしない
+        if job_id != self._job_id:
+            return
         try:
-            src_rgb = self.left_original_image.convert("RGB")
-            ref_rgb = self.right_original_image.convert("RGB")
-            src_arr = np.array(src_rgb)
-            ref_arr = np.array(ref_rgb)
-            method = self.method_var.get()
-            mode = self.mode_var.get()
+            src_arr = self._proxy("left", src_img, size)
             # カラーマッチング
-            if use_cached_image:
-                matched = self._matched_image_cache
+            if cached is not None:
+                matched = cached
             else:
-                matched = color_match.match(src_arr, ref_arr, method, mode)
-                self._matched_image_cache = matched
-            # Strength値に応じて元画像とマッチング結果をブレンド
-            strength = self.strength_var.get() / 100.0
-            blended = (1.0 - strength) * src_arr.astype(np.float64) + strength * matched.astype(np.float64)
-            blended_uint8 = np.clip(blended, 0, 255).astype(np.uint8)
+                matched = self._match_session(src_img, ref_img, size, src_arr).match(method, mode)
+            # Strength値に応じて元画像とマッチング結果をブレンド（マッチング結果を使い回す為、整数演算で合成）
+            # （保存する画像(_match_full)と同じ合成）
+            blended = color_match.utils.blend(src_arr, matched, strength)
+            self._results.put((job_id, key, matched, Image.fromarray(blended), None))
+        except Exception as e:
+            self._results.put((job_id, key, None, None, e))
+
+    def _poll_match_results(self):
+        """ジョブの結果を受け取ってプレビューを更新（Tk のスレッドで after() により定期的に実行）"""
+        self._poll_job = None
+        while True:
+            try:
+                job_id, key, matched, image, error = self._results.get_nowait()
+            except queue.Empty:
+                break
+            # 古いジョブの結果は破棄
+            if job_id != self._job_id:
+                continue
+            self._set_busy(False)
+            if error is not None:
+                self.center_original_image = None
+                self.center_image_label.config(image="", text=f"エラー: {error}")
+                continue
+            self._matched_image_cache = matched
+            self._matched_cache_key = key
             # プレビュー画像を更新
-            self.center_original_image = Image.fromarray(blended_uint8)
+            self.center_original_image = image
             self._center_last_size = (0, 0)
             self._update_image("center")
             self._schedule_resize_updates("center")
-        except Exception as e:
-            self.center_image_label.config(text=f"エラー: {e}")
+        if self._busy:
+            self._poll_job = self.after(30, self._poll_match_results)
+
+    def _set_busy(self, busy: bool):
+        """処理中の表示を切り替え"""
+        if busy == self._busy:
+            return
+        self._busy = busy
+        if busy:
+            self.busy_label.pack(side=tk.LEFT, padx=(16, 4))
+            self.busy_bar.pack(side=tk.LEFT)
+            self.busy_bar.start(15)
+        else:
+            self.busy_bar.stop()
+            self.busy_bar.pack_forget()
+            self.busy_label.pack_forget()
 
     def _schedule_resize_updates(self, side: str):
         """プレビュー画像の表示サイズ更新をスケジュール"""
@@ -0,0 +1,27 @@
+"""テスト共通のフィクスチャ"""
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+IMAGE = Path(__file__).resolve().parents[1] / "images" / "image_top.png"
+
+
+@pytest.fixture(scope="session")
+def photo():
+    """images/image_top.png の左半分(入力画像)と右半分(参照画像) (uint8 の RGB 画像)"""
+
+    img = np.asarray(Image.open(IMAGE).convert("RGB"))
+    w = img.shape[1] // 2
+    return np.ascontiguousarray(img[:, :w]), np.ascontiguousarray(img[:, w:])
+
+
+@pytest.fixture(scope="session")
+def photo16(photo):
+    """photo の入力画像を 16bit にした画像 (下位の 8bit に乱数を加え、65536 段階の階調を持たせる)"""
+
+    src, _ = photo
+    noise = np.random.default_rng(0).integers(0, 257, src.shape)
+    return (src.astype(np.uint16) * 257 + noise).astype(np.uint16)
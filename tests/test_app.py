@@ -0,0 +1,25 @@
+"""GUI アプリケーション (color_match_app) のプレビューと保存する画像のテスト"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("tkinter")
+pytest.importorskip("tkinterdnd2")
+
+import color_match
+import color_match_app
+
+
+@pytest.mark.parametrize("mode", color_match.MODES)
+@pytest.mark.parametrize("method", color_match.METHODS)
+def test_save_matches_preview(photo, method, mode):
+    """プレビューと同じ大きさの画像では、保存する画像はプレビューと同じ (Strength値を含む)"""
+
+    src, ref = photo
+    strength = 0.5
+    matched = color_match_app._preview_session(src, ref).match(method, mode)
+    preview = color_match.utils.blend(src, matched, strength)
+    progress = []
+    out = color_match_app._match_full(src, ref, method, mode, strength, progress.append)
+    np.testing.assert_array_equal(out, preview)
+    assert progress[-1] == 1.0
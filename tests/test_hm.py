@@ -0,0 +1,51 @@
+"""8bit の画像の HM と複合法の結果のテスト"""
+
+import numpy as np
+import pytest
+
+import color_match
+from color_match import bench, hm, utils
+
+
+def test_lut_is_quantized(photo):
+    """8bit 同士の HM の LUT は整数 (uint8 の LUT と同じ値)"""
+
+    src, ref = photo
+    lut = hm.transform(hm.fit(src), hm.fit(ref))["lut"]
+    np.testing.assert_array_equal(lut, np.floor(lut))
+    np.testing.assert_array_equal(color_match.match(src, ref, "hm", "rgb"), hm.match_rgb(src, ref))
+
+
+@pytest.mark.parametrize("method", ["hm-mvgd-hm", "hm-mkl-hm"])
+def test_fused_matches_staged(photo, method):
+    """rgb モードの一体化した複合法は、処理段ごとに uint8 で受け渡す手順と同じ結果"""
+
+    src, ref = photo
+    np.testing.assert_array_equal(color_match.match(src, ref, method, "rgb"), bench.staged(src, ref, method, "rgb"))
+
+
+def test_quantize_rounding_error():
+    """整数からわずかに(Lab変換の丸め誤差程度)小さい値は、その整数のビンに入る"""
+
+    x = np.array([[255.0 - 3e-14], [128.0 - 2.9e-14], [127.5], [-1e-13]])
+    np.testing.assert_array_equal(hm._quantize(x)[:, 0], [255, 128, 127, 0])
+
+
+@pytest.mark.parametrize("backend", ["skimage", "cv2"])
+def test_lab_backends_same_bins(photo, backend):
+    """Lab変換のバックエンド間で L の差が丸め誤差程度の画素は、HM の同じビンに入る"""
+
+    if backend not in color_match.available_backends():
+        pytest.skip(f"{backend} が利用できない")
+    src, _ = photo
+    previous = utils.get_backend()
+    try:
+        utils.set_backend("numpy")
+        expected = utils.rgb2lab(src)[..., :1]
+        utils.set_backend(backend)
+        lab = utils.rgb2lab(src)[..., :1]
+    finally:
+        utils.set_backend(previous)
+    close = np.abs(lab - expected)[..., 0] < 1e-9
+    assert close.any()
+    np.testing.assert_array_equal(hm._quantize(lab)[close], hm._quantize(expected)[close])
@@ -0,0 +1,57 @@
+"""画像ファイルの読み込みのエラーのテスト"""
+
+import numpy as np
+import pytest
+
+from color_match import imagefile
+
+
+@pytest.fixture
+def image():
+    return np.random.default_rng(0).integers(0, 256, (64, 96, 3), dtype=np.uint8)
+
+
+def test_truncated_png(tmp_path, image):
+    """途中で切れた 8bit の PNG はパスを付けた ValueError (元の例外を保持する)"""
+
+    path = tmp_path / "broken.png"
+    data = imagefile.encode(image, ".png")
+    path.write_bytes(data[:len(data) // 2])
+    with pytest.raises(ValueError, match="broken.png") as info:
+        imagefile.read(path)
+    assert info.value.__cause__ is not None
+
+
+def test_unknown_bytes(tmp_path):
+    """画像でないファイルは、OpenCV / tifffile の有無に関わらずパスを付けた ValueError"""
+
+    path = tmp_path / "noise.png"
+    path.write_bytes(b"\x00" * 1000)
+    with pytest.raises(ValueError, match="noise.png"):
+        imagefile.read(path)
+
+
+def test_corrupt_high_depth(tmp_path, image):
+    """OpenCV / tifffile がある場合、壊れた 16bit の PNG は「opencv-python か tifffile が必要」のエラーにしない"""
+
+    if imagefile._cv2() is None:
+        pytest.skip("opencv-python が利用できない")
+    path = tmp_path / "broken16.png"
+    data = imagefile.encode(image.astype(np.uint16) * 257, ".png")
+    path.write_bytes(data[:len(data) // 2])
+    with pytest.raises(ValueError, match="broken16.png") as info:
+        imagefile.read(path)
+    assert "必要" not in str(info.value)
+
+
+@pytest.mark.filterwarnings("ignore:Corrupt EXIF data")
+def test_corrupt_tiff(tmp_path, image):
+    """tifffile で読み込めない TIFF は、tifffile の例外を保持した ValueError"""
+
+    if imagefile._tifffile() is None:
+        pytest.skip("tifffile が利用できない")
+    path = tmp_path / "broken.tif"
+    path.write_bytes(b"II*\x00" + b"\xff" * 100)
+    with pytest.raises(ValueError, match="broken.tif") as info:
+        imagefile.read(path)
+    assert "必要" not in str(info.value)
@@ -0,0 +1,35 @@
+"""workers (行ブロック単位のスレッド並列処理) の結果のテスト"""
+
+import numpy as np
+import pytest
+
+import color_match
+from color_match import parallel
+
+
+@pytest.fixture(scope="module", params=["8bit", "16bit"])
+def images(request, photo, photo16):
+    """(入力画像, 参照画像, 8bit の1階調の値) (入力画像は複数の行ブロックに分かれる大きさ)"""
+
+    src, ref = photo
+    if request.param == "16bit":
+        return photo16, ref, 257.0
+    return src, ref, 1.0
+
+
+@pytest.mark.parametrize("mode", color_match.MODES)
+@pytest.mark.parametrize("method", color_match.METHODS)
+def test_workers(images, method, mode):
+    """
+    workers が 2 以上の結果はスレッド数に関わらず同じで、1スレッドの結果との差は 1 階調以内
+    (統計量を行ブロックごとに統合する丸め誤差の分だけ、まれに量子化の境界を越える画素がある)
+    """
+
+    src, ref, level = images
+    assert len(parallel.blocks(src)) > 1
+    expected = color_match.match(src, ref, method, mode)
+    out = color_match.match(src, ref, method, mode, workers=2)
+    np.testing.assert_array_equal(color_match.match(src, ref, method, mode, workers=3), out)
+    diff = np.abs(out.astype(np.float64) - expected) / level
+    assert np.max(diff) <= 1.0
+    assert np.mean(diff > 0) < 1e-4
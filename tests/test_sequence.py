@@ -0,0 +1,90 @@
+"""動画のカラーマッチング(SequenceMatcher)のテスト"""
+
+import numpy as np
+import pytest
+
+import color_match
+from color_match import imagefile, sequence
+
+
+@pytest.mark.parametrize("method", color_match.METHODS)
+def test_mixed_frame_sizes(photo, method):
+    """解像度の異なるフレームを続けて処理できる (統計量の画素数がフレームごとに異なる)"""
+
+    src, ref = photo
+    matcher = sequence.SequenceMatcher(ref, method, "rgb", smoothing=0.5, reuse_tol=0.0)
+    for frame in (src, src[:100, :120], src[50:400, 30:500], src[:60, :60]):
+        out = matcher.match(np.ascontiguousarray(frame))
+        assert out.shape == frame.shape
+        assert out.dtype == np.uint8
+    assert matcher.frames == 4
+
+
+def test_smooth_samples():
+    """抽出した画素は重みの比で混ぜる (フレームごとに画素数が異なってもよい)"""
+
+    prev = {"samples": np.zeros((1000, 3)), "count": np.array(1000)}
+    cur = {"samples": np.ones((300, 3)), "count": np.array(300)}
+    out = sequence.smooth_stats(prev, cur, 0.25)
+    assert int(out["count"]) == 300
+    assert np.mean(out["samples"]) == pytest.approx(0.25, abs=0.01)
+    assert sequence.smooth_stats(None, cur, 0.25) is cur
+
+
+def test_16bit_bins(photo, photo16):
+    """
+    16bit のフレームは match() と同じく 65536 段階のヒストグラムで HM を行う
+    (差はヒストグラムを画素数で正規化する丸め誤差による 16bit の 1 階調以内)
+    """
+
+    _, ref = photo
+    matcher = sequence.SequenceMatcher(ref, "hm", "rgb", smoothing=1.0)
+    out = matcher.match(photo16)
+    assert out.dtype == np.uint16
+    diff = np.abs(out.astype(np.int64) - color_match.match(photo16, ref, "hm", "rgb"))
+    assert np.max(diff) <= 1
+
+
+def _frames16(photo16) -> list:
+    return [np.ascontiguousarray(photo16[i * 40:i * 40 + 200, :300]) for i in range(3)]
+
+
+def test_16bit_folder_round_trip(tmp_path, photo, photo16):
+    """16bit の連番画像のフォルダは 16bit のまま読み込み、16bit のまま保存する"""
+
+    if imagefile._cv2() is None and imagefile._tifffile() is None:
+        pytest.skip("16bit の TIFF の保存に opencv-python か tifffile が必要")
+    _, ref = photo
+    frames = _frames16(photo16)
+    src_dir = tmp_path / "src"
+    src_dir.mkdir()
+    for i, frame in enumerate(frames):
+        imagefile.write(frame, src_dir / f"{i:03d}.tif")
+
+    sequence.run(src_dir, ref, tmp_path / "out", "hm-mkl-hm", "rgb", log=None)
+    matcher = sequence.SequenceMatcher(ref, "hm-mkl-hm", "rgb")
+    for i, frame in enumerate(frames):
+        out = imagefile.read(tmp_path / "out" / f"{i:03d}.tif")
+        assert out.dtype == np.uint16
+        np.testing.assert_array_equal(out, matcher.match(frame))
+
+
+def test_16bit_container_round_trip(tmp_path, photo, photo16):
+    """16bit のマルチページTIFFは 16bit のまま読み込み、16bit のまま保存する"""
+
+    if imagefile._tifffile() is None:
+        pytest.skip("16bit のマルチページTIFFの読み書きに tifffile が必要")
+    _, ref = photo
+    frames = _frames16(photo16)
+    imagefile.write_frames(frames, tmp_path / "src.tif")
+    read = list(imagefile.read_frames(tmp_path / "src.tif"))
+    for a, b in zip(read, frames):
+        np.testing.assert_array_equal(a, b)
+
+    sequence.run(tmp_path / "src.tif", ref, tmp_path / "out.tif", "mkl", "rgb", log=None)
+    matcher = sequence.SequenceMatcher(ref, "mkl", "rgb")
+    out = list(imagefile.read_frames(tmp_path / "out.tif"))
+    assert len(out) == len(frames)
+    for a, frame in zip(out, frames):
+        assert a.dtype == np.uint16
+        np.testing.assert_array_equal(a, matcher.match(frame))
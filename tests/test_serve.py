@@ -0,0 +1,126 @@
+"""serve サブコマンドの HTTP サーバの応答のテスト"""
+
+import http.client
+import json
+import threading
+
+import numpy as np
+import pytest
+
+from color_match import imagefile, serve
+
+
+@pytest.fixture(scope="module")
+def server():
+    """ポートを自動で割り当てて起動したサーバ (参照画像 "ref" を登録済み)"""
+
+    srv = serve.MatchServer(("127.0.0.1", 0), serve.ReferenceStore(), workers=2)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    ref = np.random.default_rng(0).integers(0, 256, (32, 48, 3), dtype=np.uint8)
+    srv.store.add(imagefile.encode(ref), "ref")
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def _post(server, path: str, body: bytes, length=None) -> tuple:
+    """POST して (ステータス, 本文) を返す (length で Content-Length を上書きする)"""
+
+    conn = http.client.HTTPConnection(*server.server_address[:2], timeout=30)
+    try:
+        conn.putrequest("POST", path)
+        if length is not False:
+            conn.putheader("Content-Length", str(len(body)) if length is None else length)
+        conn.endheaders()
+        conn.send(body)
+        res = conn.getresponse()
+        return res.status, res.read()
+    finally:
+        conn.close()
+
+
+@pytest.fixture(scope="module")
+def src():
+    return imagefile.encode(np.random.default_rng(1).integers(0, 256, (24, 40, 3), dtype=np.uint8))
+
+
+def test_match(server, src):
+    status, body = _post(server, "/match?ref=ref&method=mkl&dtype=float32", src)
+    assert status == 200
+    assert imagefile.decode(body).shape == (24, 40, 3)
+
+
+def test_invalid_dtype(server, src):
+    status, body = _post(server, "/match?ref=ref&dtype=int8", src)
+    assert status == 400
+    assert "dtype" in json.loads(body)["error"]
+    assert _post(server, "/match?ref=ref&dtype=foo", src)[0] == 400
+
+
+def test_unknown_reference(server, src):
+    assert _post(server, "/match?ref=missing", src)[0] == 404
+
+
+def test_other_key_error(server, src, monkeypatch):
+    """参照画像の検索以外の KeyError は 404 にしない"""
+
+    def _fail(data, query):
+        raise KeyError("lut")
+
+    monkeypatch.setattr(server, "match", _fail)
+    assert _post(server, "/match?ref=ref", src)[0] == 500
+
+
+@pytest.mark.parametrize("length", ["-1", "abc", "1.5"])
+def test_invalid_content_length(server, length):
+    assert _post(server, "/references", b"", length)[0] == 400
+
+
+def test_missing_content_length(server):
+    assert _post(server, "/references", b"", False)[0] == 411
+
+
+def test_profile_lru_after_wait():
+    """他のスレッドの計算を待って得た参照プロファイルも、最近使われたものとして LRU の末尾に移す"""
+
+    store = serve.ReferenceStore(cache_size=2)
+    ref = np.random.default_rng(0).integers(0, 256, (16, 16, 3), dtype=np.uint8)
+    store.add(imagefile.encode(ref), "ref")
+    store.profile("ref", "mkl", "rgb")
+    store.profile("ref", "mvgd", "rgb")
+    key = ("ref", "mkl", "rgb", ())
+
+    # 計算中のキーのロックを待つ間に、別のスレッドが計算を終えた場合を再現する
+    class _Lock:
+        def __init__(self):
+            self.waiting = threading.Event()
+            self.inner = threading.Lock()
+
+        def __enter__(self):
+            self.waiting.set()
+            self.inner.acquire()
+
+        def __exit__(self, *args):
+            self.inner.release()
+
+    lock = _Lock()
+    lock.inner.acquire()
+    with store._lock:
+        store._fitting[key] = lock
+        hit = store._profiles.pop(key)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(store.profile("ref", "mkl", "rgb")))
+    thread.start()
+    assert lock.waiting.wait(10)
+    with store._lock:
+        store._profiles[key] = hit
+        store._profiles.move_to_end(("ref", "mvgd", "rgb", ()))
+    lock.inner.release()
+    thread.join()
+    assert result == [hit]
+
+    # 待っていた参照プロファイルは最後に使われた為、次の追加では破棄されない
+    store.profile("ref", "hm", "rgb")
+    assert key in store._profiles
+    assert ("ref", "mvgd", "rgb", ()) not in store._profiles